@@ -0,0 +1,176 @@
+"""
+Admin API endpoints, guarded by the X-Admin-Token header.
+History export streams message_history as zstd-compressed JSONL without
+loading it into memory; scripts/export_history.py does the same into
+chunked, resumable files. Credit campaigns grant credits to many users
+at once; scripts/grant_credits.py is the command line version. Analytics
+are served from the daily rollups of backend.database.rollups.
+"""
+
+from datetime import date, datetime, timedelta
+from functools import partial
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.api.dependencies import get_read_session, get_session, require_admin
+from backend.config import settings
+from backend.database import crud, rollups
+from backend.database.session import read_session_scope
+from backend.models.enums import AIProviderType
+from backend.models.schemas import (
+    ActiveUsersReport, ActiveUsersRollupRow, CreditCampaignReport, CreditCampaignRequest,
+    RevenueReport, RevenueRollupRow, UsageReport, UsageRollupRow
+)
+from backend.services.credit_campaigns import CampaignFilter, run_campaign
+from backend.services.history_export import ExportFilter, stream_jsonl_zstd
+from backend.utils.exceptions import UserNotFound
+
+router = APIRouter(prefix="/api/v1/admin", dependencies=[Depends(require_admin)])
+
+# Days reported when since is not given
+ANALYTICS_DEFAULT_DAYS = 30
+
+
+@router.get("/history/export")
+async def export_history(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    provider: Optional[AIProviderType] = None,
+    telegram_id: Optional[str] = None,
+    after_created_at: Optional[datetime] = None,
+    after_id: Optional[int] = None
+):
+    """
+    Matching rows as zstd-compressed JSONL in (created_at, id) order. To resume
+    an interrupted download, pass created_at and id of the last row received
+    as after_created_at and after_id. Every batch is keyset-paged in a session
+    of its own, so a slow client holds no connection between batches.
+    """
+    user_id = None
+    if telegram_id is not None:
+        async with read_session_scope() as session:
+            user = await crud.get_user_by_telegram(session, telegram_id)
+        if not user:
+            raise UserNotFound()
+        user_id = user.id
+    elif settings.DB_SHARDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="With DB_SHARDS, export one telegram_id here or run scripts/export_history.py --shard for each shard"
+        )
+
+    filters = ExportFilter(since=since, until=until, provider=provider, user_id=user_id)
+    after = (after_created_at, after_id) if after_created_at is not None and after_id is not None else None
+    return StreamingResponse(
+        stream_jsonl_zstd(
+            partial(read_session_scope, user.telegram_id if user_id is not None else None),
+            filters,
+            after,
+            settings.EXPORT_BATCH_SIZE
+        ),
+        media_type="application/zstd",
+        headers={"Content-Disposition": 'attachment; filename="message_history.jsonl.zst"'},
+    )
+
+
+@router.post("/credits/campaigns", response_model=CreditCampaignReport)
+async def grant_campaign_credits(req: CreditCampaignRequest, session: AsyncSession = Depends(get_session)):
+    """
+    Credit req.amount to the listed telegram_ids, or to the users matching the
+    filters. Safe to repeat: users already credited by the campaign are skipped.
+    """
+    filters = None
+    if req.telegram_ids is None:
+        filters = CampaignFilter(
+            active_since=req.active_since,
+            created_before=req.created_before,
+            plan=req.plan,
+            is_vip=req.is_vip,
+        )
+        if filters.is_empty() and not req.all_users:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Give telegram_ids, a filter or all_users=true"
+            )
+
+    try:
+        report = await run_campaign(
+            session, req.campaign_id, req.amount, req.telegram_ids, filters, settings.CAMPAIGN_CHUNK_SIZE
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+    return CreditCampaignReport(
+        campaign_id=report.campaign_id,
+        amount=report.amount,
+        targeted=report.targeted,
+        granted=report.granted,
+        skipped=report.skipped,
+        chunks=report.chunks,
+        seconds=report.seconds,
+    )
+
+
+def _date_range(since: Optional[date], until: Optional[date]) -> tuple:
+    until = until or date.today()
+    since = since or until - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if since > until:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="since is after until")
+    return since, until
+
+
+@router.get("/analytics/usage", response_model=UsageReport)
+async def usage_analytics(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    provider: Optional[AIProviderType] = None,
+    session: AsyncSession = Depends(get_read_session)
+):
+    """Messages and tokens per day, provider, model and plan"""
+    since, until = _date_range(since, until)
+    rows = await rollups.usage(session, since, until, provider)
+    return UsageReport(
+        as_of=await rollups.folded_until(session, "usage"),
+        rows=[
+            UsageRollupRow(
+                day=day, ai_provider=ai_provider, ai_model=ai_model, plan=plan,
+                messages=messages, user_tokens=user_tokens, response_tokens=response_tokens
+            )
+            for day, ai_provider, ai_model, plan, messages, user_tokens, response_tokens in rows
+        ],
+    )
+
+
+@router.get("/analytics/active-users", response_model=ActiveUsersReport)
+async def active_users_analytics(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    session: AsyncSession = Depends(get_read_session)
+):
+    """Distinct active users per day and plan, up to the last heartbeat flush"""
+    since, until = _date_range(since, until)
+    rows = await rollups.active_users(session, since, until)
+    return ActiveUsersReport(
+        rows=[ActiveUsersRollupRow(day=day, plan=plan, users=users) for day, plan, users in rows],
+    )
+
+
+@router.get("/analytics/revenue", response_model=RevenueReport)
+async def revenue_analytics(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    session: AsyncSession = Depends(get_read_session)
+):
+    """Successful payments and their sum per day (payment_date) and currency"""
+    since, until = _date_range(since, until)
+    rows = await rollups.revenue(session, since, until)
+    return RevenueReport(
+        as_of=await rollups.folded_until(session, "revenue"),
+        rows=[
+            RevenueRollupRow(day=day, currency=currency, payments=payments, amount=float(amount))
+            for day, currency, payments, amount in rows
+        ],
+    )
@@ -7,8 +7,35 @@ by the database development team (dev3). This module focuses solely on
 session management and lifecycle.
 """         
 
-from backend.database.session import get_db 
-                       
+import hmac
+from typing import Optional
+
+from fastapi import Header, HTTPException, status
+
+from backend.config import settings
+from backend.database.session import read_session_scope, session_scope
+
+
 async def get_session():
-    async for s in get_db():
-        yield s
+    """One session per request: committed after the response, rolled back if the route raised"""
+    async with session_scope() as session:
+        yield session
+
+
+async def get_read_session(telegram_id: Optional[str] = None):
+    """
+    Session for read-only routes: the replica if one is configured, it keeps up,
+    and the telegram_id query parameter's user has not written just now
+    """
+    try:
+        telegram_id_int = int(telegram_id) if telegram_id is not None else None
+    except ValueError:
+        telegram_id_int = None
+    async with read_session_scope(telegram_id_int) as session:
+        yield session
+
+
+async def require_admin(x_admin_token: str = Header(default="")):
+    """Admin routes: X-Admin-Token must match ADMIN_API_TOKEN; all refused while it is unset"""
+    if not settings.ADMIN_API_TOKEN or not hmac.compare_digest(x_admin_token, settings.ADMIN_API_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin token required")
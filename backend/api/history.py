@@ -0,0 +1,68 @@
+"""
+Message history API.
+Pages through a user's questions and answers newest first with keyset
+(cursor) pagination, so every page costs the same however far back it is.
+"""
+
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.api.dependencies import get_read_session
+from backend.config import settings
+from backend.database import crud
+from backend.models.schemas import HistoryItem, HistoryPage
+from backend.utils.cursor import decode_cursor, encode_cursor
+from backend.utils.exceptions import InvalidCursor, UserNotFound
+
+router = APIRouter(prefix="/api/v1")
+
+
+def _preview(text: Optional[str], limit: int):
+    """Text cut to limit characters, and whether it was longer"""
+    text = text or ""
+    return (text[:limit], True) if len(text) > limit else (text, False)
+
+
+@router.get("/history", response_model=HistoryPage)
+async def get_history(
+    telegram_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(settings.HISTORY_PAGE_SIZE, ge=1, le=settings.HISTORY_MAX_PAGE_SIZE),
+    session: AsyncSession = Depends(get_read_session)
+):
+    """
+    One page of the user's history of the last HISTORY_QUERY_WINDOW_DAYS days;
+    pass next_cursor back as cursor for the next one.
+    """
+    try:
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise InvalidCursor()
+
+    user = await crud.get_user_by_telegram(session, telegram_id)
+    if not user:
+        raise UserNotFound()
+
+    # One extra row tells whether there is a next page
+    rows = await crud.get_history_page(session, user.id, user.telegram_id, limit + 1, before, settings.HISTORY_PREVIEW_CHARS)
+    items = []
+    for row in rows[:limit]:
+        user_message, message_cut = _preview(row.user_message, settings.HISTORY_PREVIEW_CHARS)
+        ai_response, response_cut = _preview(row.ai_response, settings.HISTORY_PREVIEW_CHARS)
+        items.append(HistoryItem(
+            id=row.id,
+            created_at=row.created_at,
+            ai_provider=row.ai_provider,
+            ai_model=row.ai_model,
+            user_message=user_message,
+            ai_response=ai_response,
+            truncated=message_cut or response_cut,
+        ))
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.created_at, last.id)
+    return HistoryPage(items=items, next_cursor=next_cursor)
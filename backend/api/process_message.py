@@ -2,79 +2,193 @@
 Message processing API endpoint for AI assistant interactions.
 Handles user message processing through AI providers with credit/trial management.
 """
-from fastapi import APIRouter, Depends
+import json
+from fastapi import APIRouter, BackgroundTasks, Depends
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.ext.asyncio import AsyncSession
 from backend.api.dependencies import get_session
+from backend.database.session import get_async_sessionmaker
+from backend.config import settings
 from backend.models.schemas import ProcessMessageRequest, ProcessMessageResponse
-from backend.services.ai_service import get_default_adapter
+from backend.services.ai_service import get_default_adapter, ai_service, resolve_model, model_code_for
+from backend.services.conversation import build_context, update_summary
+from backend.services.circuit_breaker import CircuitOpen
 from backend.database import crud
 from backend.utils.logger import logger
 from backend.utils.exceptions import NotEnoughCredits, AIServiceError
-from backend.models.enums import AIProviderType
 
 router = APIRouter(prefix="/api/v1")
 
-@router.post("/process_message", response_model=ProcessMessageResponse)
-async def process_message(payload: ProcessMessageRequest, session: AsyncSession = Depends(get_session)):
+
+def _telegram_id(payload: ProcessMessageRequest) -> int:
     try:
-        telegram_id_int = int(payload.telegram_id)
+        return int(payload.telegram_id)
     except ValueError:
-        telegram_id_int = 0
-    
-    user = await crud.get_user_by_telegram_id(session, telegram_id_int)
-    
-    if not user:
-        user = await crud.create_user(session, telegram_id_int)
-    
-    await crud.create_or_update_active_user(session, user.id)
-    
-    if not (user.trial_messages_left > 0 or user.is_vip):
+        return 0
+
+
+async def _reserve_message(session: AsyncSession, payload: ProcessMessageRequest):
+    """
+    Find or create the user, reserve one message credit and mark them active,
+    all in one statement (crud.reserve_message). VIP users are not charged and
+    get no reservation. Returns the row (id, trial_messages_left, is_vip, reservation_id).
+    """
+    user = await crud.reserve_message(
+        session, _telegram_id(payload), settings.TRIAL_MESSAGE_LIMIT, settings.CREDIT_RESERVATION_TTL
+    )
+    if user is None:
         raise NotEnoughCredits("No credits or active trial")
 
-    charged_trial = False
-    if user.trial_messages_left > 0:
-        updated_user = await crud.decrement_trial_messages(session, user.id)
-        if updated_user:
-            user = updated_user
-        charged_trial = True
-    else:
-        updated_user = await crud.update_user(
-            session, 
-            user.id, 
-            trial_messages_left=user.trial_messages_left - 1
-        )
-        if updated_user:
-            user = updated_user
-        await session.flush()
+    return user
+
+
+async def _release_message(session: AsyncSession, user, telegram_id: str) -> None:
+    """
+    Release the reservation after an AI error. If this fails the sweeper
+    returns the credit once the reservation expires.
+    """
+    if user.reservation_id is None:
+        return
+    try:
+        await crud.release_reservation(session, user.reservation_id)
+    except Exception:
+        logger.exception("Failed to release reservation after AI error for user=%s", telegram_id)
+
+
+def _sse(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _single_chunk(text: str):
+    yield text
+
+
+async def _conversation_context(session: AsyncSession, user, provider, model, text: str):
+    """
+    Earlier turns of the user's chat that fit the model's prompt budget.
+    The read transaction is ended here, so the session holds no connection
+    while the provider answers.
+    """
+    context = await build_context(
+        session,
+        user.id,
+        model_code_for(provider, model),
+        ai_service.system_prompt_for(provider, model),
+        text
+    )
+    await session.commit()
+    return context
+
+
+def _summary_task_args(payload: ProcessMessageRequest, user, provider, model):
+    """
+    Arguments for update_summary, run once the reply has been sent. It opens
+    sessions of its own rather than keeping the request's through its AI call.
+    """
+    return (
+        get_async_sessionmaker(),
+        _telegram_id(payload),
+        user.id,
+        model_code_for(provider, model),
+        ai_service.system_prompt_for(provider, model),
+        ai_service
+    )
+
+
+@router.post("/process_message", response_model=ProcessMessageResponse)
+async def process_message(
+    payload: ProcessMessageRequest,
+    background_tasks: BackgroundTasks,
+    session: AsyncSession = Depends(get_session)
+):
+    provider, model = resolve_model(payload.model_code)
+    user = await _reserve_message(session, payload)
 
     ai = get_default_adapter()
     try:
-        reply = await ai.generate(payload.text)
+        context = await _conversation_context(session, user, provider, model, payload.text)
+        reply = await ai.generate(payload.text, provider, model, context)
     except Exception as exc:
         logger.exception("AI error for user=%s", payload.telegram_id)
-        try:
-            if charged_trial:
-                updated_user = await crud.update_user(
-                    session, 
-                    user.id, 
-                    trial_messages_left=user.trial_messages_left + 1
-                )
-                if updated_user:
-                    user = updated_user
-            await session.flush()
-        except Exception:
-            logger.exception("Failed to refund after AI error for user=%s", payload.telegram_id)
+        await _release_message(session, user, payload.telegram_id)
         raise AIServiceError()
 
-    await crud.create_message_history(
-        session, 
+    # History and the reservation (committed, or released for a free cache hit)
+    # are written in one transaction
+    release = reply.cached and not settings.AI_CACHE_CHARGE_CREDITS
+    remaining = await crud.save_reply(
+        session,
         user.id,
-        ai_provider=AIProviderType.CHATGPT,
-        ai_model="gpt-3.5-turbo",
+        ai_provider=reply.provider,
+        ai_model=reply.model,
         user_message=payload.text,
-        ai_response=reply
+        ai_response=reply.text,
+        reservation_id=user.reservation_id,
+        release=release
     )
-    await session.flush()
+    background_tasks.add_task(update_summary, *_summary_task_args(payload, user, provider, model))
+
+    if remaining is None:
+        remaining = user.trial_messages_left
+    return ProcessMessageResponse(reply=reply.text, remaining_credits=remaining)
+
+
+@router.post("/process_message/stream")
+async def process_message_stream(payload: ProcessMessageRequest, session: AsyncSession = Depends(get_session)):
+    """
+    Same as /process_message, but streams the reply as Server-Sent Events.
+    Each chunk is sent as `data: {"delta": ...}`, the stream ends with
+    `event: done` carrying remaining credits, or `event: error`.
+    """
+    provider, model = resolve_model(payload.model_code)
+    user = await _reserve_message(session, payload)
 
-    remaining = user.trial_messages_left
-    return ProcessMessageResponse(reply=reply, remaining_credits=remaining)
\ No newline at end of file
+    context = await _conversation_context(session, user, provider, model, payload.text)
+    cached = await ai_service.cache_lookup(payload.text, provider, model, context)
+    release = False
+    if cached is not None:
+        chunks = _single_chunk(cached)
+        release = not settings.AI_CACHE_CHARGE_CREDITS
+    else:
+        try:
+            provider, model = ai_service.route(provider, model)
+        except CircuitOpen:
+            logger.warning("AI circuit open for user=%s", payload.telegram_id)
+            await _release_message(session, user, payload.telegram_id)
+            raise AIServiceError()
+        chunks = ai_service.stream_message(payload.text, provider, model, context)
+
+    async def events():
+        parts = []
+        try:
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield _sse({"delta": chunk})
+        except Exception:
+            logger.exception("AI stream error for user=%s", payload.telegram_id)
+            await _release_message(session, user, payload.telegram_id)
+            yield _sse({"detail": AIServiceError().detail}, event="error")
+            return
+
+        remaining = await crud.save_reply(
+            session,
+            user.id,
+            ai_provider=provider,
+            ai_model=model,
+            user_message=payload.text,
+            ai_response="".join(parts),
+            reservation_id=user.reservation_id,
+            release=release
+        )
+        if remaining is None:
+            remaining = user.trial_messages_left
+        yield _sse({"remaining_credits": remaining}, event="done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(update_summary, *_summary_task_args(payload, user, provider, model)),
+    )
@@ -5,7 +5,7 @@ to be properly described at a later time
 
 from fastapi import APIRouter, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
-from backend.api.dependencies import get_session
+from backend.api.dependencies import get_read_session, get_session
 from backend.models.schemas import RegisterRequest, UserProfile
 from backend.services.user_service import register_user, get_profile
 from backend.utils.logger import logger
@@ -20,6 +20,6 @@ async def register(payload: RegisterRequest, session: AsyncSession = Depends(get
     return {"ok": True, "telegram_id": user.telegram_id}
 
 @router.get("/user_profile", response_model=UserProfile)
-async def user_profile(telegram_id: str, session: AsyncSession = Depends(get_session)):
+async def user_profile(telegram_id: str, session: AsyncSession = Depends(get_read_session)):
     profile = await get_profile(session, telegram_id)
     return profile
\ No newline at end of file
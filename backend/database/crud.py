@@ -1,52 +1,34 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from typing import Optional, List
-from datetime import datetime, date
+from sqlalchemy import BigInteger, select, update, delete, desc, and_, or_, case, exists, false, func, literal, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, List, Sequence, Tuple
+from datetime import datetime, date, timedelta
 from backend.models.database import (
-    User, ActiveUser, MessageHistory, Subscription, Payment
+    User, ActiveUser, MessageHistory, ConversationSummary, CreditReservation, CreditCampaign, CreditGrant,
+    Subscription, Payment
 )
-from backend.models.enums import AIProviderType, SubscriptionPlanType
-
-def get_user_by_telegram_id(db: Session, telegram_id: int) -> Optional[User]:
-    return db.query(User).filter(User.telegram_id == telegram_id).first()
-
-def create_user(db: Session, telegram_id: int) -> User:
-    db_user = User(telegram_id=telegram_id)
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    
-    active_user = ActiveUser(user_id=db_user.id)
-    db.add(active_user)
-    db.commit()
-    
-    return db_user
-
-def update_user_last_active(db: Session, user_id: int) -> None:
-    db.query(User).filter(User.id == user_id).update({
-        "last_active": datetime.now()
-    })
-    db.query(ActiveUser).filter(ActiveUser.user_id == user_id).update({
-        "updated_at": datetime.now()
-    })
-    db.commit()
-
-def decrement_trial_messages(db: Session, user_id: int) -> None:
-    db.query(User).filter(
-        User.id == user_id,
-        User.trial_messages_left > 0
-    ).update({
-        "trial_messages_left": User.trial_messages_left - 1
-    })
-    db.commit()
-
-<<<<<<< HEAD
-def create_message_history(
-    db: Session,
-=======
+from backend.models.enums import AIProviderType, SubscriptionPlanType, CurrencyType
+from backend.database.heartbeats import heartbeats
+from backend.database.history_writer import history_writer
+from backend.database.sharding import on_every_shard, route, shard_of, unrouted
+from backend.database.status_cache import UserStatus, status_cache
+from backend.config import settings
+from backend.utils.tokens import count_tokens
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# ========== USER CRUD OPERATIONS ==========
+#
+# При DB_SHARDS сессия — ShardSession: функции, получающие telegram_id,
+# сначала направляют её на шард пользователя (route), остальные работают
+# на уже выбранном шарде. Запросы не про одного пользователя (сборщики,
+# выборки для админки) выполняются на всех шардах (on_every_shard).
 
 async def get_user_by_telegram_id(session: AsyncSession, telegram_id: int) -> Optional[User]:
     """Получить пользователя по telegram_id"""
+    await route(session, telegram_id)
     stmt = select(User).where(User.telegram_id == telegram_id)
     result = await session.execute(stmt)
     return result.scalar_one_or_none()
@@ -56,21 +38,11 @@ async def get_user_with_active_subscription(
     session: AsyncSession,
     telegram_id: int
 ) -> Optional[User]:
-    """Получить пользователя по telegram_id с активной подпиской"""
-    stmt = (
-        select(User)
-        .outerjoin(Subscription)
-        .where(
-            User.telegram_id == telegram_id,
-            or_(
-                Subscription.end_date >= date.today(),
-                Subscription.id.is_(None)
-            )
-        )
-        .options(selectinload(User.subscriptions))
-    )
-    result = await session.execute(stmt)
-    return result.scalar_one_or_none()
+    """
+    Получить пользователя по telegram_id. План и срок действующей подписки
+    уже в users.plan / users.access_until, запрос к subscriptions не нужен.
+    """
+    return await get_user_by_telegram_id(session, telegram_id)
 
 
 async def create_user(
@@ -80,6 +52,7 @@ async def create_user(
     is_vip: bool = False
 ) -> User:
     """Создать нового пользователя"""
+    await route(session, telegram_id)
     user = User(
         telegram_id=telegram_id,
         trial_messages_left=trial_messages_left,
@@ -88,7 +61,7 @@ async def create_user(
     session.add(user)
     await session.commit()
     await session.refresh(user)
-    await create_or_update_active_user(session, user.id)
+    heartbeats.touch(user.id, shard=shard_of(session))
 
     return user
 
@@ -96,9 +69,11 @@ async def create_user(
 async def update_user(
     session: AsyncSession,
     user_id: int,
+    telegram_id: int,
     **kwargs
 ) -> Optional[User]:
-    """Обновить данные пользователя"""
+    """Обновить данные пользователя (telegram_id выбирает шард)"""
+    await route(session, telegram_id)
     stmt = (
         update(User)
         .where(User.id == user_id)
@@ -107,18 +82,36 @@ async def update_user(
     )
     result = await session.execute(stmt)
     await session.commit()
+    await status_cache.invalidate(user_id)
 
     user = result.scalar_one_or_none()
     if user:
-        await create_or_update_active_user(session, user_id)
+        heartbeats.touch(user_id, shard=shard_of(session))
 
     return user
 
+
+async def update_user_last_active(session: AsyncSession, user_id: int) -> None:
+    """Отметить активность пользователя (запишется пакетом, см. heartbeats)"""
+    heartbeats.touch(user_id, shard=shard_of(session))
+
+
 async def get_transaction_by_id(session: AsyncSession, transaction_id: int) -> Optional[Payment]:
     """
     Get payment transaction by ID.
+    On an unrouted sharded session every shard is searched and the session
+    is bound to the one holding the payment.
     """
     stmt = select(Payment).where(Payment.id == transaction_id)
+    if unrouted(session):
+        async def find(shard_session):
+            return (await shard_session.execute(select(Payment.id).where(Payment.id == transaction_id))).first()
+
+        found = await session.fan_out(find)
+        shards = [shard for shard, row in zip(session.router.shards, found) if row is not None]
+        if not shards:
+            return None
+        session.bind_shard(shards[0])
     result = await session.execute(stmt)
     return result.scalar_one_or_none()
 
@@ -140,12 +133,12 @@ async def get_or_create_user(
         telegram_id_int = int(telegram_id)
     except ValueError:
         telegram_id_int = 0
-    
+
     user = await get_user_by_telegram_id(session, telegram_id_int)
-    
+
     if not user:
         user = await create_user(session, telegram_id_int, trial_messages_left, is_vip)
-    
+
     return user
 
 
@@ -158,13 +151,14 @@ async def change_credits(
         user.trial_messages_left += delta
     elif delta < 0:
         user.trial_messages_left = max(0, user.trial_messages_left + delta)
-    
+
     user.updated_at = datetime.utcnow()
     await session.commit()
+    await status_cache.invalidate(user.id)
     await session.refresh(user)
-    
-    await create_or_update_active_user(session, user.id)
-    
+
+    heartbeats.touch(user.id, shard=shard_of(session))
+
     return user
 
 async def update_user_by_telegram_id(
@@ -177,14 +171,16 @@ async def update_user_by_telegram_id(
     if not user:
         return None
 
-    return await update_user(session, user.id, **kwargs)
+    return await update_user(session, user.id, telegram_id, **kwargs)
 
 
 async def decrement_trial_messages(
     session: AsyncSession,
-    user_id: int
+    user_id: int,
+    telegram_id: int
 ) -> Optional[User]:
-    """Уменьшить счетчик trial_messages_left на 1"""
+    """Уменьшить счетчик trial_messages_left на 1 (telegram_id выбирает шард)"""
+    await route(session, telegram_id)
     stmt = (
         update(User)
         .where(
@@ -199,14 +195,243 @@ async def decrement_trial_messages(
     )
     result = await session.execute(stmt)
     await session.commit()
+    await status_cache.invalidate(user_id)
 
     user = result.scalar_one_or_none()
     if user:
-        await create_or_update_active_user(session, user_id)
+        heartbeats.touch(user_id, shard=shard_of(session))
 
     return user
 
 
+def vip_now(today: date):
+    """
+    VIP с учётом срока: выданный подпиской VIP перестаёт действовать сразу
+    после access_until, не дожидаясь expire_subscriptions.
+    """
+    return and_(User.is_vip, or_(User.access_until.is_(None), User.access_until >= today))
+
+
+# ========== MESSAGE HOT PATH ==========
+#
+# Кредит за сообщение резервируется до запроса к AI (reserve_message) и по
+# его итогу подтверждается (commit_reservation / save_reply) или
+# возвращается (release_reservation). Каждый шаг — один запрос. Кто первым
+# удалит строку резерва — подтверждение, отмена или сборщик просроченных
+# (release_expired_reservations), — тот и решает её судьбу, поэтому кредит
+# не возвращается дважды и не теряется, а остаток не уходит в минус.
+
+async def reserve_message(
+    session: AsyncSession,
+    telegram_id: int,
+    trial_messages_left: int = 10,
+    ttl: float = 300
+):
+    """
+    Одним запросом: создать пользователя при первом сообщении, списать одно
+    сообщение в резерв на ttl секунд (у VIP не списывается и резерв не
+    создаётся) и обновить last_active.
+    Возвращает строку (id, trial_messages_left, is_vip, reservation_id) или
+    None, если списывать нечего (в том числе новому пользователю при
+    trial_messages_left = 0).
+    """
+    await route(session, telegram_id)
+    now = datetime.utcnow()
+    vip = vip_now(now.date())
+    new_user = select(
+        literal(telegram_id, BigInteger),
+        literal(trial_messages_left - 1),
+        false(),
+        literal(now),
+        literal(now),
+        literal(now)
+    )
+    if trial_messages_left < 1:
+        # Без пробных сообщений строка предлагается только существующему
+        # пользователю, чтобы дойти до ON CONFLICT (VIP); новый не создаётся
+        new_user = new_user.where(exists().where(User.telegram_id == telegram_id))
+    charged = (
+        insert(User)
+        .from_select(
+            ["telegram_id", "trial_messages_left", "is_vip", "last_active", "created_at", "updated_at"],
+            new_user
+        )
+        .on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={
+                "trial_messages_left": case(
+                    (vip, User.trial_messages_left),
+                    else_=User.trial_messages_left - 1
+                ),
+                "last_active": now,
+                "updated_at": now
+            },
+            where=or_(vip, User.trial_messages_left > 0)
+        )
+        .returning(User.id, User.trial_messages_left, vip.label("is_vip"))
+        .cte("charged")
+    )
+    reserved = (
+        insert(CreditReservation)
+        .from_select(
+            ["user_id", "amount", "created_at", "expires_at"],
+            select(charged.c.id, literal(1), literal(now), literal(now + timedelta(seconds=ttl)))
+            .where(charged.c.is_vip.is_(False))
+        )
+        .returning(CreditReservation.id, CreditReservation.user_id)
+        .cte("reserved")
+    )
+    stmt = (
+        select(charged.c.id, charged.c.trial_messages_left, charged.c.is_vip, reserved.c.id.label("reservation_id"))
+        .outerjoin(reserved, reserved.c.user_id == charged.c.id)
+    )
+    result = await session.execute(stmt)
+    await session.commit()
+
+    user = result.one_or_none()
+    if user:
+        heartbeats.touch(user.id, now, shard_of(session))
+        await status_cache.invalidate(user.id)
+    return user
+
+
+def _commit_reservation_stmt(reservation_id: int):
+    return delete(CreditReservation).where(CreditReservation.id == reservation_id).returning(CreditReservation.id)
+
+
+async def commit_reservation(session: AsyncSession, reservation_id: int) -> bool:
+    """
+    Подтвердить резерв: кредит остаётся списанным. False, если резерва уже
+    нет (например, его вернул сборщик просроченных).
+    """
+    committed = (await session.execute(_commit_reservation_stmt(reservation_id))).first() is not None
+    await session.commit()
+    return committed
+
+
+def _release_reservation_stmt(reservation_id: int):
+    """Удалить резерв и вернуть его кредиты одним запросом"""
+    released = (
+        delete(CreditReservation)
+        .where(CreditReservation.id == reservation_id)
+        .returning(CreditReservation.user_id, CreditReservation.amount)
+        .cte("released")
+    )
+    # UPDATE ... FROM: без synchronize_session=False ORM забирает RETURNING
+    # себе для синхронизации сессии, и строки до вызывающего не доходят
+    return (
+        update(User)
+        .where(User.id == released.c.user_id)
+        .values(
+            trial_messages_left=User.trial_messages_left + released.c.amount,
+            updated_at=datetime.utcnow()
+        )
+        .returning(User.id, User.trial_messages_left)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def release_reservation(session: AsyncSession, reservation_id: int) -> Optional[int]:
+    """
+    Отменить резерв и вернуть кредит. Возвращает новый остаток или None,
+    если резерва уже нет.
+    """
+    user = (await session.execute(_release_reservation_stmt(reservation_id))).one_or_none()
+    await session.commit()
+    if user is None:
+        return None
+    await status_cache.invalidate(user.id)
+    return user.trial_messages_left
+
+
+async def release_expired_reservations(session: AsyncSession, limit: int = 1000) -> int:
+    """
+    Вернуть кредиты по просроченным резервам (не больше limit за раз).
+    Строки, занятые параллельным подтверждением, пропускаются.
+    Возвращает число пользователей, которым вернулись кредиты.
+    """
+    if unrouted(session):
+        return sum(await session.fan_out(lambda shard_session: release_expired_reservations(shard_session, limit)))
+    expired_ids = (
+        select(CreditReservation.id)
+        .where(CreditReservation.expires_at < datetime.utcnow())
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    expired = (
+        delete(CreditReservation)
+        .where(CreditReservation.id.in_(expired_ids.scalar_subquery()))
+        .returning(CreditReservation.user_id, CreditReservation.amount)
+        .cte("expired")
+    )
+    totals = (
+        select(expired.c.user_id, func.sum(expired.c.amount).label("amount"))
+        .group_by(expired.c.user_id)
+        .subquery("totals")
+    )
+    stmt = (
+        update(User)
+        .where(User.id == totals.c.user_id)
+        .values(
+            trial_messages_left=User.trial_messages_left + totals.c.amount,
+            last_active=User.last_active,
+            updated_at=datetime.utcnow()
+        )
+        .returning(User.id)
+        .execution_options(synchronize_session=False)
+    )
+    user_ids = (await session.execute(stmt)).scalars().all()
+    await session.commit()
+    await status_cache.invalidate_many(user_ids)
+    return len(user_ids)
+
+
+async def save_reply(
+    session: AsyncSession,
+    user_id: int,
+    ai_provider: AIProviderType,
+    ai_model: str,
+    user_message: str,
+    ai_response: str,
+    reservation_id: Optional[int] = None,
+    release: bool = False
+) -> Optional[int]:
+    """
+    Записать ответ в историю и закрыть резерв reservation_id (подтвердить,
+    а при release — вернуть кредит) одной транзакцией. Возвращает новый
+    остаток при возврате, иначе None. Если запущен фоновый history_writer,
+    история ставится в его очередь, а в транзакции остаётся только резерв.
+    """
+    if history_writer.running:
+        await history_writer.put(user_id, ai_provider, ai_model, user_message, ai_response)
+    else:
+        await session.execute(
+            insert(MessageHistory).values(
+                user_id=user_id,
+                ai_provider=ai_provider,
+                ai_model=ai_model,
+                user_message=user_message,
+                ai_response=ai_response,
+                user_tokens=count_tokens(user_message),
+                response_tokens=count_tokens(ai_response),
+                created_at=datetime.utcnow()
+            )
+        )
+
+    remaining = None
+    if reservation_id is not None and release:
+        user = (await session.execute(_release_reservation_stmt(reservation_id))).one_or_none()
+        remaining = user.trial_messages_left if user else None
+    elif reservation_id is not None:
+        if (await session.execute(_commit_reservation_stmt(reservation_id))).first() is None:
+            logger.warning(f"Reservation {reservation_id} of user {user_id} expired before the reply was saved")
+    await session.commit()
+    # Даже без изменения кредитов: чтения истории этого пользователя
+    # на время DB_READ_AFTER_WRITE_WINDOW уходят на primary
+    await status_cache.invalidate(user_id)
+    return remaining
+
+
 # ========== ACTIVE USER CRUD OPERATIONS ==========
 
 async def get_active_user(
@@ -249,9 +474,10 @@ async def get_recently_active_users(
     hours: int = 24,
     limit: int = 100
 ) -> Sequence[ActiveUser]:
-    """Получить список пользователей, активных за последние N часов"""
-    from datetime import datetime, timedelta
-
+    """
+    Получить список пользователей, активных за последние N часов.
+    Учитывает отметки, еще не записанные в базу (heartbeats).
+    """
     cutoff_time = datetime.utcnow() - timedelta(hours=hours)
     stmt = (
         select(ActiveUser)
@@ -259,76 +485,453 @@ async def get_recently_active_users(
         .order_by(desc(ActiveUser.updated_at))
         .limit(limit)
     )
-    result = await session.execute(stmt)
-    return result.scalars().all()
+    async def stored(shard_session):
+        return (await shard_session.execute(stmt)).scalars().all()
+
+    shard_names = session.router.shards if unrouted(session) else [shard_of(session)]
+    shards = await on_every_shard(session, stored)
+    # Keyed by (shard, user_id): ids are only unique within a shard
+    rows = sorted(
+        (
+            ((shard, active_user.user_id), active_user)
+            for shard, found in zip(shard_names, shards)
+            for active_user in found
+        ),
+        key=lambda item: item[1].updated_at,
+        reverse=True
+    )[:limit]
+
+    pending = heartbeats.pending_since(cutoff_time)
+    if not pending:
+        return [active_user for _, active_user in rows]
+
+    # Newer pending touches replace stored rows as detached copies,
+    # so nothing is written back by the session
+    merged = dict(rows)
+    for key, touched_at in pending.items():
+        stored = merged.get(key)
+        if stored is None or stored.updated_at < touched_at:
+            merged[key] = ActiveUser(user_id=key[1], updated_at=touched_at)
+    return sorted(merged.values(), key=lambda active_user: active_user.updated_at, reverse=True)[:limit]
 
 
 # ========== MESSAGE HISTORY CRUD OPERATIONS ==========
 
 async def create_message_history(
     session: AsyncSession,
->>>>>>> recovered-branch
     user_id: int,
     ai_provider: AIProviderType,
     ai_model: str,
     user_message: str,
     ai_response: str
 ) -> MessageHistory:
+    """Сохранить сообщение и ответ вместе с их размером в токенах"""
     db_message = MessageHistory(
         user_id=user_id,
         ai_provider=ai_provider,
         ai_model=ai_model,
         user_message=user_message,
-        ai_response=ai_response
+        ai_response=ai_response,
+        user_tokens=count_tokens(user_message),
+        response_tokens=count_tokens(ai_response)
     )
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    session.add(db_message)
+    await session.commit()
+    await session.refresh(db_message)
     return db_message
 
-def get_user_message_history(
-    db: Session,
+
+def history_window():
+    """
+    Условие на created_at, по которому планировщик отбрасывает старые
+    партиции message_history. Добавляется ко всем чтениям истории.
+    """
+    return MessageHistory.created_at >= datetime.utcnow() - timedelta(days=settings.HISTORY_QUERY_WINDOW_DAYS)
+
+
+async def get_user_message_history(
+    session: AsyncSession,
     user_id: int,
     limit: int = 10
-) -> List[MessageHistory]:
-    return db.query(MessageHistory)\
-        .filter(MessageHistory.user_id == user_id)\
-        .order_by(desc(MessageHistory.created_at))\
-        .limit(limit)\
-        .all()
-
-def get_active_subscription(db: Session, user_id: int) -> Optional[Subscription]:
-    today = date.today()
-    return db.query(Subscription).filter(
-        Subscription.user_id == user_id,
-        Subscription.end_date >= today
-    ).order_by(desc(Subscription.end_date)).first()
+) -> Sequence[MessageHistory]:
+    """Получить последние сообщения пользователя (за HISTORY_QUERY_WINDOW_DAYS)"""
+    stmt = (
+        select(MessageHistory)
+        .where(MessageHistory.user_id == user_id, history_window())
+        .order_by(desc(MessageHistory.created_at))
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return result.scalars().all()
 
-def create_trial_subscription(db: Session, user_id: int, days: int = 7) -> Subscription:
+
+async def get_recent_turns(
+    session: AsyncSession,
+    user_id: int,
+    limit: int,
+    after_id: Optional[int] = None
+) -> Sequence:
+    """
+    Последние limit пар (вопрос, ответ) пользователя, новые первыми;
+    только с id больше after_id, если он задан.
+    Читает только нужные колонки по индексу idx_message_history_user_created
+    и только партиции за HISTORY_QUERY_WINDOW_DAYS.
+    """
+    stmt = (
+        select(
+            MessageHistory.id,
+            MessageHistory.user_message,
+            MessageHistory.ai_response,
+            MessageHistory.user_tokens,
+            MessageHistory.response_tokens
+        )
+        .where(MessageHistory.user_id == user_id, history_window())
+        .order_by(desc(MessageHistory.created_at))
+        .limit(limit)
+    )
+    if after_id is not None:
+        stmt = stmt.where(MessageHistory.id > after_id)
+    result = await session.execute(stmt)
+    return result.all()
+
+
+async def get_unfolded_turns(
+    session: AsyncSession,
+    user_id: int,
+    limit: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None
+) -> Sequence:
+    """
+    Самые старые limit пар пользователя с id больше after_id и меньше
+    before_id (если заданы), по возрастанию id: то, что еще не вошло
+    в сжатую историю. Только партиции за HISTORY_QUERY_WINDOW_DAYS.
+    """
+    stmt = (
+        select(
+            MessageHistory.id,
+            MessageHistory.user_message,
+            MessageHistory.ai_response,
+            MessageHistory.user_tokens,
+            MessageHistory.response_tokens
+        )
+        .where(MessageHistory.user_id == user_id, history_window())
+        .order_by(MessageHistory.id)
+        .limit(limit)
+    )
+    if after_id is not None:
+        stmt = stmt.where(MessageHistory.id > after_id)
+    if before_id is not None:
+        stmt = stmt.where(MessageHistory.id < before_id)
+    result = await session.execute(stmt)
+    return result.all()
+
+
+async def get_history_page(
+    session: AsyncSession,
+    user_id: int,
+    telegram_id: int,
+    limit: int,
+    before: Optional[Tuple[datetime, int]] = None,
+    preview_chars: int = 300
+) -> Sequence:
+    """
+    Страница истории пользователя за HISTORY_QUERY_WINDOW_DAYS, новые
+    первыми: строки строго раньше курсора before = (created_at, id)
+    последней строки предыдущей страницы.
+    Keyset по индексу idx_message_history_user_created, поэтому глубокие
+    страницы стоят столько же, сколько первая. Сравнение кортежей не
+    отсекает партиции, поэтому рядом с ним стоят простые границы по
+    created_at: history_window() снизу и курсор сверху.
+    Тексты обрезаются в SQL до preview_chars + 1 символа: лишний символ
+    означает, что текст длиннее.
+    telegram_id выбирает шард.
+    """
+    await route(session, telegram_id)
+    stmt = (
+        select(
+            MessageHistory.id,
+            MessageHistory.created_at,
+            MessageHistory.ai_provider,
+            MessageHistory.ai_model,
+            func.left(MessageHistory.user_message, preview_chars + 1).label("user_message"),
+            func.left(MessageHistory.ai_response, preview_chars + 1).label("ai_response")
+        )
+        .where(MessageHistory.user_id == user_id, history_window())
+        .order_by(desc(MessageHistory.created_at), desc(MessageHistory.id))
+        .limit(limit)
+    )
+    if before is not None:
+        stmt = stmt.where(
+            MessageHistory.created_at <= before[0],
+            tuple_(MessageHistory.created_at, MessageHistory.id) < tuple_(*before)
+        )
+    result = await session.execute(stmt)
+    return result.all()
+
+
+# ========== CONVERSATION SUMMARY CRUD OPERATIONS ==========
+
+async def get_conversation_summary(
+    session: AsyncSession,
+    user_id: int
+) -> Optional[ConversationSummary]:
+    """Получить сжатую историю диалога пользователя"""
+    stmt = select(ConversationSummary).where(ConversationSummary.user_id == user_id)
+    result = await session.execute(stmt)
+    return result.scalar_one_or_none()
+
+
+async def save_conversation_summary(
+    session: AsyncSession,
+    user_id: int,
+    summary: str,
+    summary_tokens: int,
+    last_message_id: int
+) -> None:
+    """Создать или заменить сжатую историю диалога пользователя"""
+    values = dict(
+        summary=summary,
+        summary_tokens=summary_tokens,
+        last_message_id=last_message_id,
+        updated_at=datetime.utcnow()
+    )
+    stmt = (
+        insert(ConversationSummary)
+        .values(user_id=user_id, **values)
+        .on_conflict_do_update(index_elements=[ConversationSummary.user_id], set_=values)
+    )
+    await session.execute(stmt)
+    await session.commit()
+
+
+# ========== SUBSCRIPTION CRUD OPERATIONS ==========
+
+async def get_active_subscription(session: AsyncSession, user_id: int) -> Optional[Subscription]:
+    """Получить действующую подписку пользователя"""
+    stmt = (
+        select(Subscription)
+        .where(
+            Subscription.user_id == user_id,
+            Subscription.end_date >= date.today()
+        )
+        .order_by(desc(Subscription.end_date))
+        .limit(1)
+    )
+    result = await session.execute(stmt)
+    return result.scalar_one_or_none()
+
+
+async def get_user_status(session: AsyncSession, telegram_id: int) -> Optional[UserStatus]:
+    """
+    Кредиты, VIP и план пользователя из строки users (план и срок хранятся
+    в ней самой, см. grant_subscription), через status_cache.
+    """
+    async def load() -> Optional[UserStatus]:
+        await route(session, telegram_id)
+        stmt = (
+            select(User.id, User.telegram_id, User.trial_messages_left, User.is_vip, User.plan, User.access_until)
+            .where(User.telegram_id == telegram_id)
+        )
+        row = (await session.execute(stmt)).one_or_none()
+        if row is None:
+            return None
+        return UserStatus(
+            user_id=row.id,
+            telegram_id=row.telegram_id,
+            credits=int(row.trial_messages_left or 0),
+            is_vip=bool(row.is_vip),
+            plan=row.plan,
+            plan_end=row.access_until
+        )
+
+    return await status_cache.get_or_load(telegram_id, load)
+
+
+async def grant_subscription(
+    session: AsyncSession,
+    user_id: int,
+    plan: SubscriptionPlanType,
+    days: int
+) -> Optional[Subscription]:
+    """
+    Выдать подписку plan на days дней одной транзакцией: продлить
+    users.access_until (от текущего срока, если он ещё не истёк), обновить
+    users.plan и записать строку в subscriptions. PREMIUM включает VIP.
+    Пробный период не понижает действующий PREMIUM.
+    Возвращает подписку или None, если пользователя нет.
+    """
     today = date.today()
-    end_date = today.replace(day=today.day + days)
-    
-    db_subscription = Subscription(
+    current = case((User.access_until >= today, User.access_until), else_=today)
+    keeps_premium = and_(User.plan == SubscriptionPlanType.PREMIUM, User.access_until >= today)
+    values = {
+        "access_until": current + days,
+        "updated_at": datetime.utcnow()
+    }
+    if plan == SubscriptionPlanType.PREMIUM:
+        values.update(plan=plan, is_vip=True)
+    else:
+        values["plan"] = case((keeps_premium, User.plan), else_=plan)
+    stmt = (
+        update(User)
+        .where(User.id == user_id)
+        .values(**values)
+        .returning(User.access_until)
+    )
+    end_date = (await session.execute(stmt)).scalar_one_or_none()
+    if end_date is None:
+        await session.rollback()
+        return None
+
+    subscription = Subscription(
         user_id=user_id,
-        plan=SubscriptionPlanType.TRIAL,
-        start_date=today,
+        plan=plan,
+        start_date=end_date - timedelta(days=days),
         end_date=end_date
     )
-    db.add(db_subscription)
-    db.commit()
-    db.refresh(db_subscription)
-    return db_subscription
+    session.add(subscription)
+    await session.commit()
+    await status_cache.invalidate(user_id)
+    await session.refresh(subscription)
+    return subscription
+
+
+async def create_trial_subscription(session: AsyncSession, user_id: int, days: int = 7) -> Optional[Subscription]:
+    """Создать пробную подписку на days дней"""
+    return await grant_subscription(session, user_id, SubscriptionPlanType.TRIAL, days)
 
-def create_payment(
-    db: Session,
+
+async def expire_subscriptions(session: AsyncSession, limit: int = 1000) -> int:
+    """
+    Снять истёкшие подписки (не больше limit пользователей за раз) одним
+    запросом: сбросить plan и access_until, а VIP, выданный PREMIUM, снять.
+    Возвращает число пользователей.
+    """
+    if unrouted(session):
+        return sum(await session.fan_out(lambda shard_session: expire_subscriptions(shard_session, limit)))
+    today = date.today()
+    lapsed_ids = (
+        select(User.id)
+        .where(User.access_until < today)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(User)
+        .where(User.id.in_(lapsed_ids.scalar_subquery()))
+        .values(
+            is_vip=case((User.plan == SubscriptionPlanType.PREMIUM, False), else_=User.is_vip),
+            plan=None,
+            access_until=None,
+            # Сборщик не должен выглядеть как активность пользователя
+            last_active=User.last_active,
+            updated_at=datetime.utcnow()
+        )
+        .returning(User.id)
+    )
+    user_ids = (await session.execute(stmt)).scalars().all()
+    await session.commit()
+    await status_cache.invalidate_many(user_ids)
+    return len(user_ids)
+
+
+# ========== CREDIT CAMPAIGN OPERATIONS ==========
+#
+# Кампания начисляет amount кредитов каждому пользователю не больше одного
+# раза: кому уже начислено, записано в credit_grants, и повторный запуск
+# (после сбоя или с пересекающимся списком) этих пользователей пропускает.
+
+_GRANT_CAMPAIGN_CREDITS = """
+    WITH targets AS (
+        SELECT DISTINCT users.id
+        FROM unnest(CAST(:keys AS BIGINT[])) AS t(key)
+        JOIN users ON users.{key} = t.key
+    ),
+    granted AS (
+        INSERT INTO credit_grants (campaign_id, user_id, created_at)
+        SELECT :campaign_id, targets.id, now() FROM targets
+        ON CONFLICT (campaign_id, user_id) DO NOTHING
+        RETURNING user_id
+    )
+    UPDATE users SET trial_messages_left = users.trial_messages_left + :amount, updated_at = now()
+    FROM granted
+    WHERE users.id = granted.user_id
+    RETURNING users.id
+"""
+
+GRANT_BY_TELEGRAM_ID = text(_GRANT_CAMPAIGN_CREDITS.format(key="telegram_id"))
+GRANT_BY_USER_ID = text(_GRANT_CAMPAIGN_CREDITS.format(key="id"))
+
+
+async def get_or_create_campaign(session: AsyncSession, campaign_id: str, amount: int) -> CreditCampaign:
+    """
+    Найти кампанию или создать её с суммой amount. ValueError, если кампания
+    уже есть с другой суммой. Кампания заводится на каждом шарде.
+    """
+    if unrouted(session):
+        return (await session.fan_out(lambda shard_session: get_or_create_campaign(shard_session, campaign_id, amount)))[0]
+    await session.execute(
+        insert(CreditCampaign)
+        .values(id=campaign_id, amount=amount, created_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=[CreditCampaign.id])
+    )
+    campaign = (await session.execute(select(CreditCampaign).where(CreditCampaign.id == campaign_id))).scalar_one()
+    await session.commit()
+    if campaign.amount != amount:
+        raise ValueError(f"Campaign {campaign_id} grants {campaign.amount} credits, not {amount}")
+    return campaign
+
+
+async def grant_campaign_credits(
+    session: AsyncSession,
+    campaign_id: str,
+    amount: int,
+    keys: Sequence[int],
+    by_telegram_id: bool = True
+) -> List[int]:
+    """
+    Начислить amount кредитов пользователям из keys (telegram_id или id)
+    одним запросом и зафиксировать начисление в credit_grants. Пропускает
+    неизвестных пользователей и тех, кому кампания уже начисляла.
+    Возвращает id пользователей, получивших кредиты. На шардах запрос
+    выполняется на каждом: каждый шард начисляет только своим пользователям.
+    """
+    if unrouted(session):
+        granted = await session.fan_out(
+            lambda shard_session: grant_campaign_credits(shard_session, campaign_id, amount, keys, by_telegram_id)
+        )
+        return [user_id for user_ids in granted for user_id in user_ids]
+    stmt = GRANT_BY_TELEGRAM_ID if by_telegram_id else GRANT_BY_USER_ID
+    result = await session.execute(stmt, {"keys": list(keys), "campaign_id": campaign_id, "amount": amount})
+    user_ids = result.scalars().all()
+    await session.commit()
+    await status_cache.invalidate_many(user_ids)
+    return user_ids
+
+
+async def count_campaign_grants(session: AsyncSession, campaign_id: str) -> int:
+    """Сколько пользователей уже получили кредиты кампании"""
+    if unrouted(session):
+        return sum(await session.fan_out(lambda shard_session: count_campaign_grants(shard_session, campaign_id)))
+    stmt = select(func.count()).select_from(CreditGrant).where(CreditGrant.campaign_id == campaign_id)
+    return (await session.execute(stmt)).scalar_one()
+
+
+# ========== PAYMENT CRUD OPERATIONS ==========
+
+async def create_payment(
+    session: AsyncSession,
     user_id: int,
+    telegram_id: int,
     amount: float,
-    currency: str,
+    currency: CurrencyType,
     payment_date: date,
     success: bool,
     telegram_payment_id: Optional[str] = None
 ) -> Payment:
-    db_payment = Payment(
+    """Создать запись о платеже (telegram_id выбирает шард)"""
+    await route(session, telegram_id)
+    payment = Payment(
         user_id=user_id,
         amount=amount,
         currency=currency,
@@ -336,7 +939,7 @@ def create_payment(
         success=success,
         telegram_payment_id=telegram_payment_id
     )
-    db.add(db_payment)
-    db.commit()
-    db.refresh(db_payment)
-    return db_payment
\ No newline at end of file
+    session.add(payment)
+    await session.commit()
+    await session.refresh(payment)
+    return payment
@@ -0,0 +1,184 @@
+"""
+Write-behind buffer for user activity heartbeats.
+
+Touching active_users.updated_at / users.last_active on every request is a
+hot write stream for a value only needed to within a minute. touch() just
+records the newest time per user in memory; a background task writes all
+pending touches every ACTIVITY_FLUSH_INTERVAL seconds as one bulk upsert
+over arrays, and once more on shutdown. Readers merge pending touches in
+(see crud.get_recently_active_users), so they are never more than one
+flush interval behind.
+
+The same flush counts daily active users: every day a user touched goes to
+active_user_days, and the first touch of a day adds one to
+active_users_daily (see rollups.COUNT_ACTIVE_DAYS). Counting the days as
+they are touched, rather than from active_users later, is exact even though
+active_users only keeps each user's latest touch.
+
+Under DB_SHARDS user ids are only unique within a shard (unless the id
+sequences were set up with scripts/reshard.py prepare), so every touch is
+tagged with the shard its session was routed to, and each shard is written
+only its own users.
+"""
+
+import asyncio
+import time
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import text
+
+from backend.config import settings
+from backend.database.periodic import PeriodicTask
+from backend.database.rollups import COUNT_ACTIVE_DAYS
+from backend.database.sharding import unrouted
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rows whose user was deleted meanwhile are skipped by the join
+UPSERT_ACTIVE_USERS = text("""
+    INSERT INTO active_users (user_id, updated_at)
+    SELECT v.user_id, v.updated_at
+    FROM unnest(CAST(:user_ids AS BIGINT[]), CAST(:touched_at AS TIMESTAMP[])) AS v(user_id, updated_at)
+    JOIN users ON users.id = v.user_id
+    ON CONFLICT (user_id) DO UPDATE
+    SET updated_at = GREATEST(active_users.updated_at, EXCLUDED.updated_at)
+""")
+
+UPDATE_LAST_ACTIVE = text("""
+    UPDATE users SET last_active = v.touched_at
+    FROM unnest(CAST(:user_ids AS BIGINT[]), CAST(:touched_at AS TIMESTAMP[])) AS v(user_id, touched_at)
+    WHERE users.id = v.user_id
+      AND (users.last_active IS NULL OR users.last_active < v.touched_at)
+""")
+
+
+class HeartbeatBuffer(PeriodicTask):
+    run_at_start = False
+
+    def __init__(self, flush_interval: float = 10.0, max_pending: int = 10000):
+        super().__init__(flush_interval)
+        self.max_pending = max_pending
+        # Keyed by (shard, user_id); the shard is None without DB_SHARDS
+        self._pending: Dict[Tuple[Optional[str], int], datetime] = {}
+        # Every (shard, user_id, day) touched, not just the newest touch
+        self._days: Set[Tuple[Optional[str], int, date]] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self.touches = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.last_flush_seconds = 0.0
+
+    def touch(self, user_id: int, at: Optional[datetime] = None, shard: Optional[str] = None) -> None:
+        """Record activity on shard; repeated touches of a user collapse into the newest one"""
+        at = at or datetime.utcnow()
+        self._merge((shard, user_id), at)
+        self._days.add((shard, user_id, at.date()))
+        self.touches += 1
+        if len(self._pending) >= self.max_pending and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _merge(self, key: Tuple[Optional[str], int], at: datetime) -> None:
+        previous = self._pending.get(key)
+        if previous is None or previous < at:
+            self._pending[key] = at
+
+    def pending_since(self, cutoff: datetime) -> Dict[Tuple[Optional[str], int], datetime]:
+        """Touches not yet written that are newer than cutoff, by (shard, user_id)"""
+        return {key: at for key, at in self._pending.items() if at >= cutoff}
+
+    async def _write(self, session, touches: List[Tuple[int, datetime]], days: List[Tuple[int, date]]) -> None:
+        params = {"user_ids": [user_id for user_id, _ in touches], "touched_at": [at for _, at in touches]}
+        await session.execute(UPSERT_ACTIVE_USERS, params)
+        await session.execute(UPDATE_LAST_ACTIVE, params)
+        # Days already counted (e.g. a retried batch) are skipped
+        await session.execute(
+            COUNT_ACTIVE_DAYS,
+            {"user_ids": [user_id for user_id, _ in days], "days": [day for _, day in days]}
+        )
+        await session.commit()
+
+    async def flush(self, session) -> int:
+        """Write all pending touches in one transaction; on failure they are kept for the next flush"""
+        if not self._pending:
+            return 0
+
+        batch, self._pending = self._pending, {}
+        days, self._days = self._days, set()
+        started = time.perf_counter()
+        try:
+            if unrouted(session):
+                # A retry after a partly failed flush rewrites shards already
+                # written, which the upserts and the day count tolerate
+                for shard in sorted({shard for shard, _ in batch if shard is not None}):
+                    async with session.router.sessionmaker_for(shard)() as shard_session:
+                        await self._write(
+                            shard_session,
+                            [(user_id, at) for (s, user_id), at in batch.items() if s == shard],
+                            [(user_id, day) for s, user_id, day in days if s == shard]
+                        )
+                untagged = sum(1 for shard, _ in batch if shard is None)
+                if untagged:
+                    logger.warning(f"Dropped {untagged} heartbeats not tied to a shard")
+            else:
+                await self._write(
+                    session,
+                    [(user_id, at) for (_, user_id), at in batch.items()],
+                    [(user_id, day) for _, user_id, day in days]
+                )
+        except BaseException:
+            # Also on cancellation at shutdown, so stop() can still write them
+            for key, at in batch.items():
+                self._merge(key, at)
+            self._days |= days
+            self.failures += 1
+            await session.rollback()
+            raise
+        self.last_flush_seconds = time.perf_counter() - started
+        self.flushes += 1
+        self.flushed_rows += len(batch)
+        return len(batch)
+
+    async def run_once(self) -> None:
+        async with self._session_factory() as session:
+            await self.flush(session)
+
+    async def _wait(self) -> None:
+        """Until the next interval, or sooner once max_pending users are waiting"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    def _failed(self, error: Exception) -> None:
+        # flush() has counted the failure already
+        logger.error(f"Heartbeat flush failed, {len(self._pending)} users kept for retry: {error}")
+
+    def start(self, session_factory: Callable) -> None:
+        """Flush periodically with sessions from session_factory"""
+        self._wakeup = asyncio.Event()
+        super().start(session_factory)
+
+    async def stop(self) -> None:
+        """Stop the periodic flush and write what is still pending"""
+        await super().stop()
+        if self._session_factory is not None and self._pending:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Final heartbeat flush failed, {len(self._pending)} users lost: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "touches": self.touches,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "failures": self.failures,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+
+heartbeats = HeartbeatBuffer(settings.ACTIVITY_FLUSH_INTERVAL, settings.ACTIVITY_MAX_PENDING)
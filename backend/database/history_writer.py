@@ -0,0 +1,248 @@
+"""
+Asynchronous batched writer for message_history.
+
+Replies are queued in memory (bounded by HISTORY_QUEUE_SIZE) and written
+by a background task in batches of up to HISTORY_BATCH_SIZE rows, or
+whatever is queued once the oldest row has waited HISTORY_MAX_DELAY
+seconds, using the asyncpg COPY protocol. When the queue is full, callers
+wait up to HISTORY_PUT_TIMEOUT for room (backpressure); rows that still
+do not fit, batches that fail to write and whatever is left at shutdown
+are appended to a spool file (HISTORY_SPOOL_PATH) and replayed once the
+database accepts writes again.
+
+Rows not yet written are visible through pending_turns(), so the next
+prompt of a fast follow-up still sees the previous turn.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+from backend.config import settings
+from backend.database.periodic import cancel_task
+from backend.models.enums import AIProviderType
+from backend.utils.tokens import count_tokens
+import logging
+
+logger = logging.getLogger(__name__)
+
+HISTORY_COLUMNS = [
+    "user_id", "ai_provider", "ai_model", "user_message", "ai_response",
+    "user_tokens", "response_tokens", "created_at",
+]
+
+
+async def copy_history_rows(engine, rows: List[tuple]) -> None:
+    """Write rows (in HISTORY_COLUMNS order) with COPY on a pooled asyncpg connection"""
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            "message_history", records=rows, columns=HISTORY_COLUMNS
+        )
+
+
+class HistoryWriter:
+    def __init__(
+        self,
+        max_queue: int = 10000,
+        batch_size: int = 500,
+        max_delay: float = 1.0,
+        put_timeout: float = 2.0,
+        spool_path: str = "history_spool.jsonl"
+    ):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.put_timeout = put_timeout
+        self.spool_path = spool_path
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._pending: Dict[int, Deque[tuple]] = defaultdict(deque)
+        # Rows taken off the queue for the next batch, not yet handed to _write
+        self._batch: List[tuple] = []
+        self._copy_rows: Optional[Callable[[List[tuple]], Awaitable[None]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.spooled = 0
+        self.backpressure_waits = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def put(
+        self,
+        user_id: int,
+        ai_provider: AIProviderType,
+        ai_model: str,
+        user_message: str,
+        ai_response: str
+    ) -> None:
+        """Queue one reply; waits for room while the queue is full, then spools"""
+        row = (
+            user_id,
+            AIProviderType(ai_provider).value,
+            ai_model,
+            user_message,
+            ai_response,
+            count_tokens(user_message),
+            count_tokens(ai_response),
+            datetime.utcnow(),
+        )
+        if self._queue.full():
+            self.backpressure_waits += 1
+        try:
+            await asyncio.wait_for(self._queue.put(row), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("History queue full, spooling reply of user %s", user_id)
+            self._spool([row])
+            return
+        self._pending[user_id].append(row)
+        self.enqueued += 1
+
+    def pending_turns(self, user_id: int) -> List[tuple]:
+        """Queued rows of user_id not yet written, newest first"""
+        return list(reversed(self._pending.get(user_id, ())))
+
+    def _forget(self, rows: List[tuple]) -> None:
+        for row in rows:
+            queued = self._pending.get(row[0])
+            if queued:
+                queued.popleft()
+                if not queued:
+                    del self._pending[row[0]]
+
+    async def _next_batch(self) -> None:
+        """
+        Wait for a row, then collect more into self._batch until it is full or
+        max_delay has passed; stop() writes what was collected if cancelled meanwhile
+        """
+        self._batch.append(await self._queue.get())
+        deadline = time.monotonic() + self.max_delay
+        while len(self._batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+    async def _write(self, batch: List[tuple]) -> bool:
+        """COPY one batch; on failure it goes to the spool file. Returns whether the DB took it"""
+        started = time.perf_counter()
+        try:
+            await self._copy_rows(batch)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"History write of {len(batch)} rows failed, spooling: {e}")
+            self._spool(batch)
+            return False
+        except BaseException:
+            # Cancelled mid-COPY (shutdown): the rows may or may not be in the
+            # database; a replayed duplicate is better than a lost reply
+            self._spool(batch)
+            raise
+        finally:
+            self._forget(batch)
+        self.last_flush_seconds = time.perf_counter() - started
+        self.max_flush_seconds = max(self.max_flush_seconds, self.last_flush_seconds)
+        self.written += len(batch)
+        self.batches += 1
+        return True
+
+    async def _run(self) -> None:
+        await self._replay_spool()
+        while True:
+            await self._next_batch()
+            batch, self._batch = self._batch, []
+            if await self._write(batch) and self.spooled:
+                await self._replay_spool()
+
+    def _spool(self, rows: List[tuple]) -> None:
+        self._write_spool(self.spool_path, rows, "a")
+        self.spooled += len(rows)
+
+    @staticmethod
+    def _write_spool(path: str, rows: List[tuple], mode: str) -> None:
+        with open(path, mode, encoding="utf-8") as spool:
+            for row in rows:
+                spool.write(json.dumps(list(row[:-1]) + [row[-1].isoformat()], ensure_ascii=False) + "\n")
+            spool.flush()
+            os.fsync(spool.fileno())
+
+    async def _replay_spool(self) -> None:
+        """Write spooled rows back; a half-done replay is retried from its own file first"""
+        replay_path = self.spool_path + ".replay"
+        while True:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spool_path):
+                    self.spooled = 0
+                    return
+                os.replace(self.spool_path, replay_path)
+
+            with open(replay_path, encoding="utf-8") as spool:
+                rows = []
+                for line in spool:
+                    if line.strip():
+                        *values, created_at = json.loads(line)
+                        rows.append(tuple(values) + (datetime.fromisoformat(created_at),))
+            for start in range(0, len(rows), self.batch_size):
+                try:
+                    await self._copy_rows(rows[start:start + self.batch_size])
+                except Exception as e:
+                    logger.error(f"History spool replay failed, will retry: {e}")
+                    # Keep only what was not written, so the retry does not duplicate rows
+                    self._write_spool(replay_path, rows[start:], "w")
+                    return
+                except BaseException:
+                    self._write_spool(replay_path, rows[start:], "w")
+                    raise
+                self.written += len(rows[start:start + self.batch_size])
+            os.remove(replay_path)
+            logger.info(f"Replayed {len(rows)} spooled history rows")
+
+    def start(self, copy_rows: Callable[[List[tuple]], Awaitable[None]]) -> None:
+        """Write batches in the background with copy_rows (see copy_history_rows)"""
+        self._copy_rows = copy_rows
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background task and write what is collected or queued; spool it if that fails"""
+        await cancel_task(self._task)
+        self._task = None
+
+        rows, self._batch = self._batch, []
+        while not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        for start in range(0, len(rows), self.batch_size):
+            await self._write(rows[start:start + self.batch_size])
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "batches": self.batches,
+            "failures": self.failures,
+            "spooled": self.spooled,
+            "backpressure_waits": self.backpressure_waits,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+        }
+
+
+history_writer = HistoryWriter(
+    max_queue=settings.HISTORY_QUEUE_SIZE,
+    batch_size=settings.HISTORY_BATCH_SIZE,
+    max_delay=settings.HISTORY_MAX_DELAY,
+    put_timeout=settings.HISTORY_PUT_TIMEOUT,
+    spool_path=settings.HISTORY_SPOOL_PATH,
+)
@@ -7,6 +7,8 @@ CREATE TABLE users (
     telegram_id BIGINT UNIQUE NOT NULL,
     trial_messages_left INTEGER DEFAULT 10,
     is_vip BOOLEAN DEFAULT FALSE,
+    plan subscription_plan_type,
+    access_until DATE,
     last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -17,16 +19,89 @@ CREATE TABLE active_users (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Monthly partitions (message_history_pYYYYMM) are created by the backend
 CREATE TABLE message_history (
-    id BIGSERIAL PRIMARY KEY,
+    id BIGSERIAL,
     user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
     ai_provider ai_provider_type NOT NULL,
     ai_model VARCHAR(100) NOT NULL,
     user_message TEXT,
     ai_response TEXT,
+    user_tokens INTEGER,
+    response_tokens INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE conversation_summaries (
+    user_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    summary TEXT NOT NULL,
+    summary_tokens INTEGER NOT NULL DEFAULT 0,
+    last_message_id BIGINT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE credit_reservations (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    amount INTEGER NOT NULL DEFAULT 1,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE credit_campaigns (
+    id VARCHAR(64) PRIMARY KEY,
+    amount INTEGER NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE TABLE credit_grants (
+    campaign_id VARCHAR(64) REFERENCES credit_campaigns(id) ON DELETE CASCADE,
+    user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (campaign_id, user_id)
+);
+
+-- Analytics rollups, maintained by backend.database.rollups
+CREATE TABLE usage_daily (
+    day DATE NOT NULL,
+    ai_provider ai_provider_type NOT NULL,
+    ai_model VARCHAR(100) NOT NULL,
+    plan VARCHAR(16) NOT NULL,
+    messages BIGINT NOT NULL DEFAULT 0,
+    user_tokens BIGINT NOT NULL DEFAULT 0,
+    response_tokens BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, ai_provider, ai_model, plan)
+);
+
+CREATE TABLE active_user_days (
+    day DATE NOT NULL,
+    user_id BIGINT NOT NULL,
+    plan VARCHAR(16) NOT NULL,
+    PRIMARY KEY (day, user_id)
+);
+
+CREATE TABLE active_users_daily (
+    day DATE NOT NULL,
+    plan VARCHAR(16) NOT NULL,
+    users INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, plan)
+);
+
+CREATE TABLE revenue_daily (
+    day DATE NOT NULL,
+    currency currency_code NOT NULL,
+    payments INTEGER NOT NULL DEFAULT 0,
+    amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, currency)
+);
+
+CREATE TABLE rollup_watermarks (
+    name VARCHAR(32) PRIMARY KEY,
+    position TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE subscriptions (
     id BIGSERIAL PRIMARY KEY,
     user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
@@ -49,12 +124,15 @@ CREATE TABLE payments (
 );
 
 CREATE INDEX idx_users_telegram_id ON users(telegram_id);
-CREATE INDEX idx_message_history_user_id ON message_history(user_id);
-CREATE INDEX idx_message_history_created_at ON message_history(created_at);
+CREATE INDEX idx_users_access_until ON users(access_until) WHERE access_until IS NOT NULL;
+CREATE INDEX idx_message_history_user_created ON message_history(user_id, created_at);
+CREATE INDEX idx_credit_reservations_user_id ON credit_reservations(user_id);
+CREATE INDEX idx_credit_reservations_expires_at ON credit_reservations(expires_at);
 CREATE INDEX idx_subscriptions_user_id ON subscriptions(user_id);
 CREATE INDEX idx_subscriptions_end_date ON subscriptions(end_date);
 CREATE INDEX idx_payments_user_id ON payments(user_id);
 CREATE INDEX idx_payments_telegram_payment_id ON payments(telegram_payment_id);
+CREATE INDEX idx_payments_payment_date ON payments(payment_date);
 
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
@@ -0,0 +1,34 @@
+"""Message history token counts
+Revision ID: 2024_02_01_000000_message_history_token_counts
+Revises: 2024_01_01_000000_initial_migration
+Create Date: 2024-02-01 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic
+revision = '2024_02_01_000000_message_history_token_counts'
+down_revision = '2024_01_01_000000_initial_migration'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Оценка размера в токенах, считается один раз при записи
+    op.add_column('message_history',
+                  sa.Column('user_tokens', sa.Integer(), nullable=True))
+    op.add_column('message_history',
+                  sa.Column('response_tokens', sa.Integer(), nullable=True))
+
+    # Индекс для выборки последних сообщений пользователя (есть в моделях,
+    # но не создавался начальной миграцией)
+    op.execute(
+        'CREATE INDEX IF NOT EXISTS idx_message_history_user_created '
+        'ON message_history (user_id, created_at)'
+    )
+
+
+def downgrade() -> None:
+    op.execute('DROP INDEX IF EXISTS idx_message_history_user_created')
+    op.drop_column('message_history', 'response_tokens')
+    op.drop_column('message_history', 'user_tokens')
@@ -0,0 +1,33 @@
+"""Conversation summaries
+Revision ID: 2024_03_01_000000_conversation_summaries
+Revises: 2024_02_01_000000_message_history_token_counts
+Create Date: 2024-03-01 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic
+revision = '2024_03_01_000000_conversation_summaries'
+down_revision = '2024_02_01_000000_message_history_token_counts'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Сжатая история диалога, одна строка на пользователя
+    op.create_table('conversation_summaries',
+                    sa.Column('user_id', sa.BigInteger(), nullable=False),
+                    sa.Column('summary', sa.Text(), nullable=False),
+                    sa.Column('summary_tokens', sa.Integer(),
+                              server_default='0', nullable=False),
+                    sa.Column('last_message_id', sa.BigInteger(), nullable=False),
+                    sa.Column('updated_at', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('now()'), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ['user_id'], ['users.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('user_id')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('conversation_summaries')
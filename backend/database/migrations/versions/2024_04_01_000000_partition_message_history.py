@@ -0,0 +1,101 @@
+"""Monthly partitioning of message_history
+Revision ID: 2024_04_01_000000_partition_message_history
+Revises: 2024_03_01_000000_conversation_summaries
+Create Date: 2024-04-01 00:00:00.000000
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+
+# revision identifiers, used by Alembic
+revision = '2024_04_01_000000_partition_message_history'
+down_revision = '2024_03_01_000000_conversation_summaries'
+branch_labels = None
+depends_on = None
+
+# Сколько месяцев вперёд создать партиции сразу; дальше их создаёт
+# backend.database.partitions.PartitionMaintainer
+MONTHS_AHEAD = 3
+
+COLUMNS = ('id, user_id, ai_provider, ai_model, user_message, ai_response, '
+           'created_at, user_tokens, response_tokens')
+
+
+def month_start(months: int) -> datetime:
+    now = datetime.now(timezone.utc)
+    index = now.year * 12 + now.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def upgrade() -> None:
+    # Старая таблица становится партицией message_history_legacy, данные не
+    # копируются. Она покрывает всё до начала следующего месяца, дальше —
+    # помесячные партиции message_history_pYYYYMM
+    boundary = month_start(1).isoformat()
+
+    op.execute('ALTER TABLE message_history RENAME TO message_history_legacy')
+    op.execute('ALTER TABLE message_history_legacy '
+               'RENAME CONSTRAINT message_history_pkey TO message_history_legacy_pkey')
+    op.execute('ALTER INDEX IF EXISTS idx_message_history_user_created '
+               'RENAME TO idx_message_history_legacy_user_created')
+    op.execute('ALTER TABLE message_history_legacy ALTER COLUMN id DROP DEFAULT')
+
+    # Первичный ключ партиционированной таблицы обязан включать created_at
+    op.execute("""
+        CREATE TABLE message_history (
+            id BIGINT NOT NULL DEFAULT nextval('message_history_id_seq'),
+            user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            ai_provider ai_provider_type NOT NULL,
+            ai_model VARCHAR(100) NOT NULL,
+            user_message TEXT,
+            ai_response TEXT,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            user_tokens INTEGER,
+            response_tokens INTEGER,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute('ALTER SEQUENCE message_history_id_seq OWNED BY message_history.id')
+    # Индекс на родителе создаётся в каждой партиции, в том числе будущих
+    op.execute('CREATE INDEX idx_message_history_user_created '
+               'ON message_history (user_id, created_at)')
+
+    # CHECK заранее, чтобы ATTACH не сканировал таблицу под эксклюзивной блокировкой
+    op.execute(f"ALTER TABLE message_history_legacy ADD CONSTRAINT message_history_legacy_range "
+               f"CHECK (created_at < '{boundary}') NOT VALID")
+    op.execute('ALTER TABLE message_history_legacy VALIDATE CONSTRAINT message_history_legacy_range')
+    # У партиции не может быть своего первичного ключа (id): меняем его на
+    # (id, created_at), как у родителя, и ATTACH берёт этот ключ себе
+    op.execute('CREATE UNIQUE INDEX message_history_legacy_id_created_at '
+               'ON message_history_legacy (id, created_at)')
+    op.execute('ALTER TABLE message_history_legacy DROP CONSTRAINT message_history_legacy_pkey')
+    op.execute('ALTER TABLE message_history_legacy ADD CONSTRAINT message_history_legacy_pkey '
+               'PRIMARY KEY USING INDEX message_history_legacy_id_created_at')
+    op.execute(f"ALTER TABLE message_history ATTACH PARTITION message_history_legacy "
+               f"FOR VALUES FROM (MINVALUE) TO ('{boundary}')")
+
+    for months in range(1, MONTHS_AHEAD + 1):
+        start, end = month_start(months), month_start(months + 1)
+        op.execute(f"CREATE TABLE message_history_p{start:%Y%m} PARTITION OF message_history "
+                   f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+
+
+def downgrade() -> None:
+    # Строки из помесячных партиций переносятся обратно в одну таблицу
+    op.execute('ALTER TABLE message_history DETACH PARTITION message_history_legacy')
+    op.execute('ALTER TABLE message_history_legacy DROP CONSTRAINT message_history_legacy_range')
+    # Снова первичный ключ только по id
+    op.execute('ALTER TABLE message_history_legacy DROP CONSTRAINT message_history_legacy_pkey')
+    op.execute('ALTER TABLE message_history_legacy ADD CONSTRAINT message_history_legacy_pkey PRIMARY KEY (id)')
+    op.execute(f'INSERT INTO message_history_legacy ({COLUMNS}) '
+               f'SELECT {COLUMNS} FROM message_history')
+    op.execute('ALTER SEQUENCE message_history_id_seq OWNED BY message_history_legacy.id')
+    op.execute('DROP TABLE message_history')
+
+    op.execute("ALTER TABLE message_history_legacy "
+               "ALTER COLUMN id SET DEFAULT nextval('message_history_id_seq')")
+    op.execute('ALTER INDEX IF EXISTS idx_message_history_legacy_user_created '
+               'RENAME TO idx_message_history_user_created')
+    op.execute('ALTER TABLE message_history_legacy '
+               'RENAME CONSTRAINT message_history_legacy_pkey TO message_history_pkey')
+    op.execute('ALTER TABLE message_history_legacy RENAME TO message_history')
@@ -0,0 +1,51 @@
+"""Credit reservations
+Revision ID: 2024_05_01_000000_credit_reservations
+Revises: 2024_04_01_000000_partition_message_history
+Create Date: 2024-05-01 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic
+revision = '2024_05_01_000000_credit_reservations'
+down_revision = '2024_04_01_000000_partition_message_history'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Кредиты, списанные на время запроса к AI; строка удаляется при
+    # подтверждении, а при отмене или по истечении срока кредит возвращается
+    op.create_table('credit_reservations',
+                    sa.Column('id', sa.BigInteger(),
+                              nullable=False, autoincrement=True),
+                    sa.Column('user_id', sa.BigInteger(), nullable=False),
+                    sa.Column('amount', sa.Integer(),
+                              server_default='1', nullable=False),
+                    sa.Column('created_at', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('now()'), nullable=False),
+                    sa.Column('expires_at', sa.TIMESTAMP(
+                        timezone=True), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ['user_id'], ['users.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('idx_credit_reservations_user_id',
+                    'credit_reservations', ['user_id'], unique=False)
+    # Для сборщика просроченных резервов
+    op.create_index('idx_credit_reservations_expires_at',
+                    'credit_reservations', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    # Незавершённые резервы возвращаются пользователям
+    op.execute("""
+        UPDATE users SET trial_messages_left = users.trial_messages_left + r.amount
+        FROM (SELECT user_id, SUM(amount) AS amount FROM credit_reservations GROUP BY user_id) AS r
+        WHERE users.id = r.user_id
+    """)
+    op.drop_index('idx_credit_reservations_expires_at',
+                  table_name='credit_reservations')
+    op.drop_index('idx_credit_reservations_user_id',
+                  table_name='credit_reservations')
+    op.drop_table('credit_reservations')
@@ -0,0 +1,44 @@
+"""Denormalized plan and access_until on users
+Revision ID: 2024_06_01_000000_users_access_until
+Revises: 2024_05_01_000000_credit_reservations
+Create Date: 2024-06-01 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic
+revision = '2024_06_01_000000_users_access_until'
+down_revision = '2024_05_01_000000_credit_reservations'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # План и дата окончания последней подписки прямо в users: проверка
+    # доступа читает только строку пользователя
+    op.add_column('users', sa.Column('plan', postgresql.ENUM('trial', 'premium',
+                                                              name='subscription_plan_type', create_type=False),
+                                     nullable=True))
+    op.add_column('users', sa.Column('access_until', sa.Date(), nullable=True))
+    # Для сборщика истёкших подписок
+    op.create_index('idx_users_access_until', 'users', ['access_until'], unique=False,
+                    postgresql_where=sa.text('access_until IS NOT NULL'))
+
+    # Заполняем из самой поздней действующей подписки
+    op.execute("""
+        UPDATE users SET plan = s.plan, access_until = s.end_date
+        FROM (
+            SELECT DISTINCT ON (user_id) user_id, plan, end_date
+            FROM subscriptions
+            WHERE end_date >= CURRENT_DATE
+            ORDER BY user_id, end_date DESC
+        ) AS s
+        WHERE users.id = s.user_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_users_access_until', table_name='users')
+    op.drop_column('users', 'access_until')
+    op.drop_column('users', 'plan')
@@ -0,0 +1,41 @@
+"""Credit campaigns
+Revision ID: 2024_07_01_000000_credit_campaigns
+Revises: 2024_06_01_000000_users_access_until
+Create Date: 2024-07-01 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic
+revision = '2024_07_01_000000_credit_campaigns'
+down_revision = '2024_06_01_000000_users_access_until'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Массовые начисления кредитов; сумма фиксируется при первом запуске
+    op.create_table('credit_campaigns',
+                    sa.Column('id', sa.String(length=64), nullable=False),
+                    sa.Column('amount', sa.Integer(), nullable=False),
+                    sa.Column('created_at', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('now()'), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    # Кому кампания уже начислила: повторный запуск этих пользователей пропускает
+    op.create_table('credit_grants',
+                    sa.Column('campaign_id', sa.String(length=64), nullable=False),
+                    sa.Column('user_id', sa.BigInteger(), nullable=False),
+                    sa.Column('created_at', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('now()'), nullable=True),
+                    sa.ForeignKeyConstraint(
+                        ['campaign_id'], ['credit_campaigns.id'], ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(
+                        ['user_id'], ['users.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('campaign_id', 'user_id')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('credit_grants')
+    op.drop_table('credit_campaigns')
@@ -0,0 +1,69 @@
+"""Usage rollups
+Revision ID: 2024_08_01_000000_usage_rollups
+Revises: 2024_07_01_000000_credit_campaigns
+Create Date: 2024-08-01 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic
+revision = '2024_08_01_000000_usage_rollups'
+down_revision = '2024_07_01_000000_credit_campaigns'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Сообщения и токены по дням, провайдерам, моделям и планам
+    op.create_table('usage_daily',
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('ai_provider', postgresql.ENUM('chatgpt', 'perplexity', 'deepseek',
+                                                             name='ai_provider_type', create_type=False),
+                              nullable=False),
+                    sa.Column('ai_model', sa.String(length=100), nullable=False),
+                    sa.Column('plan', sa.String(length=16), nullable=False),
+                    sa.Column('messages', sa.BigInteger(), server_default='0', nullable=False),
+                    sa.Column('user_tokens', sa.BigInteger(), server_default='0', nullable=False),
+                    sa.Column('response_tokens', sa.BigInteger(), server_default='0', nullable=False),
+                    sa.PrimaryKeyConstraint('day', 'ai_provider', 'ai_model', 'plan')
+                    )
+    # Кто уже учтён в DAU за день (пишется при сбросе heartbeats):
+    # повторная активность не считается дважды
+    op.create_table('active_user_days',
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('user_id', sa.BigInteger(), nullable=False),
+                    sa.Column('plan', sa.String(length=16), nullable=False),
+                    sa.PrimaryKeyConstraint('day', 'user_id')
+                    )
+    op.create_table('active_users_daily',
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('plan', sa.String(length=16), nullable=False),
+                    sa.Column('users', sa.Integer(), server_default='0', nullable=False),
+                    sa.PrimaryKeyConstraint('day', 'plan')
+                    )
+    op.create_table('revenue_daily',
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('currency', postgresql.ENUM('RUB', 'USD', 'EUR',
+                                                          name='currency_code', create_type=False),
+                              nullable=False),
+                    sa.Column('payments', sa.Integer(), server_default='0', nullable=False),
+                    sa.Column('amount', sa.DECIMAL(precision=14, scale=2), server_default='0', nullable=False),
+                    sa.PrimaryKeyConstraint('day', 'currency')
+                    )
+    # До какого момента исходные строки уже сложены в агрегаты
+    op.create_table('rollup_watermarks',
+                    sa.Column('name', sa.String(length=32), nullable=False),
+                    sa.Column('position', sa.TIMESTAMP(), nullable=False),
+                    sa.Column('updated_at', sa.TIMESTAMP(),
+                              server_default=sa.text('now()'), nullable=True),
+                    sa.PrimaryKeyConstraint('name')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('rollup_watermarks')
+    op.drop_table('revenue_daily')
+    op.drop_table('active_users_daily')
+    op.drop_table('active_user_days')
+    op.drop_table('usage_daily')
@@ -0,0 +1,154 @@
+"""
+Monthly partitions of message_history.
+
+message_history is range-partitioned on created_at, one partition per
+calendar month (UTC), named message_history_pYYYYMM. Rows from before the
+switch live in message_history_legacy, which covers everything up to the
+first monthly partition. PartitionMaintainer keeps HISTORY_PARTITIONS_AHEAD
+months of partitions ready, and retention is detaching and dropping
+partitions that end more than HISTORY_RETENTION_MONTHS ago rather than
+DELETEs.
+"""
+
+import re
+from datetime import date, datetime, timezone
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import text
+
+from backend.config import settings
+from backend.database.periodic import PeriodicTask
+from backend.database.sharding import on_every_shard
+import logging
+
+logger = logging.getLogger(__name__)
+
+PARENT = "message_history"
+
+LIST_PARTITIONS = text("""
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = CAST(:parent AS regclass)
+""")
+
+_BOUNDS = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+class Partition(NamedTuple):
+    name: str
+    start: Optional[datetime]  # None for MINVALUE
+    end: Optional[datetime]  # None for MAXVALUE
+
+
+def month_start(day: date, months: int = 0) -> datetime:
+    """Midnight UTC on the first day of the month `months` after day's month"""
+    index = day.year * 12 + day.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(start: datetime) -> str:
+    return f"{PARENT}_p{start:%Y%m}"
+
+
+def _bound(value: str) -> Optional[datetime]:
+    if value in ("MINVALUE", "MAXVALUE"):
+        return None
+    # timestamptz bounds (migrations) carry an offset, timestamp ones (init.sql,
+    # create_all) do not; both are UTC
+    bound = datetime.fromisoformat(value.strip("'"))
+    return bound.replace(tzinfo=timezone.utc) if bound.tzinfo is None else bound.astimezone(timezone.utc)
+
+
+def parse_partition(name: str, bound: str) -> Partition:
+    """Partition from pg_get_expr(relpartbound), e.g. FOR VALUES FROM ('...') TO ('...')"""
+    match = _BOUNDS.search(bound)
+    return Partition(name, _bound(match.group(1)), _bound(match.group(2)))
+
+
+def missing_months(partitions: List[Partition], now: datetime, months_ahead: int) -> List[datetime]:
+    """Month starts from now's month through months_ahead later not covered by any partition"""
+    missing = []
+    for offset in range(months_ahead + 1):
+        start, end = month_start(now, offset), month_start(now, offset + 1)
+        overlaps = any(
+            (p.start is None or p.start < end) and (p.end is None or start < p.end)
+            for p in partitions
+        )
+        if not overlaps:
+            missing.append(start)
+    return missing
+
+
+def expired_partitions(partitions: List[Partition], cutoff: datetime) -> List[Partition]:
+    """Partitions that only hold rows older than cutoff"""
+    return [p for p in partitions if p.end is not None and p.end <= cutoff]
+
+
+async def list_partitions(session) -> List[Partition]:
+    result = await session.execute(LIST_PARTITIONS, {"parent": PARENT})
+    return [parse_partition(name, bound) for name, bound in result.all()]
+
+
+async def ensure_partitions(session, months_ahead: int, now: Optional[datetime] = None) -> List[str]:
+    """Create the partitions missing for this month and the next months_ahead; returns their names"""
+    now = now or datetime.now(timezone.utc)
+    created = []
+    for start in missing_months(await list_partitions(session), now, months_ahead):
+        end = month_start(start, 1)
+        name = partition_name(start)
+        await session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+        created.append(name)
+    await session.commit()
+    return created
+
+
+async def drop_expired_partitions(session, retention_months: int, now: Optional[datetime] = None) -> List[str]:
+    """Detach and drop partitions that end retention_months or more before this month"""
+    cutoff = month_start(now or datetime.now(timezone.utc), -retention_months)
+    dropped = []
+    for partition in expired_partitions(await list_partitions(session), cutoff):
+        await session.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {partition.name}"))
+        await session.execute(text(f"DROP TABLE {partition.name}"))
+        dropped.append(partition.name)
+    await session.commit()
+    return dropped
+
+
+class PartitionMaintainer(PeriodicTask):
+    description = "message_history partition maintenance"
+
+    def __init__(self, months_ahead: int = 3, retention_months: int = 0, interval: float = 3600.0):
+        super().__init__(interval)
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.created: List[str] = []
+        self.dropped: List[str] = []
+
+    async def _maintain(self, session) -> tuple:
+        created = await ensure_partitions(session, self.months_ahead)
+        dropped = await drop_expired_partitions(session, self.retention_months) if self.retention_months else []
+        return created, dropped
+
+    async def run_once(self) -> None:
+        async with self._session_factory() as session:
+            results = await on_every_shard(session, self._maintain)
+        created = [name for shard_created, _ in results for name in shard_created]
+        dropped = [name for _, shard_dropped in results for name in shard_dropped]
+        if created or dropped:
+            logger.info(f"message_history partitions created: {created}, dropped: {dropped}")
+        self.created.extend(created)
+        self.dropped.extend(dropped)
+
+    def stats(self) -> dict:
+        return {"created": self.created, "dropped": self.dropped, "failures": self.failures}
+
+
+partition_maintainer = PartitionMaintainer(
+    settings.HISTORY_PARTITIONS_AHEAD,
+    settings.HISTORY_RETENTION_MONTHS,
+    settings.HISTORY_PARTITION_CHECK_INTERVAL,
+)
@@ -0,0 +1,67 @@
+"""
+Background jobs that run every few seconds or minutes.
+
+A PeriodicTask subclass implements run_once() with sessions from
+self._session_factory; start(session_factory) runs it in the background
+every `interval` seconds (first right away, or after one interval when
+run_at_start is False) and stop() cancels it. A failed run is logged and
+counted, and the next one is tried on schedule.
+"""
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+import logging
+
+
+async def cancel_task(task: Optional[asyncio.Task]) -> None:
+    """Cancel task and wait until it has finished"""
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+class PeriodicTask(ABC):
+    description = "Periodic task"  # for failure logs
+    run_at_start = True
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._session_factory: Optional[Callable] = None
+        self._task: Optional[asyncio.Task] = None
+        self.failures = 0
+
+    @abstractmethod
+    async def run_once(self):
+        """One run of the job"""
+
+    async def _wait(self) -> None:
+        await asyncio.sleep(self.interval)
+
+    def _failed(self, error: Exception) -> None:
+        self.failures += 1
+        logging.getLogger(type(self).__module__).error(f"{self.description} failed: {error}")
+
+    async def _run(self) -> None:
+        if not self.run_at_start:
+            await self._wait()
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self._failed(e)
+            await self._wait()
+
+    def start(self, session_factory: Callable) -> None:
+        """Run every interval seconds with sessions from session_factory"""
+        self._session_factory = session_factory
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        await cancel_task(self._task)
+        self._task = None
@@ -0,0 +1,51 @@
+"""
+Sweeper for expired credit reservations.
+
+process_message reserves a message credit before the AI call
+(crud.reserve_message) and commits or releases it afterwards. If the worker
+dies or a streaming client goes away in between, the reservation row stays
+behind; ReservationSweeper returns the credits of reservations older than
+CREDIT_RESERVATION_TTL every CREDIT_RESERVATION_SWEEP_INTERVAL seconds.
+"""
+
+from backend.config import settings
+from backend.database import crud
+from backend.database.periodic import PeriodicTask
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationSweeper(PeriodicTask):
+    description = "Credit reservation sweep"
+    run_at_start = False
+
+    def __init__(self, interval: float = 30.0, batch_size: int = 1000):
+        super().__init__(interval)
+        self.batch_size = batch_size
+        self.sweeps = 0
+        self.released_users = 0
+
+    async def run_once(self) -> int:
+        """Release expired reservations batch by batch; returns the number of users credited"""
+        released = 0
+        async with self._session_factory() as session:
+            while True:
+                users = await crud.release_expired_reservations(session, self.batch_size)
+                released += users
+                if users == 0:
+                    break
+        self.sweeps += 1
+        self.released_users += released
+        if released:
+            logger.info(f"Released expired credit reservations of {released} users")
+        return released
+
+    def stats(self) -> dict:
+        return {"sweeps": self.sweeps, "released_users": self.released_users, "failures": self.failures}
+
+
+reservation_sweeper = ReservationSweeper(
+    settings.CREDIT_RESERVATION_SWEEP_INTERVAL,
+    settings.CREDIT_RESERVATION_SWEEP_BATCH,
+)
@@ -0,0 +1,284 @@
+"""
+Daily rollups for analytics.
+
+Counting messages per provider, daily active users or revenue straight from
+message_history, active_users and payments means scanning them. Instead
+they are kept in small per-day tables:
+
+- usage_daily: messages and tokens per day, provider, model and plan
+- active_users_daily: distinct active users per day and plan
+- revenue_daily: successful payments and their sum per day and currency
+
+Daily active users are counted when heartbeats are flushed (see
+COUNT_ACTIVE_DAYS and backend.database.heartbeats): active_users only keeps
+each user's latest touch, so folding it later would miss a user active on
+several days. UsageRollups just prunes the days no touch can reach anymore.
+
+Each other source has a watermark in rollup_watermarks. A run takes the row
+FOR UPDATE SKIP LOCKED (so one worker per database does the work), folds
+the rows created in [watermark, watermark + ROLLUP_STEP) into the rollup
+and moves the watermark in the same transaction, window by window until
+ROLLUP_LAG seconds before now. The lag leaves time for rows that are
+written late: history batches carry the time they were queued. History
+rows replayed from the spool after a longer outage are not counted.
+
+Payments turn successful after they are created, so revenue for the last
+ROLLUP_REVENUE_SETTLE_DAYS days (and any days since the previous run) is
+recomputed on every run instead; its watermark is the time of that run.
+
+A user's plan is taken from users when the rows are folded in or the
+touches flushed: "free" unless access_until covers the day. When sharded, every shard keeps its own
+rollups and the reads below add them up.
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import func, select, text
+
+from backend.config import settings
+from backend.database.periodic import PeriodicTask
+from backend.database.sharding import on_every_shard
+from backend.models.database import ActiveUsersDaily, RevenueDaily, RollupWatermark, UsageDaily
+from backend.models.enums import AIProviderType
+import logging
+
+logger = logging.getLogger(__name__)
+
+FREE_PLAN = "free"
+
+
+def _plan_on(day: str) -> str:
+    return f"CASE WHEN users.access_until >= {day} THEN CAST(users.plan AS text) ELSE '{FREE_PLAN}' END"
+
+
+FOLD_USAGE = text(f"""
+    INSERT INTO usage_daily AS rollup (day, ai_provider, ai_model, plan, messages, user_tokens, response_tokens)
+    SELECT CAST(m.created_at AS date), m.ai_provider, m.ai_model, {_plan_on("CAST(m.created_at AS date)")},
+           count(*), coalesce(sum(m.user_tokens), 0), coalesce(sum(m.response_tokens), 0)
+    FROM message_history m
+    JOIN users ON users.id = m.user_id
+    WHERE m.created_at >= :start AND m.created_at < :end
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (day, ai_provider, ai_model, plan) DO UPDATE
+    SET messages = rollup.messages + EXCLUDED.messages,
+        user_tokens = rollup.user_tokens + EXCLUDED.user_tokens,
+        response_tokens = rollup.response_tokens + EXCLUDED.response_tokens
+""")
+
+# Run by every heartbeat flush with the (user_id, day) pairs it touched.
+# active_user_days remembers who was already counted for a day, so only a
+# user's first touch of a day adds to the count, whichever worker flushes it
+COUNT_ACTIVE_DAYS = text(f"""
+    WITH counted AS (
+        INSERT INTO active_user_days (day, user_id, plan)
+        SELECT v.day, v.user_id, {_plan_on("v.day")}
+        FROM unnest(CAST(:user_ids AS BIGINT[]), CAST(:days AS DATE[])) AS v(user_id, day)
+        JOIN users ON users.id = v.user_id
+        ON CONFLICT (day, user_id) DO NOTHING
+        RETURNING day, plan
+    )
+    INSERT INTO active_users_daily AS rollup (day, plan, users)
+    SELECT day, plan, count(*) FROM counted GROUP BY day, plan
+    ON CONFLICT (day, plan) DO UPDATE SET users = rollup.users + EXCLUDED.users
+""")
+
+# Touches are flushed within seconds; the margin covers a worker that kept
+# them through a long database outage. A touch older than this would be
+# counted a second time
+ACTIVE_USER_DAYS_KEPT = 7
+
+PRUNE_ACTIVE_USER_DAYS = text("DELETE FROM active_user_days WHERE day < :start_day")
+
+CLEAR_REVENUE = text("DELETE FROM revenue_daily WHERE day >= :start_day")
+
+FOLD_REVENUE = text("""
+    INSERT INTO revenue_daily (day, currency, payments, amount)
+    SELECT payment_date, currency, count(*), sum(amount)
+    FROM payments
+    WHERE success AND payment_date >= :start_day
+    GROUP BY payment_date, currency
+""")
+
+INIT_WATERMARK = text("""
+    INSERT INTO rollup_watermarks (name, position) VALUES (:name, :position)
+    ON CONFLICT (name) DO NOTHING
+""")
+
+LOCK_WATERMARK = text("SELECT position FROM rollup_watermarks WHERE name = :name FOR UPDATE SKIP LOCKED")
+
+MOVE_WATERMARK = text("UPDATE rollup_watermarks SET position = :position, updated_at = now() WHERE name = :name")
+
+
+class Rollup(NamedTuple):
+    name: str
+    statements: tuple  # run in order for each window, with start, end and start_day
+
+
+ROLLUPS = (
+    Rollup("usage", (FOLD_USAGE,)),
+)
+
+
+def next_window(position: datetime, now: datetime, step: timedelta, lag: timedelta) -> Optional[tuple]:
+    """[start, end) to fold after position: at most step long, ending lag before now; None when caught up"""
+    end = min(position + step, now - lag)
+    return (position, end) if end > position else None
+
+
+async def _lock_watermark(session, name: str, initial: datetime) -> Optional[datetime]:
+    """Watermark position, locked until commit; None while another worker holds it"""
+    await session.execute(INIT_WATERMARK, {"name": name, "position": initial})
+    return (await session.execute(LOCK_WATERMARK, {"name": name})).scalar_one_or_none()
+
+
+class UsageRollups(PeriodicTask):
+    description = "Usage rollup"
+
+    def __init__(
+        self,
+        interval: float = 300.0,
+        step: float = 3600.0,
+        lag: float = 120.0,
+        revenue_settle_days: int = 3,
+        backfill_days: int = 90
+    ):
+        super().__init__(interval)
+        self.step = timedelta(seconds=step)
+        self.lag = timedelta(seconds=lag)
+        self.revenue_settle_days = revenue_settle_days
+        self.backfill_days = backfill_days
+        self.runs = 0
+        self.windows = 0
+
+    def _backfill_start(self, today: date) -> datetime:
+        return datetime.combine(today - timedelta(days=self.backfill_days), datetime.min.time())
+
+    async def _fold(self, session, rollup: Rollup, now: datetime) -> int:
+        """Fold windows of new rows one transaction each; returns how many"""
+        windows = 0
+        while True:
+            position = await _lock_watermark(session, rollup.name, self._backfill_start(now.date()))
+            window = None if position is None else next_window(position, now, self.step, self.lag)
+            if window is None:
+                await session.commit()
+                return windows
+            start, end = window
+            for statement in rollup.statements:
+                await session.execute(statement, {"start": start, "end": end, "start_day": start.date()})
+            await session.execute(MOVE_WATERMARK, {"name": rollup.name, "position": end})
+            await session.commit()
+            windows += 1
+
+    async def _fold_revenue(self, session, now: datetime) -> int:
+        """Recompute the unsettled days, and every day since the last run if that was longer ago"""
+        position = await _lock_watermark(session, "revenue", self._backfill_start(now.date()))
+        if position is None:
+            await session.commit()
+            return 0
+        start_day = min(position.date(), now.date() - timedelta(days=self.revenue_settle_days))
+        await session.execute(CLEAR_REVENUE, {"start_day": start_day})
+        await session.execute(FOLD_REVENUE, {"start_day": start_day})
+        await session.execute(MOVE_WATERMARK, {"name": "revenue", "position": now})
+        await session.commit()
+        return 1
+
+    async def _refresh(self, session) -> int:
+        now = datetime.utcnow()
+        windows = 0
+        for rollup in ROLLUPS:
+            windows += await self._fold(session, rollup, now)
+        windows += await self._fold_revenue(session, now)
+        start_day = now.date() - timedelta(days=ACTIVE_USER_DAYS_KEPT)
+        await session.execute(PRUNE_ACTIVE_USER_DAYS, {"start_day": start_day})
+        await session.commit()
+        return windows
+
+    async def run_once(self) -> int:
+        """Bring every rollup up to date; returns the number of windows folded"""
+        async with self._session_factory() as session:
+            windows = sum(await on_every_shard(session, self._refresh))
+        self.runs += 1
+        self.windows += windows
+        logger.debug(f"Usage rollups: {windows} windows folded")
+        return windows
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "windows": self.windows, "failures": self.failures}
+
+
+# ---------- reads ----------
+
+def _sum_by_key(shards: List[list], keys: int) -> List[tuple]:
+    """Rows of every shard added up on their first `keys` columns, in key order"""
+    if len(shards) == 1:
+        return [tuple(row) for row in shards[0]]
+    totals: Dict[tuple, tuple] = {}
+    for rows in shards:
+        for row in rows:
+            key, values = tuple(row[:keys]), tuple(row[keys:])
+            current = totals.get(key)
+            totals[key] = values if current is None else tuple(a + b for a, b in zip(current, values))
+    return [key + values for key, values in sorted(totals.items())]
+
+
+async def _read(session, stmt, keys: int) -> List[tuple]:
+    async def rows(shard_session):
+        return (await shard_session.execute(stmt)).all()
+
+    return _sum_by_key(await on_every_shard(session, rows), keys)
+
+
+async def usage(session, since: date, until: date, provider: Optional[AIProviderType] = None) -> List[tuple]:
+    """(day, ai_provider, ai_model, plan, messages, user_tokens, response_tokens) for since..until"""
+    stmt = (
+        select(
+            UsageDaily.day, UsageDaily.ai_provider, UsageDaily.ai_model, UsageDaily.plan,
+            UsageDaily.messages, UsageDaily.user_tokens, UsageDaily.response_tokens
+        )
+        .where(UsageDaily.day >= since, UsageDaily.day <= until)
+        .order_by(UsageDaily.day, UsageDaily.ai_provider, UsageDaily.ai_model, UsageDaily.plan)
+    )
+    if provider is not None:
+        stmt = stmt.where(UsageDaily.ai_provider == provider)
+    return await _read(session, stmt, 4)
+
+
+async def active_users(session, since: date, until: date) -> List[tuple]:
+    """(day, plan, users) for since..until"""
+    stmt = (
+        select(ActiveUsersDaily.day, ActiveUsersDaily.plan, ActiveUsersDaily.users)
+        .where(ActiveUsersDaily.day >= since, ActiveUsersDaily.day <= until)
+        .order_by(ActiveUsersDaily.day, ActiveUsersDaily.plan)
+    )
+    return await _read(session, stmt, 2)
+
+
+async def revenue(session, since: date, until: date) -> List[tuple]:
+    """(day, currency, payments, amount) for since..until"""
+    stmt = (
+        select(RevenueDaily.day, RevenueDaily.currency, RevenueDaily.payments, RevenueDaily.amount)
+        .where(RevenueDaily.day >= since, RevenueDaily.day <= until)
+        .order_by(RevenueDaily.day, RevenueDaily.currency)
+    )
+    return await _read(session, stmt, 2)
+
+
+async def folded_until(session, name: str) -> Optional[datetime]:
+    """Source rows before this time are in rollup `name` on every shard; None before the first run"""
+    stmt = select(func.min(RollupWatermark.position)).where(RollupWatermark.name == name)
+
+    async def position(shard_session):
+        return (await shard_session.execute(stmt)).scalar_one_or_none()
+
+    positions = await on_every_shard(session, position)
+    return None if None in positions else min(positions)
+
+
+usage_rollups = UsageRollups(
+    settings.ROLLUP_INTERVAL,
+    settings.ROLLUP_STEP,
+    settings.ROLLUP_LAG,
+    settings.ROLLUP_REVENUE_SETTLE_DAYS,
+    settings.ROLLUP_BACKFILL_DAYS,
+)
@@ -0,0 +1,363 @@
+"""
+Hash sharding of user data across several PostgreSQL databases.
+
+Every shard has the full schema; a user and all their rows (history,
+subscriptions, payments, ...) live on the shard HashRing picks for their
+telegram_id. With DB_SHARDS set, get_async_sessionmaker() hands out
+ShardSession objects instead of plain sessions. A ShardSession is bound to
+a shard by the first crud call that names a user (route()), and everything
+after it in the request runs there. Jobs that are not about one user
+(sweepers, heartbeats, partitions, admin queries) call fan_out() /
+on_every_shard() to run on all shards.
+
+Resharding is online. With DB_SHARDS_NEXT set, a user whose shard differs
+between the two rings is "moving": their requests take a shared advisory
+lock on the source shard and use it while the user is still there,
+otherwise the target. move_user() takes the same lock exclusively, copies
+the user's rows to the target, commits there and then deletes them from
+the source, so a request never sees the user on both or neither.
+"""
+
+import asyncio
+import bisect
+import hashlib
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from backend.config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+USER_EXISTS = text("SELECT 1 FROM users WHERE telegram_id = :telegram_id")
+LOCK_SHARED = text("SELECT pg_advisory_lock_shared(:key)")
+UNLOCK_SHARED = text("SELECT pg_advisory_unlock_shared(:key)")
+TRY_LOCK = text("SELECT pg_try_advisory_lock(:key)")
+UNLOCK = text("SELECT pg_advisory_unlock(:key)")
+
+# Tables holding a user's rows, parents first; credit_grants also needs its campaign
+USER_TABLES = (
+    "active_users",
+    "subscriptions",
+    "payments",
+    "credit_reservations",
+    "conversation_summaries",
+    "credit_grants",
+    "message_history",
+)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def lock_key(telegram_id: int) -> int:
+    """Advisory lock key of a user (signed 64 bit)"""
+    return _hash(f"user:{telegram_id}") - 2 ** 63
+
+
+class HashRing:
+    """Consistent-hash ring: adding a shard moves about 1/N of the users, all onto it"""
+
+    def __init__(self, shards: List[str], vnodes: int = 128):
+        if not shards:
+            raise ValueError("A hash ring needs at least one shard")
+        self.shards = sorted(shards)
+        points = sorted((_hash(f"{shard}#{i}"), shard) for shard in self.shards for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, telegram_id: int) -> str:
+        index = bisect.bisect(self._hashes, _hash(str(telegram_id))) % len(self._hashes)
+        return self._owners[index]
+
+
+class ShardRouter:
+    def __init__(
+        self,
+        urls: Dict[str, str],
+        next_urls: Optional[Dict[str, str]] = None,
+        vnodes: int = 128,
+        engine_factory: Optional[Callable[[str], AsyncEngine]] = None
+    ):
+        self.urls = dict(urls)
+        self.next_urls = dict(next_urls or {})
+        self.ring = HashRing(list(urls), vnodes)
+        self.next_ring = HashRing(list(self.next_urls), vnodes) if self.next_urls else None
+        self._engine_factory = engine_factory or _create_engine
+        self._engines: Dict[str, AsyncEngine] = {}
+        self._sessionmakers: Dict[str, async_sessionmaker] = {}
+        self.routed: Dict[str, int] = {}
+        self.moving_lookups = 0
+
+    @property
+    def shards(self) -> List[str]:
+        """Every shard of the current and, while resharding, the next layout"""
+        return sorted(set(self.urls) | set(self.next_urls))
+
+    def engine(self, shard: str) -> AsyncEngine:
+        if shard not in self._engines:
+            self._engines[shard] = self._engine_factory({**self.urls, **self.next_urls}[shard])
+        return self._engines[shard]
+
+    def sessionmaker_for(self, shard: str) -> async_sessionmaker:
+        if shard not in self._sessionmakers:
+            self._sessionmakers[shard] = async_sessionmaker(self.engine(shard), expire_on_commit=False)
+        return self._sessionmakers[shard]
+
+    def placement(self, telegram_id: int) -> Tuple[str, str]:
+        """(current shard, shard after resharding); equal unless the user is moving"""
+        source = self.ring.shard_for(telegram_id)
+        return source, self.next_ring.shard_for(telegram_id) if self.next_ring else source
+
+    async def open(self, telegram_id: int) -> Tuple[str, AsyncSession, Optional[AsyncConnection]]:
+        """
+        Session on the shard that holds telegram_id. For a moving user it is
+        bound to a connection holding the user's shared lock on the source,
+        returned as the third item so ShardSession.close() can release it.
+        """
+        source, target = self.placement(telegram_id)
+        if source == target:
+            return source, self.sessionmaker_for(source)(), None
+
+        self.moving_lookups += 1
+        conn = await self.engine(source).connect()
+        try:
+            key = {"key": lock_key(telegram_id)}
+            await conn.execute(LOCK_SHARED, key)
+            on_source = (await conn.execute(USER_EXISTS, {"telegram_id": telegram_id})).first() is not None
+            await conn.commit()
+            if on_source:
+                return source, AsyncSession(bind=conn, expire_on_commit=False), conn
+            await conn.execute(UNLOCK_SHARED, key)
+            await conn.commit()
+        except BaseException:
+            await conn.close()
+            raise
+        await conn.close()
+        # Already moved, or a new user: they belong to the target
+        return target, self.sessionmaker_for(target)(), None
+
+    async def fan_out(self, fn: Callable[[AsyncSession], Awaitable]) -> List:
+        """fn(session) on every shard at once, each with its own session; results in shard order"""
+        async def run(shard):
+            async with self.sessionmaker_for(shard)() as session:
+                return await fn(session)
+
+        return list(await asyncio.gather(*(run(shard) for shard in self.shards)))
+
+    def sessionmaker(self) -> Callable[[], "ShardSession"]:
+        return lambda: ShardSession(self)
+
+    async def dispose(self) -> None:
+        for engine in self._engines.values():
+            await engine.dispose()
+        self._engines.clear()
+        self._sessionmakers.clear()
+
+    def stats(self) -> dict:
+        return {
+            "shards": self.shards,
+            "resharding": self.next_ring is not None,
+            "routed": dict(self.routed),
+            "moving_lookups": self.moving_lookups,
+        }
+
+
+class ShardSession:
+    """
+    AsyncSession stand-in that picks its shard on the first route() call and
+    then forwards everything to a session there.
+    """
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+        self.shard: Optional[str] = None
+        self._session: Optional[AsyncSession] = None
+        self._conn: Optional[AsyncConnection] = None
+        self._lock_key: Optional[int] = None
+        self._telegram_id: Optional[int] = None
+
+    @property
+    def routed(self) -> bool:
+        return self._session is not None
+
+    async def route(self, telegram_id: int) -> None:
+        if self._session is not None:
+            if telegram_id != self._telegram_id and self.router.placement(telegram_id) != self.router.placement(self._telegram_id):
+                raise RuntimeError(f"Session is bound to shard {self.shard}; telegram_id {telegram_id} may live elsewhere")
+            return
+        self.shard, self._session, self._conn = await self.router.open(telegram_id)
+        self._telegram_id = telegram_id
+        self._lock_key = lock_key(telegram_id) if self._conn is not None else None
+        self.router.routed[self.shard] = self.router.routed.get(self.shard, 0) + 1
+
+    def bind_shard(self, shard: str) -> None:
+        """Bind to a shard found by a fan-out lookup (e.g. a payment by id)"""
+        if self._session is None:
+            self.shard, self._session = shard, self.router.sessionmaker_for(shard)()
+
+    async def fan_out(self, fn: Callable[[AsyncSession], Awaitable]) -> List:
+        return await self.router.fan_out(fn)
+
+    def _bound(self) -> AsyncSession:
+        if self._session is None:
+            raise RuntimeError("Sharded session used before crud routed it to a user's shard")
+        return self._session
+
+    def __getattr__(self, name):
+        # execute, scalar, stream, add, refresh, flush, ... of the bound session
+        return getattr(self._bound(), name)
+
+    async def commit(self) -> None:
+        if self._session is not None:
+            await self._session.commit()
+
+    async def rollback(self) -> None:
+        if self._session is not None:
+            await self._session.rollback()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+        if self._conn is not None:
+            try:
+                await self._conn.execute(UNLOCK_SHARED, {"key": self._lock_key})
+                await self._conn.commit()
+            finally:
+                await self._conn.close()
+                self._conn = None
+
+    async def __aenter__(self) -> "ShardSession":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+def _create_engine(url: str) -> AsyncEngine:
+    from backend.database.session import async_database_url, engine_options
+    return create_async_engine(async_database_url(url), **engine_options())
+
+
+async def route(session, telegram_id: int) -> None:
+    """Bind a sharded session to telegram_id's shard; plain sessions are left alone"""
+    if isinstance(session, ShardSession):
+        await session.route(telegram_id)
+
+
+def unrouted(session) -> bool:
+    """A sharded session not yet bound to a shard: work not about one user must fan out"""
+    return isinstance(session, ShardSession) and not session.routed
+
+
+def shard_of(session) -> Optional[str]:
+    """The shard a sharded session is bound to; None for a plain or unbound one"""
+    return session.shard if isinstance(session, ShardSession) else None
+
+
+async def on_every_shard(session, fn: Callable[[AsyncSession], Awaitable]) -> List:
+    """[fn(session)] for a plain or bound session, fn on every shard for an unbound sharded one"""
+    if unrouted(session):
+        return await session.fan_out(fn)
+    return [await fn(session)]
+
+
+# ---------- resharding ----------
+
+async def move_user(router: ShardRouter, telegram_id: int, batch_size: int = 5000) -> Optional[str]:
+    """
+    Move a user whose shard changes in the next layout from source to target.
+    Returns the target shard, or None if there was nothing to move or the
+    user is busy (a request holds their lock); run again later for those.
+    """
+    from backend.models.database import Base
+
+    source, target = router.placement(telegram_id)
+    if source == target:
+        return None
+    key = {"key": lock_key(telegram_id)}
+    users = Base.metadata.tables["users"]
+    tables = [Base.metadata.tables[name] for name in USER_TABLES]
+    campaigns = Base.metadata.tables["credit_campaigns"]
+
+    async with router.engine(source).connect() as src:
+        locked = (await src.execute(TRY_LOCK, key)).scalar()
+        await src.commit()
+        if not locked:
+            return None
+        try:
+            user = (await src.execute(select(users).where(users.c.telegram_id == telegram_id))).mappings().first()
+            if user is None:
+                await src.commit()
+                return None
+            user_id = user["id"]
+            async with router.engine(target).begin() as dst:
+                # A retry after a failed move replaces what the earlier attempt copied
+                await dst.execute(delete(users).where(users.c.id == user_id))
+                await dst.execute(insert(users).values(dict(user)))
+                campaign_ids = select(Base.metadata.tables["credit_grants"].c.campaign_id).where(
+                    Base.metadata.tables["credit_grants"].c.user_id == user_id
+                )
+                for row in (await src.execute(select(campaigns).where(campaigns.c.id.in_(campaign_ids)))).mappings():
+                    await dst.execute(pg_insert(campaigns).values(dict(row)).on_conflict_do_nothing())
+                for table in tables:
+                    result = await src.stream(select(table).where(table.c.user_id == user_id))
+                    async for rows in result.mappings().partitions(batch_size):
+                        await dst.execute(insert(table), [dict(row) for row in rows])
+            # Children go with the user (ON DELETE CASCADE)
+            await src.execute(delete(users).where(users.c.id == user_id))
+            await src.commit()
+        except BaseException:
+            await src.rollback()
+            raise
+        finally:
+            await src.execute(UNLOCK, key)
+            await src.commit()
+
+    from backend.database.status_cache import status_cache
+    await status_cache.invalidate(user_id)
+    logger.info(f"Moved user {telegram_id} from shard {source} to {target}")
+    return target
+
+
+async def moving_users(router: ShardRouter, shard: str, batch_size: int = 1000):
+    """Batches of telegram_ids stored on shard that belong elsewhere in the next layout"""
+    after = -2 ** 63
+    while True:
+        async with router.sessionmaker_for(shard)() as session:
+            rows = (await session.execute(
+                text("SELECT telegram_id FROM users WHERE telegram_id > :after ORDER BY telegram_id LIMIT :limit"),
+                {"after": after, "limit": batch_size}
+            )).scalars().all()
+        if not rows:
+            return
+        after = rows[-1]
+        yield [telegram_id for telegram_id in rows if router.placement(telegram_id)[1] != shard]
+
+
+async def prepare_sequences(engine: AsyncEngine, offset: int, stride: int) -> None:
+    """
+    Make every id sequence of a shard hand out ids = offset (mod stride), above
+    what it already used, so ids never collide with another shard's.
+    """
+    async with engine.begin() as conn:
+        sequences = (await conn.execute(text(
+            "SELECT sequencename FROM pg_sequences WHERE schemaname = current_schema()"
+        ))).scalars().all()
+        for sequence in sequences:
+            last = (await conn.execute(text(f"SELECT COALESCE(last_value, 0) FROM {sequence}"))).scalar()
+            start = (last // stride + 1) * stride + offset
+            await conn.execute(text(f"ALTER SEQUENCE {sequence} INCREMENT BY {stride} RESTART WITH {start}"))
+
+
+def _router_from_settings() -> Optional[ShardRouter]:
+    if not settings.DB_SHARDS:
+        return None
+    return ShardRouter(settings.DB_SHARDS, settings.DB_SHARDS_NEXT, settings.DB_SHARD_VNODES)
+
+
+shard_router = _router_from_settings()
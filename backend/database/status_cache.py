@@ -0,0 +1,301 @@
+"""
+In-process cache of compact per-user status records.
+
+Menu taps, /get_credits, /user_profile and the message checks all need the
+same few fields (credits, VIP flag, active plan and its end date), which
+cost a user query plus a subscription query. UserStatusCache keeps them
+for USER_STATUS_CACHE_TTL seconds in a bounded LRU keyed by telegram_id.
+
+crud functions that change these fields call invalidate(user_id) after
+their commit (save_reply too, so readers know the user just wrote, see
+session.ReadRouter). The invalidation is published on a bus so every worker
+drops its copy: LocalInvalidationBus for a single process (and tests),
+RedisInvalidationBus (USER_STATUS_REDIS_URL) across workers. A load that
+started before an invalidation of the same user is not stored, so a
+concurrent write is never masked by an older read. When the Redis
+subscription breaks it is retried with backoff, and every worker that
+reconnects drops its whole cache, since messages sent meanwhile are lost.
+"""
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from backend.config import settings
+from backend.models.enums import SubscriptionPlanType
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UserStatus:
+    user_id: int
+    telegram_id: int
+    credits: int
+    is_vip: bool
+    plan: Optional[SubscriptionPlanType] = None
+    plan_end: Optional[date] = None
+
+    @property
+    def has_active_subscription(self) -> bool:
+        # Checked on read, so a plan ending while cached is not reported as active
+        return self.plan_end is not None and self.plan_end >= date.today()
+
+    @property
+    def active_plan(self) -> Optional[SubscriptionPlanType]:
+        return self.plan if self.has_active_subscription else None
+
+
+class LocalInvalidationBus:
+    """Delivers invalidations to subscribers of this process only"""
+
+    def __init__(self):
+        self._subscribers = []
+        self._reset_callbacks = []
+
+    def subscribe(self, callback: Callable[[int], None]) -> None:
+        self._subscribers.append(callback)
+
+    def on_reset(self, callback: Callable[[], None]) -> None:
+        """callback() when invalidations may have been missed and everything must be dropped"""
+        self._reset_callbacks.append(callback)
+
+    def _reset(self) -> None:
+        for callback in self._reset_callbacks:
+            callback()
+
+    async def publish(self, user_id: int) -> None:
+        for callback in self._subscribers:
+            callback(user_id)
+
+    async def publish_many(self, user_ids: List[int]) -> None:
+        for user_id in user_ids:
+            for callback in self._subscribers:
+                callback(user_id)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class RedisInvalidationBus(LocalInvalidationBus):
+    """
+    Invalidations over a Redis pub/sub channel, so all workers drop the entry.
+    Works with redis.asyncio.Redis or any stand-in with publish() and pubsub().
+    """
+
+    def __init__(
+        self,
+        client,
+        channel: str = "user_status_invalidate",
+        retry_delay: float = 0.5,
+        max_retry_delay: float = 30.0
+    ):
+        super().__init__()
+        self.client = client
+        self.channel = channel
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._task: Optional[asyncio.Task] = None
+        self.reconnects = 0
+
+    @classmethod
+    def from_url(cls, url: str, channel: str = "user_status_invalidate") -> "RedisInvalidationBus":
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("USER_STATUS_REDIS_URL is set but the redis package is not installed") from e
+        return cls(redis.from_url(url), channel)
+
+    async def publish(self, user_id: int) -> None:
+        # Local subscribers first: the publishing worker must not serve a stale copy
+        # even if Redis is unreachable
+        await super().publish(user_id)
+        try:
+            await self.client.publish(self.channel, json.dumps({"user_id": user_id}))
+        except Exception as e:
+            logger.error(f"User status invalidation of {user_id} not published: {e}")
+
+    async def publish_many(self, user_ids: List[int]) -> None:
+        """One message for the whole batch instead of one per user"""
+        await super().publish_many(user_ids)
+        try:
+            await self.client.publish(self.channel, json.dumps({"user_ids": list(user_ids)}))
+        except Exception as e:
+            logger.error(f"User status invalidation of {len(user_ids)} users not published: {e}")
+
+    def _deliver(self, message: dict) -> None:
+        if message.get("type") != "message":
+            return
+        try:
+            data = json.loads(message["data"])
+            user_ids = data["user_ids"] if "user_ids" in data else [data["user_id"]]
+        except (ValueError, KeyError, TypeError):
+            return
+        for user_id in user_ids:
+            for callback in self._subscribers:
+                callback(user_id)
+
+    async def _listen(self) -> None:
+        """Deliver other workers' invalidations; resubscribe with backoff when the connection breaks"""
+        delay = self.retry_delay
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                if self.reconnects:
+                    # Whatever was published while disconnected is lost
+                    logger.info("User status invalidations resubscribed, dropping all cached statuses")
+                    self._reset()
+                delay = self.retry_delay
+                async for message in pubsub.listen():
+                    self._deliver(message)
+                raise ConnectionError("subscription closed")
+            except Exception as e:
+                logger.error(f"User status invalidation listener failed, resubscribing in {delay:.1f}s: {e}")
+            finally:
+                try:
+                    await pubsub.reset()
+                except Exception:
+                    pass
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    async def start(self) -> None:
+        self._task = asyncio.ensure_future(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class UserStatusCache:
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: float = 30.0,
+        bus: Optional[LocalInvalidationBus] = None,
+        enabled: bool = True
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self._entries: "OrderedDict[int, Tuple[float, UserStatus]]" = OrderedDict()
+        self._telegram_ids: Dict[int, int] = {}
+        # Every invalidation gets the next epoch; a load is not stored if its user
+        # was invalidated at a later epoch than the one the load started at.
+        # Only the newest max_size stamps are kept; loads older than the oldest
+        # forgotten stamp (_floor) are not stored either
+        self._epoch = 0
+        self._floor = 0
+        self._invalidated: "OrderedDict[int, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._listeners = []
+        self.bus = bus or LocalInvalidationBus()
+        self.bus.subscribe(self._drop)
+        self.bus.on_reset(self.clear)
+
+    def subscribe(self, callback: Callable[[int], None]) -> None:
+        """Also call callback(user_id) for every invalidation, local or from another worker"""
+        self._listeners.append(callback)
+
+    def use_bus(self, bus: LocalInvalidationBus) -> None:
+        self.bus = bus
+        bus.subscribe(self._drop)
+        bus.on_reset(self.clear)
+
+    def get(self, telegram_id: int) -> Optional[UserStatus]:
+        entry = self._entries.get(telegram_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(telegram_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, status: UserStatus, epoch: int) -> None:
+        if not self.enabled or epoch < self._floor or self._invalidated.get(status.user_id, -1) > epoch:
+            return
+        self._entries[status.telegram_id] = (time.monotonic() + self.ttl, status)
+        self._entries.move_to_end(status.telegram_id)
+        self._telegram_ids[status.user_id] = status.telegram_id
+        while len(self._entries) > self.max_size:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._telegram_ids.pop(evicted.user_id, None)
+
+    async def get_or_load(
+        self,
+        telegram_id: int,
+        load: Callable[[], Awaitable[Optional[UserStatus]]]
+    ) -> Optional[UserStatus]:
+        """Cached status of telegram_id, or load() it; None (user not found) is not cached"""
+        status = self.get(telegram_id) if self.enabled else None
+        if status is not None:
+            return status
+        epoch = self._epoch
+        status = await load()
+        if status is not None:
+            self.put(status, epoch)
+        return status
+
+    def _drop(self, user_id: int) -> None:
+        self._epoch += 1
+        self.invalidations += 1
+        self._invalidated[user_id] = self._epoch
+        self._invalidated.move_to_end(user_id)
+        if len(self._invalidated) > self.max_size:
+            _, self._floor = self._invalidated.popitem(last=False)
+        telegram_id = self._telegram_ids.pop(user_id, None)
+        if telegram_id is not None:
+            self._entries.pop(telegram_id, None)
+        for callback in self._listeners:
+            callback(user_id)
+
+    def clear(self) -> None:
+        """Drop every record; loads already running are not stored either"""
+        self._epoch += 1
+        self._floor = self._epoch
+        self._invalidated.clear()
+        self._entries.clear()
+        self._telegram_ids.clear()
+
+    async def invalidate(self, user_id: int) -> None:
+        """Drop user_id's status here and, through the bus, in every other worker"""
+        await self.bus.publish(user_id)
+
+    async def invalidate_many(self, user_ids: List[int]) -> None:
+        """invalidate() for a batch of users, as one bus message"""
+        if user_ids:
+            await self.bus.publish_many(user_ids)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+status_cache = UserStatusCache(
+    settings.USER_STATUS_CACHE_SIZE,
+    settings.USER_STATUS_CACHE_TTL,
+    enabled=settings.USER_STATUS_CACHE_ENABLED,
+)
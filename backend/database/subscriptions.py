@@ -0,0 +1,52 @@
+"""
+Expiry of lapsed subscriptions.
+
+The plan and end date of a user's latest subscription are kept on the users
+row (plan, access_until), so access checks read nothing else. Those
+columns are set by crud.grant_subscription; SubscriptionSweeper clears
+them, and the VIP flag PREMIUM granted, once access_until has passed,
+in bulk UPDATEs of at most SUBSCRIPTION_SWEEP_BATCH users. Until the
+sweep runs, checks already treat the subscription as lapsed by comparing
+access_until with today.
+"""
+
+from backend.config import settings
+from backend.database import crud
+from backend.database.periodic import PeriodicTask
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionSweeper(PeriodicTask):
+    description = "Subscription sweep"
+
+    def __init__(self, interval: float = 600.0, batch_size: int = 1000):
+        super().__init__(interval)
+        self.batch_size = batch_size
+        self.sweeps = 0
+        self.expired_users = 0
+
+    async def run_once(self) -> int:
+        """Expire lapsed subscriptions batch by batch; returns the number of users"""
+        expired = 0
+        async with self._session_factory() as session:
+            while True:
+                users = await crud.expire_subscriptions(session, self.batch_size)
+                expired += users
+                if users < self.batch_size:
+                    break
+        self.sweeps += 1
+        self.expired_users += expired
+        if expired:
+            logger.info(f"Expired subscriptions of {expired} users")
+        return expired
+
+    def stats(self) -> dict:
+        return {"sweeps": self.sweeps, "expired_users": self.expired_users, "failures": self.failures}
+
+
+subscription_sweeper = SubscriptionSweeper(
+    settings.SUBSCRIPTION_SWEEP_INTERVAL,
+    settings.SUBSCRIPTION_SWEEP_BATCH,
+)
@@ -4,11 +4,26 @@ It initializes the API server, registers all feature routers, sets up global
 error handling, and manages application lifecycle.
 """
 
+from functools import partial
+
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from backend.utils.logger import logger
 from backend.utils.exceptions import NotEnoughCredits, UserNotFound, PaymentValidationError, AIServiceError
-from backend.api import process_message, credits, payments, users, trial, webhook
+from backend.api import process_message, credits, payments, users, trial, webhook, history, admin
+from backend.services.ai_service import ai_service
+from backend.config import settings
+from backend.database.heartbeats import heartbeats
+from backend.database.history_writer import copy_history_rows, history_writer
+from backend.database.partitions import partition_maintainer
+from backend.database.sharding import shard_router
+from backend.database.reservations import reservation_sweeper
+from backend.database.rollups import usage_rollups
+from backend.database.subscriptions import subscription_sweeper
+from backend.database.status_cache import RedisInvalidationBus, status_cache
+from backend.database.session import (
+    dispose_engine, get_async_engine, get_async_sessionmaker, get_read_sessionmaker, pool_stats, read_router
+)
 
 app = FastAPI(title="Pomogator Backend")
 
@@ -18,16 +33,45 @@ app.include_router(payments.router)
 app.include_router(users.router)
 app.include_router(trial.router)
 app.include_router(webhook.router)
+app.include_router(history.router)
+app.include_router(admin.router)
 
 
 @app.on_event("startup")
 async def startup():
     logger.info("Pomogator backend starting")
+    await ai_service.startup()
+    if settings.USER_STATUS_REDIS_URL:
+        status_cache.use_bus(RedisInvalidationBus.from_url(settings.USER_STATUS_REDIS_URL))
+    await status_cache.bus.start()
+    # Writes seen by the status cache keep the writer's reads on the primary for a while
+    status_cache.subscribe(read_router.note_write)
+    if get_read_sessionmaker() is not None:
+        read_router.start(get_read_sessionmaker())
+    partition_maintainer.start(get_async_sessionmaker())
+    heartbeats.start(get_async_sessionmaker())
+    reservation_sweeper.start(get_async_sessionmaker())
+    subscription_sweeper.start(get_async_sessionmaker())
+    if settings.ROLLUP_ENABLED:
+        usage_rollups.start(get_async_sessionmaker())
+    # COPY goes to one database; sharded replies write history in their own transaction
+    if settings.HISTORY_WRITER_ENABLED and shard_router is None:
+        history_writer.start(partial(copy_history_rows, get_async_engine()))
 
 
 @app.on_event("shutdown")
 async def shutdown():
     logger.info("Pomogator backend stopping")
+    await heartbeats.stop()
+    await history_writer.stop()
+    await reservation_sweeper.stop()
+    await subscription_sweeper.stop()
+    await usage_rollups.stop()
+    await partition_maintainer.stop()
+    await status_cache.bus.stop()
+    await read_router.stop()
+    await dispose_engine()
+    await ai_service.shutdown()
 
 
 @app.exception_handler(NotEnoughCredits)
@@ -51,4 +95,21 @@ async def handle_ai_error(request: Request, exc: AIServiceError):
 
 @app.get("/health")
 def health():
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+def metrics():
+    return {
+        "ai": ai_service.stats(),
+        "activity": heartbeats.stats(),
+        "history": history_writer.stats(),
+        "history_partitions": partition_maintainer.stats(),
+        "user_status_cache": status_cache.stats(),
+        "credit_reservations": reservation_sweeper.stats(),
+        "subscriptions": subscription_sweeper.stats(),
+        "rollups": usage_rollups.stats(),
+        "db_pool": pool_stats(),
+        "db_replica": read_router.stats(),
+        "shards": shard_router.stats() if shard_router else None,
+    }
\ No newline at end of file
@@ -1,4 +1,4 @@
-from .database import Base, User, ActiveUser, MessageHistory, Subscription, Payment
+from .database import Base, User, ActiveUser, MessageHistory, ConversationSummary, CreditReservation, CreditCampaign, CreditGrant, UsageDaily, ActiveUserDay, ActiveUsersDaily, RevenueDaily, RollupWatermark, Subscription, Payment
 from .enums import AIProviderType, SubscriptionPlanType, CurrencyType
 
 __all__ = [
@@ -6,6 +6,15 @@ __all__ = [
     "User",
     "ActiveUser",
     "MessageHistory",
+    "ConversationSummary",
+    "CreditReservation",
+    "CreditCampaign",
+    "CreditGrant",
+    "UsageDaily",
+    "ActiveUserDay",
+    "ActiveUsersDaily",
+    "RevenueDaily",
+    "RollupWatermark",
     "Subscription",
     "Payment",
     "AIProviderType",
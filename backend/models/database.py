@@ -16,6 +16,9 @@ class User(Base):
     telegram_id = Column(BigInteger, unique=True, nullable=False, index=True)
     trial_messages_left = Column(Integer, default=10)
     is_vip = Column(Boolean, default=False)
+    # Latest subscription, kept in step with subscriptions so access checks need no join
+    plan = Column(SQLEnum(SubscriptionPlanType), nullable=True)
+    access_until = Column(Date, nullable=True, index=True)
     last_active = Column(DateTime, default=func.now(), onupdate=func.now())
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
@@ -37,16 +40,102 @@ class ActiveUser(Base):
 
 class MessageHistory(Base):
     __tablename__ = 'message_history'
+    # Monthly partitions are created by backend.database.partitions
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
     
-    id = Column(BigInteger, primary_key=True, index=True)
-    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     ai_provider = Column(SQLEnum(AIProviderType), nullable=False)
     ai_model = Column(String(100), nullable=False)
     user_message = Column(Text)
     ai_response = Column(Text)
-    created_at = Column(DateTime, default=func.now(), index=True)
+    # Token estimates (backend.utils.tokens) so prompt budgets need no re-counting
+    user_tokens = Column(Integer)
+    response_tokens = Column(Integer)
+    created_at = Column(DateTime, primary_key=True, default=func.now())
     user = relationship("User", back_populates="messages")
 
+class ConversationSummary(Base):
+    __tablename__ = 'conversation_summaries'
+    
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    summary = Column(Text, nullable=False)
+    summary_tokens = Column(Integer, nullable=False, default=0)
+    # message_history.id of the newest turn folded into the summary
+    last_message_id = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+class CreditReservation(Base):
+    __tablename__ = 'credit_reservations'
+    
+    # A message credit taken from users.trial_messages_left while the AI call
+    # runs; deleting the row commits it, deleting it with a refund releases it
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    amount = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime, default=func.now())
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class CreditCampaign(Base):
+    __tablename__ = 'credit_campaigns'
+    
+    # A bulk credit grant; each user gets the amount at most once per campaign
+    id = Column(String(64), primary_key=True)
+    amount = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+
+class CreditGrant(Base):
+    __tablename__ = 'credit_grants'
+    
+    campaign_id = Column(String(64), ForeignKey('credit_campaigns.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    created_at = Column(DateTime, default=func.now())
+
+class UsageDaily(Base):
+    __tablename__ = 'usage_daily'
+    
+    # Rollups kept up to date by backend.database.rollups; plan is the
+    # user's plan on that day ("free" without one)
+    day = Column(Date, primary_key=True)
+    ai_provider = Column(SQLEnum(AIProviderType), primary_key=True)
+    ai_model = Column(String(100), primary_key=True)
+    plan = Column(String(16), primary_key=True)
+    messages = Column(BigInteger, nullable=False, default=0)
+    user_tokens = Column(BigInteger, nullable=False, default=0)
+    response_tokens = Column(BigInteger, nullable=False, default=0)
+
+class ActiveUserDay(Base):
+    __tablename__ = 'active_user_days'
+    
+    # Users already counted in active_users_daily for a day, written by
+    # heartbeat flushes (see backend.database.heartbeats)
+    day = Column(Date, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    plan = Column(String(16), nullable=False)
+
+class ActiveUsersDaily(Base):
+    __tablename__ = 'active_users_daily'
+    
+    day = Column(Date, primary_key=True)
+    plan = Column(String(16), primary_key=True)
+    users = Column(Integer, nullable=False, default=0)
+
+class RevenueDaily(Base):
+    __tablename__ = 'revenue_daily'
+    
+    day = Column(Date, primary_key=True)
+    currency = Column(SQLEnum(CurrencyType), primary_key=True)
+    payments = Column(Integer, nullable=False, default=0)
+    amount = Column(DECIMAL(14, 2), nullable=False, default=0)
+
+class RollupWatermark(Base):
+    __tablename__ = 'rollup_watermarks'
+    
+    # Everything before position has been folded into the rollup
+    name = Column(String(32), primary_key=True)
+    position = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
 class Subscription(Base):
     __tablename__ = 'subscriptions'
     
@@ -73,4 +162,5 @@ class Payment(Base):
     user = relationship("User", back_populates="payments")
 
 Index('idx_message_history_user_created', MessageHistory.user_id, MessageHistory.created_at)
-Index('idx_subscriptions_active', Subscription.user_id, Subscription.end_date)
\ No newline at end of file
+Index('idx_subscriptions_active', Subscription.user_id, Subscription.end_date)
+Index('idx_payments_payment_date', Payment.payment_date)
\ No newline at end of file
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime, date
-from typing import Optional
+from typing import List, Optional
 from .enums import AIProviderType, SubscriptionPlanType,CurrencyType
 
 class UserBase(BaseModel):
@@ -40,6 +40,69 @@ class MessageResponse(MessageBase):
     class Config:
         from_attributes = True
 
+class HistoryItem(BaseModel):
+    id: int
+    created_at: datetime
+    ai_provider: AIProviderType
+    ai_model: str
+    user_message: str
+    ai_response: str
+    truncated: bool = Field(False, description="user_message or ai_response was cut to the preview length")
+
+class HistoryPage(BaseModel):
+    items: List[HistoryItem]
+    next_cursor: Optional[str] = Field(None, description="Pass as cursor to get older messages; null on the last page")
+
+class CreditCampaignRequest(BaseModel):
+    campaign_id: str = Field(..., min_length=1, max_length=64, description="Users are credited at most once per campaign")
+    amount: int = Field(..., gt=0)
+    telegram_ids: Optional[List[int]] = Field(None, description="Users to credit; if omitted, the filters below select them")
+    active_since: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    plan: Optional[SubscriptionPlanType] = None
+    is_vip: Optional[bool] = None
+    all_users: bool = Field(False, description="Required to credit every user when no ids or filters are given")
+
+class CreditCampaignReport(BaseModel):
+    campaign_id: str
+    amount: int
+    targeted: int
+    granted: int
+    skipped: int = Field(..., description="Unknown users and users already credited by this campaign")
+    chunks: int
+    seconds: float
+
+class UsageRollupRow(BaseModel):
+    day: date
+    ai_provider: AIProviderType
+    ai_model: str
+    plan: str = Field(..., description="trial, premium or free")
+    messages: int
+    user_tokens: int
+    response_tokens: int
+
+class UsageReport(BaseModel):
+    as_of: Optional[datetime] = Field(None, description="Messages created before this time (UTC) are counted")
+    rows: List[UsageRollupRow]
+
+class ActiveUsersRollupRow(BaseModel):
+    day: date
+    plan: str = Field(..., description="trial, premium or free")
+    users: int
+
+class ActiveUsersReport(BaseModel):
+    rows: List[ActiveUsersRollupRow]
+
+class RevenueRollupRow(BaseModel):
+    day: date
+    currency: CurrencyType
+    payments: int
+    amount: float
+
+class RevenueReport(BaseModel):
+    as_of: Optional[datetime] = Field(None, description="Time (UTC) of the last recount")
+    rows: List[RevenueRollupRow]
+
 class SubscriptionBase(BaseModel):
     plan: SubscriptionPlanType
     start_date: date
@@ -102,4 +165,23 @@ class UserStatusResponse(BaseModel):
     trial_messages_left: int
     has_active_subscription: bool
     subscription_end_date: Optional[date] = None
-    active_plan: Optional[SubscriptionPlanType] = None
\ No newline at end of file
+    active_plan: Optional[SubscriptionPlanType] = None
+
+class RegisterRequest(BaseModel):
+    telegram_id: str
+
+class UserProfile(BaseModel):
+    telegram_id: str
+    credits: int
+    is_vip: bool = False
+    is_trial_active: bool
+    trial_remaining: int = Field(0, description="Days left in the trial plan")
+
+class ProcessMessageRequest(BaseModel):
+    telegram_id: str
+    text: str
+    model_code: Optional[str] = None
+
+class ProcessMessageResponse(BaseModel):
+    reply: str
+    remaining_credits: int
@@ -0,0 +1,277 @@
+"""
+Provider adapters for AIService.
+
+An adapter knows how to talk to one kind of backend: complete() returns a
+whole reply, stream() yields it in chunks. AdapterRegistry maps an
+AIProviderType (and optionally a specific model code) to the adapter that
+serves it, so new providers or a mock can be plugged in without touching
+AIService.
+"""
+
+import json
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import openai
+
+from ..models.enums import AIProviderType
+from .mock_llm import MockProfile, mock_stream
+from .rate_limiter import ProviderLimiter, ProviderRateLimited
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+PERPLEXITY_SYSTEM_PROMPT = "You are a helpful assistant. Be precise and concise."
+EMPTY_RESPONSE_TEXT = "I received your message but couldn't generate a response. Please try again."
+MAX_TOKENS = 1000
+
+
+class ProviderAdapter:
+    name = "AI provider"
+
+    def __init__(self, system_prompt: str = DEFAULT_SYSTEM_PROMPT, limiter: Optional[ProviderLimiter] = None):
+        self.system_prompt = system_prompt
+        self.limiter = limiter
+
+    def messages(self, message: str, context: Optional[List[dict]] = None) -> List[dict]:
+        """System prompt, earlier conversation turns (if any), then the new message"""
+        return [
+            {"role": "system", "content": self.system_prompt},
+            *(context or []),
+            {"role": "user", "content": message}
+        ]
+
+    async def complete(self, message: str, model: str, context: Optional[List[dict]] = None) -> str:
+        raise NotImplementedError
+
+    async def stream(self, message: str, model: str, context: Optional[List[dict]] = None) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield
+
+    def update_limits(self, headers, status_code: int = 200) -> None:
+        if self.limiter is not None:
+            self.limiter.update_from_headers(headers, status_code)
+
+    def rate_limited(self, response: httpx.Response) -> ProviderRateLimited:
+        """Pause the provider's limiter per the 429 headers and build the error to raise"""
+        self.update_limits(response.headers, 429)
+        retry_after = self.limiter.retry_delay() if self.limiter is not None else None
+        return ProviderRateLimited(f"{self.name} API error: 429", retry_after)
+
+
+class ChatGPTAdapter(ProviderAdapter):
+    """OpenAI through the official SDK"""
+
+    name = "ChatGPT"
+
+    def __init__(
+        self,
+        get_client: Callable[[], Optional[openai.AsyncOpenAI]],
+        limiter: Optional[ProviderLimiter] = None,
+        system_prompt: str = DEFAULT_SYSTEM_PROMPT
+    ):
+        super().__init__(system_prompt, limiter)
+        self._get_client = get_client
+
+    def _client(self) -> openai.AsyncOpenAI:
+        client = self._get_client()
+        if not client:
+            raise Exception("OpenAI API key not configured")
+        return client
+
+    async def complete(self, message: str, model: str, context: Optional[List[dict]] = None) -> str:
+        try:
+            raw = await self._client().chat.completions.with_raw_response.create(
+                model=model,
+                messages=self.messages(message, context),
+                max_tokens=MAX_TOKENS,
+                temperature=0.7
+            )
+            self.update_limits(raw.headers)
+            response = raw.parse()
+
+            content = response.choices[0].message.content
+            if content is None:
+                logger.warning("ChatGPT returned empty content")
+                return EMPTY_RESPONSE_TEXT
+
+            return content
+
+        except openai.RateLimitError as e:
+            raise self.rate_limited(e.response)
+        except Exception as e:
+            logger.error(f"ChatGPT error: {e}")
+            raise Exception(f"ChatGPT processing failed: {str(e)}")
+
+    async def stream(self, message: str, model: str, context: Optional[List[dict]] = None) -> AsyncIterator[str]:
+        try:
+            stream = await self._client().chat.completions.create(
+                model=model,
+                messages=self.messages(message, context),
+                max_tokens=MAX_TOKENS,
+                temperature=0.7,
+                stream=True
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        except openai.RateLimitError as e:
+            raise self.rate_limited(e.response)
+        except Exception as e:
+            logger.error(f"ChatGPT stream error: {e}")
+            raise Exception(f"ChatGPT streaming failed: {str(e)}")
+
+
+class OpenAICompatibleAdapter(ProviderAdapter):
+    """Any /chat/completions API (DeepSeek, Perplexity, the fake LLM server) over plain HTTP"""
+
+    def __init__(
+        self,
+        name: str,
+        api_key: Optional[str],
+        get_client: Callable[[], httpx.AsyncClient],
+        limiter: Optional[ProviderLimiter] = None,
+        system_prompt: str = DEFAULT_SYSTEM_PROMPT
+    ):
+        super().__init__(system_prompt, limiter)
+        self.name = name
+        self.api_key = api_key
+        self._get_client = get_client
+
+    def _payload(self, message: str, model: str, context: Optional[List[dict]], stream: bool = False) -> dict:
+        payload = {
+            "model": model,
+            "messages": self.messages(message, context),
+            "max_tokens": MAX_TOKENS,
+            "temperature": 0.7
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    async def complete(self, message: str, model: str, context: Optional[List[dict]] = None) -> str:
+        try:
+            if not self.api_key:
+                raise Exception(f"{self.name} API key not configured")
+
+            response = await self._get_client().post("/chat/completions", json=self._payload(message, model, context))
+
+            if response.status_code == 429:
+                raise self.rate_limited(response)
+            self.update_limits(response.headers)
+
+            if response.status_code == 200:
+                data = response.json()
+                content = data["choices"][0]["message"]["content"]
+
+                if content is None:
+                    logger.warning(f"{self.name} returned empty content")
+                    return EMPTY_RESPONSE_TEXT
+
+                return content
+            else:
+                error_msg = f"{self.name} API error: {response.status_code} - {response.text}"
+                logger.error(error_msg)
+                raise Exception(error_msg)
+
+        except ProviderRateLimited:
+            raise
+        except Exception as e:
+            logger.error(f"{self.name} error: {e}")
+            raise Exception(f"{self.name} processing failed: {str(e)}")
+
+    async def stream(self, message: str, model: str, context: Optional[List[dict]] = None) -> AsyncIterator[str]:
+        try:
+            if not self.api_key:
+                raise Exception(f"{self.name} API key not configured")
+
+            async with self._get_client().stream(
+                "POST",
+                "/chat/completions",
+                json=self._payload(message, model, context, stream=True),
+            ) as response:
+                if response.status_code == 429:
+                    raise self.rate_limited(response)
+                self.update_limits(response.headers)
+                if response.status_code != 200:
+                    body = (await response.aread()).decode(errors="replace")
+                    raise Exception(f"{self.name} API error: {response.status_code} - {body}")
+
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = json.loads(data).get("choices") or []
+                    content = choices[0].get("delta", {}).get("content") if choices else None
+                    if content:
+                        yield content
+
+        except ProviderRateLimited:
+            raise
+        except Exception as e:
+            logger.error(f"{self.name} stream error: {e}")
+            raise Exception(f"{self.name} streaming failed: {str(e)}")
+
+
+class MockAdapter(ProviderAdapter):
+    """Answers locally per a MockProfile; no network, no API keys"""
+
+    name = "Mock"
+
+    def __init__(self, profile: Optional[MockProfile] = None, system_prompt: str = DEFAULT_SYSTEM_PROMPT):
+        super().__init__(system_prompt)
+        self.profile = profile or MockProfile()
+        self.calls = 0
+
+    def _maybe_fail(self) -> None:
+        status = self.profile.sample_error()
+        if status == 429:
+            raise ProviderRateLimited(f"{self.name} API error: 429", 1.0)
+        if status:
+            raise Exception(f"{self.name} API error: {status} - injected failure")
+
+    async def complete(self, message: str, model: str, context: Optional[List[dict]] = None) -> str:
+        self.calls += 1
+        self._maybe_fail()
+        return "".join([token async for token in mock_stream(self.profile, message, model)]).strip()
+
+    async def stream(self, message: str, model: str, context: Optional[List[dict]] = None) -> AsyncIterator[str]:
+        self.calls += 1
+        self._maybe_fail()
+        async for token in mock_stream(self.profile, message, model):
+            yield token
+
+
+class AdapterRegistry:
+    """
+    Adapters by provider, with optional per-model-code overrides.
+    A model-code registration wins over the provider-wide one.
+    """
+
+    def __init__(self):
+        self._by_provider: Dict[AIProviderType, ProviderAdapter] = {}
+        self._by_model_code: Dict[str, Tuple[AIProviderType, ProviderAdapter]] = {}
+
+    def register(self, provider: AIProviderType, adapter: ProviderAdapter, model_code: Optional[str] = None) -> None:
+        if model_code:
+            self._by_model_code[model_code] = (provider, adapter)
+        else:
+            self._by_provider[provider] = adapter
+
+    def get(self, provider: AIProviderType, model_code: Optional[str] = None) -> ProviderAdapter:
+        override = self._by_model_code.get(model_code) if model_code else None
+        if override and override[0] == provider:
+            return override[1]
+        try:
+            return self._by_provider[provider]
+        except KeyError:
+            raise ValueError(f"Unsupported AI provider: {provider}")
+
+    def stats(self) -> dict:
+        adapters = {provider.value: adapter.name for provider, adapter in self._by_provider.items()}
+        adapters.update({code: adapter.name for code, (_, adapter) in self._by_model_code.items()})
+        return adapters
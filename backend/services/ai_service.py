@@ -1,19 +1,270 @@
+import json
+import time
 import httpx
 import openai
+from collections import Counter
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from ..config import settings
 from ..models.enums import AIProviderType
+from .response_cache import ResponseCache, InMemoryCacheStore, RedisCacheStore
+from .single_flight import SingleFlight
+from .rate_limiter import ProviderLimiter, ProviderRateLimited, RateLimitExceeded
+from .circuit_breaker import CircuitBreaker, CircuitOpen
+from .hedging import HedgeBudget, LatencyTracker, race
+from .adapters import (
+    AdapterRegistry, ChatGPTAdapter, MockAdapter, OpenAICompatibleAdapter, ProviderAdapter,
+    PERPLEXITY_SYSTEM_PROMPT, EMPTY_RESPONSE_TEXT, MAX_TOKENS,
+)
+from .mock_llm import MockProfile
 import logging
 
 logger = logging.getLogger(__name__)
 
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+DEEPSEEK_BASE_URL = "https://api.deepseek.com/v1"
+PERPLEXITY_BASE_URL = "https://api.perplexity.ai"
+
+# Bot model codes -> (provider, upstream model name)
+MODEL_CATALOG: Dict[str, Tuple[AIProviderType, str]] = {
+    "chatgpt_instant": (AIProviderType.CHATGPT, "gpt-4o-mini"),
+    "chatgpt_thinking": (AIProviderType.CHATGPT, "o3-mini"),
+    "chatgpt_gpt5": (AIProviderType.CHATGPT, "gpt-5"),
+    "deepseek_default": (AIProviderType.DEEPSEEK, "deepseek-chat"),
+    "deepseek_thinking": (AIProviderType.DEEPSEEK, "deepseek-reasoner"),
+    "perplexity_search": (AIProviderType.PERPLEXITY, "sonar"),
+    "perplexity_research": (AIProviderType.PERPLEXITY, "sonar-deep-research"),
+    "perplexity_labs": (AIProviderType.PERPLEXITY, "sonar-reasoning-pro"),
+}
+DEFAULT_MODEL_CODE = "chatgpt_gpt5"
+
+
+def resolve_model(model_code: Optional[str]) -> Tuple[AIProviderType, str]:
+    """Map a bot model code to provider and upstream model, falling back to the default"""
+    return MODEL_CATALOG.get(model_code or DEFAULT_MODEL_CODE, MODEL_CATALOG[DEFAULT_MODEL_CODE])
+
+
+def model_code_for(provider: AIProviderType, model: str) -> Optional[str]:
+    """Reverse of resolve_model: the bot model code for a provider/model, if any"""
+    for code, target in MODEL_CATALOG.items():
+        if target == (provider, model):
+            return code
+    return None
+
+
+def fallback_for(provider: AIProviderType, model: str) -> Optional[Tuple[AIProviderType, str]]:
+    """Fallback target configured in AI_FALLBACK_MODELS for a provider/model, if any"""
+    fallback_code = settings.AI_FALLBACK_MODELS.get(model_code_for(provider, model))
+    return MODEL_CATALOG.get(fallback_code) if fallback_code else None
+
+
+def hedge_target_for(provider: AIProviderType, model: str) -> Optional[Tuple[AIProviderType, str]]:
+    """Where to send a hedged duplicate, if hedging is enabled for the model in AI_HEDGE_MODELS"""
+    code = model_code_for(provider, model)
+    if code not in settings.AI_HEDGE_MODELS:
+        return None
+    return MODEL_CATALOG.get(settings.AI_HEDGE_MODELS[code], (provider, model))
+
+
+@dataclass
+class AIReply:
+    text: str
+    provider: AIProviderType
+    model: str
+    cached: bool = False
+    shared: bool = False
+
+
+def build_response_cache() -> ResponseCache:
+    """Create the response cache configured in settings"""
+    if settings.AI_CACHE_REDIS_URL:
+        store = RedisCacheStore.from_url(settings.AI_CACHE_REDIS_URL)
+    else:
+        store = InMemoryCacheStore(max_size=settings.AI_CACHE_MAX_SIZE)
+    return ResponseCache(
+        store,
+        ttl=settings.AI_CACHE_TTL,
+        enabled=settings.AI_CACHE_ENABLED,
+        bypass_models=settings.AI_CACHE_BYPASS_MODELS,
+    )
+
+
+def build_breaker(name: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        window_seconds=settings.AI_BREAKER_WINDOW_SECONDS,
+        min_calls=settings.AI_BREAKER_MIN_CALLS,
+        failure_rate=settings.AI_BREAKER_FAILURE_RATE,
+        slow_call_seconds=settings.AI_BREAKER_SLOW_CALL_SECONDS,
+        open_seconds=settings.AI_BREAKER_OPEN_SECONDS,
+    )
+
+
+def build_limiter(provider: AIProviderType) -> ProviderLimiter:
+    """Create the rate limiter for provider from defaults and AI_PROVIDER_LIMITS overrides"""
+    limits = settings.AI_PROVIDER_LIMITS.get(provider.value, {})
+    return ProviderLimiter(
+        provider.value,
+        max_concurrency=int(limits.get("max_concurrency", settings.AI_MAX_CONCURRENCY)),
+        requests_per_minute=limits.get("requests_per_minute", settings.AI_REQUESTS_PER_MINUTE),
+        tokens_per_minute=limits.get("tokens_per_minute", settings.AI_TOKENS_PER_MINUTE),
+        max_wait=limits.get("max_wait", settings.AI_RATE_LIMIT_MAX_WAIT),
+    )
+
+
+def estimate_tokens(message: str, context: Optional[List[dict]] = None) -> int:
+    """Rough upper bound of tokens a request consumes from the TPM budget"""
+    prompt_chars = len(message) + sum(len(turn["content"]) for turn in context or [])
+    return prompt_chars // 4 + MAX_TOKENS
+
+
+def build_http_client(base_url: str = "", api_key: Optional[str] = None) -> httpx.AsyncClient:
+    """Create a long-lived pooled client for one AI provider"""
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+
+    return httpx.AsyncClient(
+        base_url=base_url,
+        headers=headers,
+        http2=settings.AI_HTTP2,
+        limits=httpx.Limits(
+            max_connections=settings.AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.AI_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.AI_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(settings.AI_HTTP_TIMEOUT, connect=settings.AI_HTTP_CONNECT_TIMEOUT),
+    )
+
+
 class AIService:
     def __init__(self):
-        if settings.OPENAI_API_KEY:
-            self.openai_client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
-        else:
-            self.openai_client = None
+        if not settings.OPENAI_API_KEY:
             logger.warning("OpenAI API key not configured")
-        
+
+        self._http_clients: Dict[AIProviderType, httpx.AsyncClient] = {}
+        self.openai_client: Optional[openai.AsyncOpenAI] = None
+        self._openai_http_client: Optional[httpx.AsyncClient] = None
+        self.cache = build_response_cache()
+        self.single_flight = SingleFlight()
+        self.upstream_calls: Counter = Counter()
+        self.limiters: Dict[AIProviderType, ProviderLimiter] = {
+            provider: build_limiter(provider) for provider in AIProviderType
+        }
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.failovers = 0
+        self.latency = LatencyTracker(settings.AI_LATENCY_WINDOW, settings.AI_HEDGE_MIN_SAMPLES)
+        self.hedge_budget = HedgeBudget(settings.AI_HEDGE_MAX_RATIO, settings.AI_LATENCY_WINDOW)
+        self.hedge_wins = 0
+        self.adapters = AdapterRegistry()
+        self._register_default_adapters()
+
+    async def startup(self) -> None:
+        """Open pooled HTTP clients so the first request does not pay the handshake"""
+        self._get_http_client(AIProviderType.CHATGPT)
+        self._get_http_client(AIProviderType.DEEPSEEK)
+        self._get_http_client(AIProviderType.PERPLEXITY)
+        logger.info("AI provider HTTP clients opened (http2=%s)", settings.AI_HTTP2)
+
+    async def shutdown(self) -> None:
+        """Close pooled HTTP clients and release their sockets"""
+        clients = list(self._http_clients.values())
+        self._http_clients.clear()
+        self.openai_client = None
+        for client in clients:
+            await client.aclose()
+        logger.info("AI provider HTTP clients closed")
+
+    def _get_http_client(self, provider: AIProviderType) -> httpx.AsyncClient:
+        """Return the shared client for provider, creating it on first use"""
+        client = self._http_clients.get(provider)
+        if client is None or client.is_closed:
+            if provider == AIProviderType.CHATGPT:
+                # The OpenAI SDK sets its own base URL and auth headers
+                client = build_http_client()
+            elif provider == AIProviderType.DEEPSEEK:
+                client = build_http_client(settings.DEEPSEEK_BASE_URL or DEEPSEEK_BASE_URL, settings.DEEPSEEK_API_KEY)
+            elif provider == AIProviderType.PERPLEXITY:
+                client = build_http_client(settings.PERPLEXITY_BASE_URL or PERPLEXITY_BASE_URL,
+                                           settings.PERPLEXITY_API_KEY)
+            else:
+                raise ValueError(f"No HTTP client for AI provider: {provider}")
+            self._http_clients[provider] = client
+        return client
+
+    def _get_openai_client(self) -> Optional[openai.AsyncOpenAI]:
+        """Return the async OpenAI client bound to the shared ChatGPT connection pool"""
+        if not settings.OPENAI_API_KEY:
+            return None
+
+        http_client = self._get_http_client(AIProviderType.CHATGPT)
+        if self.openai_client is None or self._openai_http_client is not http_client:
+            self.openai_client = openai.AsyncOpenAI(
+                api_key=settings.OPENAI_API_KEY,
+                base_url=settings.OPENAI_BASE_URL or OPENAI_BASE_URL,
+                timeout=settings.AI_HTTP_TIMEOUT,
+                http_client=http_client,
+            )
+            self._openai_http_client = http_client
+        return self.openai_client
+
+    def _register_default_adapters(self) -> None:
+        """Real provider adapters, or the mock adapter for every provider when AI_MOCK_MODE is on"""
+        if settings.AI_MOCK_MODE:
+            mock = MockAdapter(MockProfile(
+                latency_ms=settings.AI_MOCK_LATENCY_MS,
+                latency_jitter_ms=settings.AI_MOCK_LATENCY_JITTER_MS,
+                latency_distribution=settings.AI_MOCK_LATENCY_DISTRIBUTION,
+                tokens_per_second=settings.AI_MOCK_TOKENS_PER_SECOND,
+                error_rate=settings.AI_MOCK_ERROR_RATE,
+            ))
+            for provider in AIProviderType:
+                self.adapters.register(provider, mock)
+            logger.warning("AI_MOCK_MODE is on, AI providers are not called")
+            return
+
+        self.adapters.register(AIProviderType.CHATGPT, ChatGPTAdapter(
+            self._get_openai_client, self.limiters[AIProviderType.CHATGPT]
+        ))
+        self.adapters.register(AIProviderType.DEEPSEEK, OpenAICompatibleAdapter(
+            "DeepSeek", settings.DEEPSEEK_API_KEY,
+            lambda: self._get_http_client(AIProviderType.DEEPSEEK),
+            self.limiters[AIProviderType.DEEPSEEK],
+        ))
+        self.adapters.register(AIProviderType.PERPLEXITY, OpenAICompatibleAdapter(
+            "Perplexity", settings.PERPLEXITY_API_KEY,
+            lambda: self._get_http_client(AIProviderType.PERPLEXITY),
+            self.limiters[AIProviderType.PERPLEXITY],
+            system_prompt=PERPLEXITY_SYSTEM_PROMPT,
+        ))
+
+    def adapter_for(self, provider: AIProviderType, model: str) -> ProviderAdapter:
+        return self.adapters.get(provider, model_code_for(provider, model))
+
+    def system_prompt_for(self, provider: AIProviderType, model: str) -> str:
+        return self.adapter_for(provider, model).system_prompt
+
+    def _cache_prompt(self, provider: AIProviderType, model: str, context: Optional[List[dict]]) -> str:
+        """Everything besides the message that shapes the reply: system prompt and replayed turns"""
+        prompt = self.system_prompt_for(provider, model)
+        if context:
+            prompt += "\x1e" + json.dumps(context, ensure_ascii=False)
+        return prompt
+
+    def stats(self) -> dict:
+        return {
+            "cache": self.cache.stats(),
+            "single_flight": self.single_flight.stats(),
+            "upstream_calls": {f"{provider.value}/{model}": count
+                               for (provider, model), count in self.upstream_calls.items()},
+            "rate_limits": {provider.value: limiter.stats() for provider, limiter in self.limiters.items()},
+            "breakers": {name: breaker.stats() for name, breaker in self.breakers.items()},
+            "failovers": self.failovers,
+            "latency": self.latency.stats(),
+            "hedging": dict(self.hedge_budget.stats(), backup_wins=self.hedge_wins),
+            "adapters": self.adapters.stats(),
+        }
+
     async def process_message(
         self, 
         message: str, 
@@ -21,127 +272,229 @@ class AIService:
         model: str = "gpt-3.5-turbo"
     ) -> str:
         """Process message through selected AI provider. Returns AI response as string."""
-        
-        if provider == AIProviderType.CHATGPT:
-            return await self._process_chatgpt(message, model)
-        elif provider == AIProviderType.DEEPSEEK:
-            return await self._process_deepseek(message, model)
-        elif provider == AIProviderType.PERPLEXITY:
-            return await self._process_perplexity(message, model)
-        else:
-            raise ValueError(f"Unsupported AI provider: {provider}")
-    
-    async def _process_chatgpt(self, message: str, model: str) -> str:
-        """Process message using OpenAI ChatGPT"""
-        try:
-            if not self.openai_client:
-                raise Exception("OpenAI API key not configured")
-            
-            response = self.openai_client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": message}
-                ],
-                max_tokens=1000,
-                temperature=0.7
-            )
-            
-            content = response.choices[0].message.content
-            if content is None:
-                logger.warning("ChatGPT returned empty content")
-                return "I received your message but couldn't generate a response. Please try again."
-            
-            return content
-            
-        except Exception as e:
-            logger.error(f"ChatGPT error: {e}")
-            raise Exception(f"ChatGPT processing failed: {str(e)}")
-    
-    async def _process_deepseek(self, message: str, model: str) -> str:
-        """Process message using DeepSeek API"""
+        reply = await self.generate(message, provider, model)
+        return reply.text
+
+    async def generate(
+        self,
+        message: str,
+        provider: AIProviderType = AIProviderType.CHATGPT,
+        model: str = "gpt-3.5-turbo",
+        context: Optional[List[dict]] = None
+    ) -> AIReply:
+        """
+        Answer from the response cache if possible, otherwise call the provider and cache the reply.
+        Identical concurrent requests share a single upstream call.
+        context holds earlier conversation turns as chat messages (see services.conversation).
+        """
+        cached = await self.cache_lookup(message, provider, model, context)
+        if cached is not None:
+            return AIReply(cached, provider, model, cached=True)
+
+        provider, model = self.route(provider, model)
+
+        async def call() -> Tuple[str, AIProviderType, str]:
+            text, used_provider, used_model = await self._call_hedged(message, provider, model, context)
+            await self._cache_store(message, used_provider, used_model, text, context)
+            return text, used_provider, used_model
+
+        if not settings.AI_SINGLE_FLIGHT_ENABLED:
+            return AIReply(*await call())
+
+        key = self.cache.make_key(provider, model, self._cache_prompt(provider, model, context), message)
+        (text, used_provider, used_model), shared = await self.single_flight.do(key, call)
+        return AIReply(text, used_provider, used_model, shared=shared)
+
+    def _breakers_for(self, provider: AIProviderType, model: str) -> Tuple[CircuitBreaker, CircuitBreaker]:
+        """Provider-wide and per-model breakers; a call needs both to be closed"""
+        breakers = []
+        for name in (provider.value, f"{provider.value}/{model}"):
+            if name not in self.breakers:
+                self.breakers[name] = build_breaker(name)
+            breakers.append(self.breakers[name])
+        return breakers[0], breakers[1]
+
+    def route(self, provider: AIProviderType, model: str) -> Tuple[AIProviderType, str]:
+        """
+        Pick the target for a request: the requested model, or its configured
+        fallback while the requested model's circuit is open.
+        Raises CircuitOpen when neither is available.
+        """
+        if self._available(provider, model):
+            return provider, model
+
+        fallback = fallback_for(provider, model)
+        if fallback and self._available(*fallback):
+            self.failovers += 1
+            logger.warning(f"Circuit open for {provider.value}/{model}, rerouting to {fallback[0].value}/{fallback[1]}")
+            return fallback
+
+        raise CircuitOpen(f"Circuit open for {provider.value}/{model}")
+
+    def _available(self, provider: AIProviderType, model: str) -> bool:
+        return all(breaker.available() for breaker in self._breakers_for(provider, model))
+
+    def _admit(self, provider: AIProviderType, model: str) -> None:
+        """
+        Let one upstream call through both breakers, taking a half-open probe
+        only once both agree. Raises CircuitOpen otherwise.
+        """
+        breakers = self._breakers_for(provider, model)
+        if not all(breaker.available() for breaker in breakers):
+            raise CircuitOpen(f"Circuit open for {provider.value}/{model}")
+        for breaker in breakers:
+            breaker.allow()
+
+    def _record_outcome(self, provider: AIProviderType, model: str, latency: Optional[float]) -> None:
+        """Feed a call result to the breakers; latency None means the call failed"""
+        for breaker in self._breakers_for(provider, model):
+            if latency is None:
+                breaker.record_failure()
+            else:
+                breaker.record_success(latency)
+
+    async def _call_hedged(
+        self,
+        message: str,
+        provider: AIProviderType,
+        model: str,
+        context: Optional[List[dict]] = None
+    ) -> Tuple[str, AIProviderType, str]:
+        """
+        Call provider; for models in AI_HEDGE_MODELS, start a duplicate request once the
+        call outlives the AI_HEDGE_PERCENTILE of recent latency. The first answer wins.
+        """
+        target = hedge_target_for(provider, model)
+        delay = self.latency.percentile(f"{provider.value}/{model}", settings.AI_HEDGE_PERCENTILE) if target else None
+        if delay is None:
+            return await self._call_guarded(message, provider, model, context), provider, model
+
+        def may_hedge() -> bool:
+            # The backup's own _call_guarded takes the breakers' probes
+            return self._available(*target) and self.hedge_budget.allow()
+
+        text, backup_won = await race(
+            lambda: self._call_guarded(message, provider, model, context),
+            lambda: self._call_guarded(message, *target, context),
+            delay,
+            may_hedge,
+        )
+        self.hedge_budget.record(backup_won is not None)
+        if backup_won:
+            self.hedge_wins += 1
+            return text, target[0], target[1]
+        return text, provider, model
+
+    async def _call_guarded(
+        self,
+        message: str,
+        provider: AIProviderType,
+        model: str,
+        context: Optional[List[dict]] = None
+    ) -> str:
+        """Call provider and report the outcome to its circuit breakers"""
+        self._admit(provider, model)
+        started = time.monotonic()
         try:
-            if not settings.DEEPSEEK_API_KEY:
-                raise Exception("DeepSeek API key not configured")
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.deepseek.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {settings.DEEPSEEK_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": model,
-                        "messages": [
-                            {"role": "system", "content": "You are a helpful assistant."},
-                            {"role": "user", "content": message}
-                        ],
-                        "max_tokens": 1000,
-                        "temperature": 0.7
-                    },
-                    timeout=30.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    content = data["choices"][0]["message"]["content"]
-                    
-                    if content is None:
-                        logger.warning("DeepSeek returned empty content")
-                        return "I received your message but couldn't generate a response. Please try again."
-                    
-                    return content
-                else:
-                    error_msg = f"DeepSeek API error: {response.status_code} - {response.text}"
-                    logger.error(error_msg)
-                    raise Exception(error_msg)
-                    
-        except Exception as e:
-            logger.error(f"DeepSeek error: {e}")
-            raise Exception(f"DeepSeek processing failed: {str(e)}")
-    
-    async def _process_perplexity(self, message: str, model: str) -> str:
-        """Process message using Perplexity API"""
+            text = await self._call_provider(message, provider, model, context)
+        except (RateLimitExceeded, ProviderRateLimited):
+            # Throttling is not a sign the provider is down
+            raise
+        except Exception:
+            self._record_outcome(provider, model, None)
+            raise
+        latency = time.monotonic() - started
+        self._record_outcome(provider, model, latency)
+        self.latency.record(f"{provider.value}/{model}", latency)
+        return text
+
+    async def cache_lookup(
+        self,
+        message: str,
+        provider: AIProviderType,
+        model: str,
+        context: Optional[List[dict]] = None
+    ) -> Optional[str]:
+        return await self.cache.get(provider, model, self._cache_prompt(provider, model, context), message)
+
+    async def _cache_store(
+        self,
+        message: str,
+        provider: AIProviderType,
+        model: str,
+        text: str,
+        context: Optional[List[dict]] = None
+    ) -> None:
+        if text and text != EMPTY_RESPONSE_TEXT:
+            await self.cache.set(provider, model, self._cache_prompt(provider, model, context), message, text)
+
+    async def _call_provider(
+        self,
+        message: str,
+        provider: AIProviderType,
+        model: str,
+        context: Optional[List[dict]] = None
+    ) -> str:
+        """Call provider within its rate limits, waiting out 429s for up to AI_RATE_LIMIT_RETRIES retries"""
+        limiter = self.limiters[provider]
+        for attempt in range(settings.AI_RATE_LIMIT_RETRIES + 1):
+            async with limiter.acquire(estimate_tokens(message, context)):
+                try:
+                    return await self._dispatch(message, provider, model, context)
+                except ProviderRateLimited as e:
+                    if attempt == settings.AI_RATE_LIMIT_RETRIES:
+                        raise
+                    logger.warning(f"{provider.value} returned 429, retrying after {e.retry_after}s")
+
+    async def _dispatch(
+        self,
+        message: str,
+        provider: AIProviderType,
+        model: str,
+        context: Optional[List[dict]] = None
+    ) -> str:
+        adapter = self.adapter_for(provider, model)
+        self.upstream_calls[(provider, model)] += 1
+        return await adapter.complete(message, model, context)
+
+    async def stream_message(
+        self,
+        message: str,
+        provider: AIProviderType = AIProviderType.CHATGPT,
+        model: str = "gpt-3.5-turbo",
+        context: Optional[List[dict]] = None
+    ) -> AsyncIterator[str]:
+        """
+        Process message through selected AI provider. Yields response text chunks as they arrive.
+        Does not read the response cache (see cache_lookup) or reroute (see route),
+        but caches the completed reply and reports the outcome to the circuit breakers.
+        """
+        self._admit(provider, model)
+        chunks = self.adapter_for(provider, model).stream(message, model, context)
+        self.upstream_calls[(provider, model)] += 1
+        parts = []
+        started = time.monotonic()
+        first_chunk_latency = None
         try:
-            if not settings.PERPLEXITY_API_KEY:
-                raise Exception("Perplexity API key not configured")
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.perplexity.ai/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {settings.PERPLEXITY_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": model,
-                        "messages": [
-                            {"role": "system", "content": "You are a helpful assistant. Be precise and concise."},
-                            {"role": "user", "content": message}
-                        ],
-                        "max_tokens": 1000,
-                        "temperature": 0.7
-                    },
-                    timeout=30.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    content = data["choices"][0]["message"]["content"]
-                    
-                    if content is None:
-                        logger.warning("Perplexity returned empty content")
-                        return "I received your message but couldn't generate a response. Please try again."
-                    
-                    return content
-                else:
-                    error_msg = f"Perplexity API error: {response.status_code} - {response.text}"
-                    logger.error(error_msg)
-                    raise Exception(error_msg)
-                    
-        except Exception as e:
-            logger.error(f"Perplexity error: {e}")
-            raise Exception(f"Perplexity processing failed: {str(e)}")
-
-ai_service = AIService()
\ No newline at end of file
+            async with self.limiters[provider].acquire(estimate_tokens(message, context)):
+                async for chunk in chunks:
+                    if first_chunk_latency is None:
+                        first_chunk_latency = time.monotonic() - started
+                    parts.append(chunk)
+                    yield chunk
+        except (RateLimitExceeded, ProviderRateLimited):
+            raise
+        except Exception:
+            self._record_outcome(provider, model, None)
+            raise
+        # Streams are judged by time to first chunk, not total duration
+        self._record_outcome(provider, model, first_chunk_latency or time.monotonic() - started)
+        await self._cache_store(message, provider, model, "".join(parts), context)
+
+
+ai_service = AIService()
+
+
+def get_default_adapter() -> AIService:
+    """The shared AIService; it picks the provider adapter per request from its registry"""
+    return ai_service
\ No newline at end of file
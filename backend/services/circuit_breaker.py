@@ -0,0 +1,112 @@
+"""
+Circuit breakers for AI providers and models.
+
+A breaker watches a rolling window of call outcomes. When enough calls in
+the window failed or were slower than slow_call_seconds, it opens and
+callers fail fast (or reroute) for open_seconds. After that a single probe
+call is let through: success closes the breaker, failure opens it again.
+available() only looks; allow() takes that probe, so it is called just
+before the call is made.
+"""
+
+import time
+from collections import deque
+from typing import Callable, Deque, Tuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """The target's breaker is open and no fallback is available"""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window_seconds: float = 60.0,
+        min_calls: int = 5,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 20.0,
+        open_seconds: float = 30.0,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self._clock = clock
+        # (finished_at, bad) where bad means failed or slower than slow_call_seconds
+        self._calls: Deque[Tuple[float, bool]] = deque()
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self.times_opened = 0
+
+    def available(self) -> bool:
+        """Whether allow() would let a call through now, without taking the half-open probe"""
+        now = self._clock()
+        if self.state == OPEN:
+            return now - self._opened_at >= self.open_seconds
+        if self.state == HALF_OPEN:
+            return not self._probe_started or now - self._probe_started >= self.open_seconds
+        return True
+
+    def allow(self) -> bool:
+        """Whether a call may go through now; in half-open state this takes the probe"""
+        now = self._clock()
+        if self.state == OPEN and now - self._opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self._probe_started = 0.0
+        if self.state == HALF_OPEN:
+            # One probe at a time; a probe that never reports back is replaced after open_seconds
+            if self._probe_started and now - self._probe_started < self.open_seconds:
+                return False
+            self._probe_started = now
+            return True
+        return self.state == CLOSED
+
+    def record_success(self, latency: float) -> None:
+        if self.state == HALF_OPEN:
+            self._close()
+            return
+        self._record(latency > self.slow_call_seconds)
+
+    def record_failure(self) -> None:
+        if self.state == HALF_OPEN:
+            self._open()
+            return
+        self._record(True)
+
+    def _record(self, bad: bool) -> None:
+        now = self._clock()
+        self._calls.append((now, bad))
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            self._calls.popleft()
+
+        if self.state == CLOSED and len(self._calls) >= self.min_calls:
+            bad_calls = sum(1 for _, is_bad in self._calls if is_bad)
+            if bad_calls / len(self._calls) >= self.failure_rate:
+                self._open()
+
+    def _open(self) -> None:
+        self.state = OPEN
+        self._opened_at = self._clock()
+        self.times_opened += 1
+
+    def _close(self) -> None:
+        self.state = CLOSED
+        self._calls.clear()
+
+    def stats(self) -> dict:
+        bad_calls = sum(1 for _, is_bad in self._calls if is_bad)
+        return {
+            "state": self.state,
+            "calls": len(self._calls),
+            "bad_calls": bad_calls,
+            "times_opened": self.times_opened,
+        }
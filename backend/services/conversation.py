@@ -0,0 +1,199 @@
+"""
+Conversation context for AI calls.
+
+Recent turns from message_history are replayed to the provider so that
+follow-up questions make sense. Each model code has a prompt token budget
+(AI_CONTEXT_TOKEN_BUDGETS, default AI_CONTEXT_TOKEN_BUDGET) covering the
+system prompt, the replayed turns and the new message; the oldest turns
+are dropped first when it would be exceeded.
+
+Turns that no longer fit are folded into a rolling per-user summary
+(conversation_summaries) by update_summary, which runs after the reply has
+been sent. The summary is sent ahead of the replayed turns, so prompt size
+stays flat however long the chat gets.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..database import crud
+from ..database.history_writer import history_writer
+from ..database.sharding import route
+from ..models.database import ConversationSummary
+from ..utils.tokens import count_tokens
+from .ai_service import resolve_model
+import logging
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+# Users whose summary is being updated by this process
+_summarizing: Set[int] = set()
+
+
+@dataclass
+class Turn:
+    id: Optional[int]  # None while the turn is still queued in history_writer
+    user_message: str
+    ai_response: str
+    tokens: int
+
+    def as_messages(self) -> List[dict]:
+        return [
+            {"role": "user", "content": self.user_message},
+            {"role": "assistant", "content": self.ai_response},
+        ]
+
+
+def token_budget(model_code: Optional[str]) -> int:
+    return settings.AI_CONTEXT_TOKEN_BUDGETS.get(model_code, settings.AI_CONTEXT_TOKEN_BUDGET)
+
+
+def turn_from_row(row) -> Turn:
+    """Build a Turn from a get_recent_turns row, counting tokens only where history lacks them"""
+    user_message = row.user_message or ""
+    ai_response = row.ai_response or ""
+    user_tokens = row.user_tokens if row.user_tokens is not None else count_tokens(user_message)
+    response_tokens = row.response_tokens if row.response_tokens is not None else count_tokens(ai_response)
+    return Turn(row.id, user_message, ai_response, user_tokens + response_tokens)
+
+
+def fit_to_budget(newest_first: Iterable[Turn], budget: int) -> List[Turn]:
+    """Keep the newest turns whose total fits in budget; returns them oldest first"""
+    kept = []
+    for turn in newest_first:
+        if turn.tokens > budget:
+            break
+        budget -= turn.tokens
+        kept.append(turn)
+    kept.reverse()
+    return kept
+
+
+async def _load_turns(session: AsyncSession, user_id: int, limit: int):
+    """The user's summary (if any) and the newest turns not folded into it, newest first"""
+    summary = await crud.get_conversation_summary(session, user_id) if settings.AI_SUMMARY_ENABLED else None
+    rows = await crud.get_recent_turns(session, user_id, limit, summary.last_message_id if summary else None)
+    queued = [
+        Turn(None, user_message, ai_response, user_tokens + response_tokens)
+        for _, _, _, user_message, ai_response, user_tokens, response_tokens, _ in history_writer.pending_turns(user_id)
+    ]
+    return summary, (queued + [turn_from_row(row) for row in rows])[:limit]
+
+
+async def build_context(
+    session: AsyncSession,
+    user_id: int,
+    model_code: Optional[str],
+    system_prompt: str,
+    message: str
+) -> List[dict]:
+    """Chat messages to send between the system prompt and message, within the model's budget"""
+    if not settings.AI_CONTEXT_ENABLED:
+        return []
+
+    budget = token_budget(model_code) - count_tokens(system_prompt) - count_tokens(message)
+    if budget <= 0:
+        return []
+
+    summary, turns = await _load_turns(session, user_id, settings.AI_CONTEXT_MAX_TURNS)
+    context = []
+    if summary and summary.summary_tokens < budget:
+        budget -= summary.summary_tokens
+        context.append({"role": "system", "content": SUMMARY_PREFIX + summary.summary})
+    for turn in fit_to_budget(turns, budget):
+        context.extend(turn.as_messages())
+    return context
+
+
+def summary_prompt(previous: Optional[str], turns: Sequence[Turn]) -> str:
+    lines = [
+        f"Update the running summary of a chat between a user and an assistant. "
+        f"Keep facts, names, preferences and open questions; drop small talk. "
+        f"Answer with the new summary only, at most {settings.AI_SUMMARY_MAX_WORDS} words.",
+        "",
+        "Current summary:",
+        previous or "(none)",
+        "",
+        "New turns:",
+    ]
+    for turn in turns:
+        lines.append(f"User: {turn.user_message}")
+        lines.append(f"Assistant: {turn.ai_response}")
+    return "\n".join(lines)
+
+
+async def _turns_to_fold(
+    session: AsyncSession,
+    user_id: int,
+    model_code: Optional[str],
+    system_prompt: str
+) -> Tuple[Optional[ConversationSummary], List[Turn]]:
+    """The user's summary and the turns outside model_code's context window not yet folded into it"""
+    summary, turns = await _load_turns(session, user_id, settings.AI_CONTEXT_MAX_TURNS)
+    if not turns:
+        return summary, []
+    # Same window build_context will use, taking the last message as the size of the next one
+    budget = token_budget(model_code) - count_tokens(system_prompt) - count_tokens(turns[0].user_message)
+    if summary:
+        budget -= summary.summary_tokens
+    in_window = [turn.id for turn in fit_to_budget(turns, budget) if turn.id is not None]
+    # Everything older than the window and newer than the summary, oldest first,
+    # so a backlog is folded in order over several calls. Queued turns are the
+    # newest, so they only fall out of a window that is nearly empty
+    rows = await crud.get_unfolded_turns(
+        session,
+        user_id,
+        settings.AI_SUMMARY_MAX_FOLD,
+        after_id=summary.last_message_id if summary else None,
+        before_id=min(in_window) if in_window else None
+    )
+    return summary, [turn_from_row(row) for row in rows]
+
+
+async def update_summary(
+    session_factory: Callable,
+    telegram_id: int,
+    user_id: int,
+    model_code: Optional[str],
+    system_prompt: str,
+    ai
+) -> None:
+    """
+    Fold turns that fell out of model_code's context window into the user's summary.
+    Meant to run after the reply is sent; waits until AI_SUMMARY_MIN_TURNS turns are
+    out of the window so summarization is not paid on every message. Errors are logged only.
+    Reads and the write each use a short session from session_factory, so no
+    connection is held during the summary call.
+    """
+    if not (settings.AI_CONTEXT_ENABLED and settings.AI_SUMMARY_ENABLED) or user_id in _summarizing:
+        return
+
+    _summarizing.add(user_id)
+    try:
+        async with session_factory() as session:
+            await route(session, telegram_id)
+            summary, to_fold = await _turns_to_fold(session, user_id, model_code, system_prompt)
+        if len(to_fold) < settings.AI_SUMMARY_MIN_TURNS:
+            return
+
+        provider, model = resolve_model(settings.AI_SUMMARY_MODEL_CODE)
+        reply = await ai.generate(summary_prompt(summary.summary if summary else None, to_fold), provider, model)
+        async with session_factory() as session:
+            await route(session, telegram_id)
+            await crud.save_conversation_summary(
+                session,
+                user_id,
+                reply.text,
+                count_tokens(reply.text),
+                to_fold[-1].id
+            )
+        logger.info(f"Folded {len(to_fold)} turns into the conversation summary of user {user_id}")
+    except Exception as e:
+        logger.error(f"Conversation summary update failed for user {user_id}: {e}")
+    finally:
+        _summarizing.discard(user_id)
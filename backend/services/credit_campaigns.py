@@ -0,0 +1,129 @@
+"""
+Bulk credit grants (campaigns).
+
+A campaign gives the same amount of credits to a cohort of users, named by
+a list of telegram_ids or selected with a CampaignFilter. Users are
+processed in chunks of CAMPAIGN_CHUNK_SIZE: each chunk is one
+UPDATE ... FROM unnest(...) statement in its own transaction (see
+crud.grant_campaign_credits), so 100k users take a few dozen statements.
+Every grant is recorded per (campaign, user); running a campaign again,
+after a failure or with an overlapping cohort, only credits users who have
+not received it yet.
+"""
+
+import time
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Callable, Iterable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database import crud
+from ..database.sharding import on_every_shard
+from ..models.database import User
+from ..models.enums import SubscriptionPlanType
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CampaignFilter:
+    """Users to credit; fields left as None do not restrict. All None selects every user"""
+    active_since: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    plan: Optional[SubscriptionPlanType] = None
+    is_vip: Optional[bool] = None
+
+    def is_empty(self) -> bool:
+        return all(value is None for value in vars(self).values())
+
+
+@dataclass
+class CampaignReport:
+    campaign_id: str
+    amount: int
+    targeted: int = 0
+    granted: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+
+    @property
+    def skipped(self) -> int:
+        """Unknown users and users the campaign had already credited"""
+        return self.targeted - self.granted
+
+
+def cohort_query(filters: CampaignFilter, after: int, limit: int):
+    """Next limit user ids matching filters, in id order after the id `after`"""
+    stmt = select(User.id).where(User.id > after).order_by(User.id).limit(limit)
+    if filters.active_since is not None:
+        stmt = stmt.where(User.last_active >= filters.active_since)
+    if filters.created_before is not None:
+        stmt = stmt.where(User.created_at < filters.created_before)
+    if filters.plan is not None:
+        stmt = stmt.where(User.plan == filters.plan, User.access_until >= date.today())
+    if filters.is_vip is not None:
+        stmt = stmt.where(User.is_vip.is_(filters.is_vip))
+    return stmt
+
+
+def _dedupe(telegram_ids: Iterable[int]) -> List[int]:
+    return list(dict.fromkeys(telegram_ids))
+
+
+async def run_campaign(
+    session: AsyncSession,
+    campaign_id: str,
+    amount: int,
+    telegram_ids: Optional[Iterable[int]] = None,
+    filters: Optional[CampaignFilter] = None,
+    chunk_size: int = 5000,
+    progress: Optional[Callable[[CampaignReport], None]] = None
+) -> CampaignReport:
+    """
+    Credit amount to every user in telegram_ids, or else to every user
+    matching filters, chunk by chunk. progress is called with the running
+    report after each chunk. ValueError if campaign_id was already run with
+    another amount.
+    """
+    if telegram_ids is None and filters is None:
+        raise ValueError("A campaign needs telegram_ids or filters")
+
+    await crud.get_or_create_campaign(session, campaign_id, amount)
+    report = CampaignReport(campaign_id, amount)
+    started = time.perf_counter()
+
+    async def apply(target_session, keys: List[int], by_telegram_id: bool) -> None:
+        granted = await crud.grant_campaign_credits(target_session, campaign_id, amount, keys, by_telegram_id)
+        report.targeted += len(keys)
+        report.granted += len(granted)
+        report.chunks += 1
+        report.seconds = time.perf_counter() - started
+        if progress is not None:
+            progress(report)
+
+    if telegram_ids is not None:
+        keys = _dedupe(telegram_ids)
+        for start in range(0, len(keys), chunk_size):
+            await apply(session, keys[start:start + chunk_size], by_telegram_id=True)
+    else:
+        # Walked per shard when sharded: user ids are only ordered within one database
+        async def walk(shard_session) -> None:
+            after = 0
+            while True:
+                user_ids = (await shard_session.execute(cohort_query(filters, after, chunk_size))).scalars().all()
+                if not user_ids:
+                    break
+                await apply(shard_session, user_ids, by_telegram_id=False)
+                after = user_ids[-1]
+
+        await on_every_shard(session, walk)
+
+    report.seconds = time.perf_counter() - started
+    logger.info(
+        f"Campaign {campaign_id}: {report.granted} of {report.targeted} users credited with {amount} "
+        f"in {report.chunks} chunks, {report.seconds:.1f}s"
+    )
+    return report
@@ -0,0 +1,97 @@
+"""
+Request hedging for latency-critical models.
+
+LatencyTracker keeps recent per-model latencies. When a call has not
+finished after a chosen percentile of them, a duplicate is started and
+the first successful result wins. HedgeBudget caps the share of calls
+that may be hedged so tail latency drops without doubling cost.
+"""
+
+import asyncio
+import math
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, key: str, latency: float) -> None:
+        self._samples[key].append(latency)
+
+    def percentile(self, key: str, percent: float) -> Optional[float]:
+        """Nearest-rank percentile of recent latencies, None until min_samples are collected"""
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        rank = max(1, math.ceil(percent / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+    def stats(self) -> dict:
+        return {
+            key: {
+                "samples": len(samples),
+                "p50": self.percentile(key, 50),
+                "p90": self.percentile(key, 90),
+                "p99": self.percentile(key, 99),
+            }
+            for key, samples in self._samples.items()
+        }
+
+
+class HedgeBudget:
+    """Allows hedging only while hedged calls stay under max_ratio of recent calls"""
+
+    def __init__(self, max_ratio: float = 0.1, window: int = 200):
+        self.max_ratio = max_ratio
+        self._calls: Deque[bool] = deque(maxlen=window)
+
+    def record(self, hedged: bool) -> None:
+        self._calls.append(hedged)
+
+    def allow(self) -> bool:
+        if not self._calls:
+            return self.max_ratio > 0
+        return (sum(self._calls) + 1) / (len(self._calls) + 1) <= self.max_ratio
+
+    def stats(self) -> dict:
+        return {"calls": len(self._calls), "hedged": sum(self._calls), "max_ratio": self.max_ratio}
+
+
+async def race(
+    primary: Callable[[], Awaitable[T]],
+    backup: Callable[[], Awaitable[T]],
+    delay: float,
+    may_hedge: Callable[[], bool] = lambda: True
+) -> Tuple[T, Optional[bool]]:
+    """
+    Run primary; if it is still running after delay and may_hedge() agrees,
+    start backup as well. Returns the first successful result and whether it
+    came from backup (None when no hedge was started). The slower call is
+    cancelled. If both fail, the primary's error is raised.
+    """
+    primary_task = asyncio.ensure_future(primary())
+    tasks = {primary_task}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not may_hedge():
+            return await primary_task, None
+
+        backup_task = asyncio.ensure_future(backup())
+        tasks.add(backup_task)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), task is backup_task
+        raise primary_task.exception()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
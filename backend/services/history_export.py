@@ -0,0 +1,280 @@
+"""
+Bulk export of message_history.
+
+Rows are read in (created_at, id) order a batch at a time, so memory stays
+flat whatever the table size. export_history streams them with a
+server-side cursor (stream + yield_per) and writes them into numbered chunk files of zstd-compressed
+JSONL or zstd Parquet and records a checkpoint after every finished chunk;
+running it again with the same directory and filters resumes after the
+last exported row. stream_jsonl_zstd feeds the same rows to an HTTP
+response page by page, keyset-paged on (created_at, id) with a short
+session per page, so a slow client holds no connection between pages.
+
+zstandard (JSONL) and pyarrow (Parquet) are imported only when used, so
+the rest of the backend loads without them.
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models.database import MessageHistory
+from ..models.enums import AIProviderType
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+@dataclass
+class ExportFilter:
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    provider: Optional[AIProviderType] = None
+    user_id: Optional[int] = None
+
+    def as_json(self) -> dict:
+        return {
+            key: value.isoformat() if isinstance(value, datetime) else getattr(value, "value", value)
+            for key, value in asdict(self).items()
+        }
+
+
+def history_query(filters: ExportFilter, after: Optional[Tuple[datetime, int]] = None):
+    """Rows matching filters in (created_at, id) order, strictly after the after key"""
+    stmt = select(
+        MessageHistory.id,
+        MessageHistory.user_id,
+        MessageHistory.created_at,
+        MessageHistory.ai_provider,
+        MessageHistory.ai_model,
+        MessageHistory.user_message,
+        MessageHistory.ai_response,
+        MessageHistory.user_tokens,
+        MessageHistory.response_tokens,
+    ).order_by(MessageHistory.created_at, MessageHistory.id)
+    if filters.since is not None:
+        stmt = stmt.where(MessageHistory.created_at >= filters.since)
+    if filters.until is not None:
+        stmt = stmt.where(MessageHistory.created_at < filters.until)
+    if filters.provider is not None:
+        stmt = stmt.where(MessageHistory.ai_provider == filters.provider)
+    if filters.user_id is not None:
+        stmt = stmt.where(MessageHistory.user_id == filters.user_id)
+    if after is not None:
+        stmt = stmt.where(tuple_(MessageHistory.created_at, MessageHistory.id) > tuple_(*after))
+    return stmt
+
+
+def row_to_record(row) -> dict:
+    return {
+        "id": row.id,
+        "user_id": row.user_id,
+        "created_at": row.created_at.isoformat(),
+        "ai_provider": getattr(row.ai_provider, "value", row.ai_provider),
+        "ai_model": row.ai_model,
+        "user_message": row.user_message,
+        "ai_response": row.ai_response,
+        "user_tokens": row.user_tokens,
+        "response_tokens": row.response_tokens,
+    }
+
+
+async def read_page(
+    session: AsyncSession,
+    filters: ExportFilter,
+    after: Optional[Tuple[datetime, int]],
+    limit: int
+) -> Tuple[List[dict], Optional[Tuple[datetime, int]]]:
+    """Up to limit records after the after key, and the key of the last one"""
+    rows = (await session.execute(history_query(filters, after).limit(limit))).all()
+    last = (rows[-1].created_at, rows[-1].id) if rows else None
+    return [row_to_record(row) for row in rows], last
+
+
+async def iter_history(
+    session: AsyncSession,
+    filters: ExportFilter,
+    after: Optional[Tuple[datetime, int]] = None,
+    batch_size: int = 1000
+) -> AsyncIterator[List[dict]]:
+    """Batches of at most batch_size records, fetched from a server-side cursor"""
+    result = await session.stream(history_query(filters, after).execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield [row_to_record(row) for row in rows]
+
+
+class JsonlZstdWriter:
+    extension = "jsonl.zst"
+
+    def __init__(self, path: str, level: int = 3):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError("JSONL export needs the zstandard package") from e
+        self._file = open(path, "wb")
+        self._stream = zstandard.ZstdCompressor(level=level).stream_writer(self._file)
+
+    def write(self, records: List[dict]) -> None:
+        self._stream.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode())
+
+    def close(self) -> None:
+        self._stream.close()
+
+
+class ParquetWriter:
+    extension = "parquet"
+
+    def __init__(self, path: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Parquet export needs the pyarrow package") from e
+        self._pa = pa
+        self._schema = pa.schema([
+            ("id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("created_at", pa.string()),
+            ("ai_provider", pa.string()),
+            ("ai_model", pa.string()),
+            ("user_message", pa.string()),
+            ("ai_response", pa.string()),
+            ("user_tokens", pa.int32()),
+            ("response_tokens", pa.int32()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema, compression="zstd")
+
+    def write(self, records: List[dict]) -> None:
+        # One row group per fetched batch
+        self._writer.write_table(self._pa.Table.from_pylist(records, schema=self._schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+WRITERS = {"jsonl": JsonlZstdWriter, "parquet": ParquetWriter}
+
+
+def _write_json(path: str, data: dict) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(out_dir: str, filters: ExportFilter, fmt: str) -> Optional[dict]:
+    """The checkpoint of an earlier run into out_dir; ValueError if it was for other filters"""
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint["filters"] != filters.as_json() or checkpoint["format"] != fmt:
+        raise ValueError(f"{path} belongs to an export with other filters or format")
+    return checkpoint
+
+
+async def export_history(
+    session: AsyncSession,
+    out_dir: str,
+    filters: ExportFilter,
+    fmt: str = "jsonl",
+    chunk_rows: int = 100000,
+    batch_size: int = 1000
+) -> dict:
+    """
+    Export matching rows into out_dir/history-NNNNN.<ext>, chunk_rows rows per file.
+    A chunk is written under a temporary name and renamed when complete, then
+    the checkpoint is updated, so an interrupted run loses at most one chunk of
+    work and never leaves a partial file. Returns the final checkpoint.
+    """
+    writer_class = WRITERS[fmt]
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint = load_checkpoint(out_dir, filters, fmt) or {
+        "filters": filters.as_json(),
+        "format": fmt,
+        "parts": 0,
+        "rows": 0,
+        "last": None,
+        "done": False,
+    }
+    if checkpoint["done"]:
+        return checkpoint
+
+    after = None
+    if checkpoint["last"]:
+        after = (datetime.fromisoformat(checkpoint["last"]["created_at"]), checkpoint["last"]["id"])
+
+    writer, part_path, part_rows = None, None, 0
+
+    def finish_part():
+        nonlocal writer, part_rows
+        writer.close()
+        os.replace(part_path + ".tmp", part_path)
+        checkpoint["parts"] += 1
+        checkpoint["rows"] += part_rows
+        checkpoint["last"] = {"created_at": last["created_at"], "id": last["id"]}
+        _write_json(os.path.join(out_dir, CHECKPOINT_FILE), checkpoint)
+        logger.info(f"Exported {part_path} ({part_rows} rows, {checkpoint['rows']} total)")
+        writer, part_rows = None, 0
+
+    async for records in iter_history(session, filters, after, batch_size):
+        while records:
+            if writer is None:
+                part_path = os.path.join(out_dir, f"history-{checkpoint['parts']:05d}.{writer_class.extension}")
+                writer = writer_class(part_path + ".tmp")
+            take = records[:chunk_rows - part_rows]
+            records = records[len(take):]
+            writer.write(take)
+            part_rows += len(take)
+            last = take[-1]
+            if part_rows >= chunk_rows:
+                finish_part()
+
+    if writer is not None:
+        finish_part()
+    checkpoint["done"] = True
+    _write_json(os.path.join(out_dir, CHECKPOINT_FILE), checkpoint)
+    return checkpoint
+
+
+def stream_jsonl_zstd(
+    session_factory,
+    filters: ExportFilter,
+    after: Optional[Tuple[datetime, int]] = None,
+    batch_size: int = 1000
+) -> AsyncIterator[bytes]:
+    """
+    One zstd frame of JSONL for a streaming response. Every batch is read in
+    a session of its own, closed before the batch is sent. Raises
+    RuntimeError right away if zstandard is missing.
+    """
+    try:
+        import zstandard
+    except ImportError as e:
+        raise RuntimeError("JSONL export needs the zstandard package") from e
+
+    async def chunks():
+        compressor = zstandard.ZstdCompressor().compressobj()
+        key = after
+        while True:
+            async with session_factory() as session:
+                records, last = await read_page(session, filters, key, batch_size)
+            chunk = compressor.compress(
+                "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode()
+            )
+            if chunk:
+                yield chunk
+            if len(records) < batch_size:
+                break
+            key = last
+        yield compressor.flush()
+
+    return chunks()
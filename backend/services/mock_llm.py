@@ -0,0 +1,144 @@
+"""
+Fake LLM behaviour for load tests without network access or API keys.
+
+MockProfile describes latency distribution, token rate and injected
+errors. It drives both MockAdapter (in-process) and the standalone
+OpenAI-compatible server built by create_fake_openai_app
+(run it with scripts/fake_llm_server.py).
+"""
+
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal", "exponential")
+
+
+@dataclass
+class MockProfile:
+    latency_ms: float = 200.0
+    latency_jitter_ms: float = 50.0
+    latency_distribution: str = "normal"
+    tokens_per_second: float = 0.0
+    reply_tokens: int = 30
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    seed: Optional[int] = None
+
+    def __post_init__(self):
+        if self.latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {self.latency_distribution}")
+        self.rng = random.Random(self.seed)
+
+    def sample_latency(self) -> float:
+        """Seconds before the first token"""
+        mean, jitter = self.latency_ms, self.latency_jitter_ms
+        if self.latency_distribution == "fixed":
+            value = mean
+        elif self.latency_distribution == "uniform":
+            value = self.rng.uniform(mean - jitter, mean + jitter)
+        elif self.latency_distribution == "normal":
+            value = self.rng.gauss(mean, jitter)
+        elif self.latency_distribution == "lognormal":
+            # Long right tail around the given median, jitter sets the spread
+            sigma = jitter / mean if mean > 0 else 0.0
+            value = mean * self.rng.lognormvariate(0.0, sigma)
+        else:
+            value = self.rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+        return max(0.0, value) / 1000.0
+
+    def sample_error(self) -> Optional[int]:
+        """HTTP status of an injected failure, or None"""
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+
+def mock_reply_tokens(message: str, model: str, count: int) -> List[str]:
+    """Deterministic reply split into word-sized tokens"""
+    words = (f"[{model}] " + " ".join(message.split()[:8])).split() or ["mock"]
+    filler = ["lorem", "ipsum", "dolor", "sit", "amet"]
+    while len(words) < count:
+        words.append(filler[len(words) % len(filler)])
+    return [word + " " for word in words[:max(count, 1)]]
+
+
+async def mock_stream(profile: MockProfile, message: str, model: str) -> AsyncIterator[str]:
+    """Wait the sampled latency, then emit tokens at the profile's token rate"""
+    await asyncio.sleep(profile.sample_latency())
+    delay = profile.token_delay()
+    for token in mock_reply_tokens(message, model, profile.reply_tokens):
+        if delay:
+            await asyncio.sleep(delay)
+        yield token
+
+
+def create_fake_openai_app(profile: MockProfile) -> FastAPI:
+    """Minimal OpenAI-compatible /chat/completions server with optional streaming"""
+    app = FastAPI(title="Fake LLM")
+    app.state.profile = profile
+    app.state.requests = 0
+
+    @app.post("/v1/chat/completions")
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        app.state.requests += 1
+        body = await request.json()
+        model = body.get("model", "mock")
+        messages = body.get("messages") or [{}]
+        message = messages[-1].get("content") or ""
+
+        status = profile.sample_error()
+        if status == 429:
+            return JSONResponse(status_code=429, headers={"retry-after": "1"},
+                                content={"error": {"message": "Rate limit reached", "type": "rate_limit_error"}})
+        if status:
+            return JSONResponse(status_code=status,
+                                content={"error": {"message": "Injected failure", "type": "server_error"}})
+
+        completion_id = f"chatcmpl-mock-{app.state.requests}"
+        created = int(time.time())
+
+        if body.get("stream"):
+            async def events():
+                async for token in mock_stream(profile, message, model):
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        text = "".join([token async for token in mock_stream(profile, message, model)])
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(message) // 4, "completion_tokens": profile.reply_tokens,
+                      "total_tokens": len(message) // 4 + profile.reply_tokens},
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return {"requests": app.state.requests}
+
+    return app
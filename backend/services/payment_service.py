@@ -3,7 +3,9 @@ dev2 to be implement description later
 """
 
 from sqlalchemy.ext.asyncio import AsyncSession
+from backend.config import settings
 from backend.database import crud
+from backend.models.enums import SubscriptionPlanType
 from backend.utils.logger import logger
 from backend.utils.exceptions import PaymentValidationError
 from datetime import date
@@ -13,6 +15,7 @@ async def create_invoice(session: AsyncSession, user, amount: int, provider: str
     payment = await crud.create_payment(
         session=session,
         user_id=user.id,
+        telegram_id=user.telegram_id,
         amount=float(amount),
         currency=crud.CurrencyType.RUB,
         payment_date=date.today(),
@@ -41,13 +44,15 @@ async def confirm_payment(session: AsyncSession, payment, status: str):
     await session.commit()
 
     if success:
-        await crud.update_user(
+        # Sets users.plan/access_until/is_vip and drops the cached status everywhere
+        subscription = await crud.grant_subscription(
             session=session,
             user_id=payment.user_id,
-            is_vip=True
+            plan=SubscriptionPlanType.PREMIUM,
+            days=settings.SUBSCRIPTION_DAYS
         )
-        logger.info("Activated VIP for user %s via payment %s",
-                    payment.user_id, payment.id)
+        logger.info("Activated VIP for user %s via payment %s until %s",
+                    payment.user_id, payment.id, subscription.end_date if subscription else None)
     else:
         logger.info("Payment %s completed with status %s", payment.id, status)
 
@@ -0,0 +1,186 @@
+"""
+Per-provider concurrency and rate limiting for AI calls.
+
+Each provider gets a ProviderLimiter: a semaphore for concurrent calls and
+token buckets for requests and tokens per minute. Limits adapt to the
+x-ratelimit-* and retry-after headers the provider sends back. Callers
+wait up to max_wait for capacity instead of failing immediately.
+"""
+
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Callable, Mapping, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class RateLimitExceeded(Exception):
+    """No capacity became available within the allowed wait"""
+
+
+class ProviderRateLimited(Exception):
+    """Provider answered 429; retry_after is in seconds when known"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse '20ms', '1.5s', '6m0s' or a bare number of seconds"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse retry-after given either in seconds or as an HTTP date"""
+    seconds = parse_duration(value)
+    if seconds is not None or not value:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.capacity / 60.0)
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        """Seconds until amount can be consumed (0 when available now)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.capacity
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def adapt(self, limit: Optional[float], remaining: Optional[float]) -> None:
+        """Follow the limit and remaining budget reported by the provider"""
+        self._refill()
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.tokens = min(self.tokens, float(remaining))
+
+
+class ProviderLimiter:
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        max_wait: float,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.name = name
+        self.max_wait = max_wait
+        self._clock = clock
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.requests = TokenBucket(requests_per_minute, clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock)
+        self.blocked_until = 0.0
+        self.waiting = 0
+        self.rejected = 0
+
+    @asynccontextmanager
+    async def acquire(self, tokens: int = 0) -> AsyncIterator[None]:
+        """Hold a concurrency slot and a share of the rate budget for one call"""
+        deadline = self._clock() + self.max_wait
+        self.waiting += 1
+        try:
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise RateLimitExceeded(f"{self.name}: no free concurrency slot after {self.max_wait}s")
+
+            try:
+                while True:
+                    now = self._clock()
+                    delay = max(self.blocked_until - now, self.requests.time_until(1), self.tokens.time_until(tokens))
+                    if delay <= 0:
+                        break
+                    if now + delay > deadline:
+                        self.rejected += 1
+                        raise RateLimitExceeded(f"{self.name}: rate limited for another {delay:.1f}s")
+                    await asyncio.sleep(delay)
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+
+        self.requests.consume(1)
+        self.tokens.consume(tokens)
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    def block_for(self, seconds: Optional[float]) -> None:
+        if seconds:
+            self.blocked_until = max(self.blocked_until, self._clock() + seconds)
+
+    def update_from_headers(self, headers: Mapping[str, str], status_code: int = 200) -> None:
+        """Adapt limits to x-ratelimit-* and retry-after response headers"""
+
+        def number(name: str) -> Optional[float]:
+            try:
+                return float(headers[name])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            remaining = number(f"x-ratelimit-remaining-{kind}")
+            bucket.adapt(number(f"x-ratelimit-limit-{kind}"), remaining)
+            if remaining is not None and remaining <= 0:
+                self.block_for(parse_duration(headers.get(f"x-ratelimit-reset-{kind}")))
+
+        retry_after = parse_retry_after(headers.get("retry-after"))
+        if status_code == 429 or retry_after:
+            self.block_for(retry_after or 1.0)
+            logger.warning("%s rate limited, pausing for %.1fs", self.name, self.retry_delay())
+
+    def retry_delay(self) -> float:
+        """Seconds until the provider accepts requests again"""
+        return max(0.0, self.blocked_until - self._clock())
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "blocked_for": self.retry_delay(),
+            "requests_per_minute": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity,
+        }
@@ -0,0 +1,135 @@
+"""
+Response cache for repeated prompts sent to the same provider/model.
+
+Keys are built from provider, model, system prompt and normalized user text.
+Storage is pluggable: InMemoryCacheStore (LRU + TTL, per process) is the
+default, RedisCacheStore shares entries between workers.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional, Tuple
+
+from ..models.enums import AIProviderType
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Case-fold and collapse whitespace so trivially different prompts share a key"""
+    return " ".join(text.split()).casefold()
+
+
+class InMemoryCacheStore:
+    """Bounded LRU store with per-entry expiry, local to the worker process"""
+
+    def __init__(self, max_size: int = 1000, clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self._clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        self._entries[key] = (self._clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisCacheStore:
+    """
+    Store shared by all workers. Works with redis.asyncio.Redis or any
+    stand-in exposing async get(key) and set(key, value, ex=ttl).
+    """
+
+    def __init__(self, client, prefix: str = "ai_cache:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "ai_cache:") -> "RedisCacheStore":
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("AI_CACHE_REDIS_URL is set but the redis package is not installed") from e
+        return cls(redis.from_url(url), prefix)
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.client.get(self.prefix + key)
+        if isinstance(value, bytes):
+            value = value.decode()
+        return value
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        await self.client.set(self.prefix + key, value, ex=ttl)
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        store,
+        ttl: int = 3600,
+        enabled: bool = True,
+        bypass_models: Iterable[str] = ()
+    ):
+        self.store = store
+        self.ttl = ttl
+        self.enabled = enabled
+        self.bypass_models = set(bypass_models)
+        self.hits = 0
+        self.misses = 0
+
+    def is_cacheable(self, model: str) -> bool:
+        return self.enabled and model not in self.bypass_models
+
+    @staticmethod
+    def make_key(provider: AIProviderType, model: str, system_prompt: str, message: str) -> str:
+        raw = "\x1f".join([provider.value, model, system_prompt, normalize_text(message)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get(self, provider: AIProviderType, model: str, system_prompt: str, message: str) -> Optional[str]:
+        """Return cached reply or None. Store failures are treated as a miss."""
+        if not self.is_cacheable(model):
+            return None
+        try:
+            value = await self.store.get(self.make_key(provider, model, system_prompt, message))
+        except Exception as e:
+            logger.warning(f"Response cache read failed: {e}")
+            value = None
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, provider: AIProviderType, model: str, system_prompt: str, message: str, reply: str) -> None:
+        if not self.is_cacheable(model):
+            return
+        try:
+            await self.store.set(self.make_key(provider, model, system_prompt, message), reply, self.ttl)
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
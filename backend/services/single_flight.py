@@ -0,0 +1,37 @@
+"""
+Single-flight coalescing of identical in-flight calls.
+
+Concurrent callers that use the same key share one upstream call and all
+receive its result (or its exception).
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """
+        Run fn once per key at a time. Returns the result and whether it was
+        shared with a call that was already in flight.
+        """
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        # shield: a caller that gives up must not cancel the call for the others
+        return await asyncio.shield(task), shared
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._in_flight), "coalesced": self.coalesced}
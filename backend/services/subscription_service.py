@@ -7,7 +7,9 @@ from backend.utils.logger import logger
 from backend.config import settings
 from backend.database import crud
 from backend.utils.exceptions import UserNotFound
+from backend.models.enums import SubscriptionPlanType
 from datetime import date, timedelta
+from typing import Optional
 
 
 async def start_trial(session: AsyncSession, telegram_id: str):
@@ -30,8 +32,16 @@ async def start_trial(session: AsyncSession, telegram_id: str):
         return new_user
 
 
-async def has_access(session: AsyncSession, user) -> bool:
-    if user.is_vip:
+def has_access(user, today: Optional[date] = None) -> bool:
+    """
+    Access check on an already loaded user row; no query, since plan and
+    access_until live on users.
+    """
+    today = today or date.today()
+    active = user.access_until is not None and user.access_until >= today
+    if user.is_vip and (user.access_until is None or active):
+        return True
+    if user.plan == SubscriptionPlanType.PREMIUM and active:
         return True
     if user.trial_messages_left > 0:
         return True
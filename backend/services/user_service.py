@@ -1,73 +1,99 @@
 # backend/services/user_service.py
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional, Tuple, Dict, Any
-from datetime import datetime
+from datetime import date
 from ..database import crud
+from ..database.status_cache import UserStatus
 from ..models.enums import SubscriptionPlanType
 from ..models.database import User
+from ..models.schemas import UserProfile
+from ..utils.exceptions import UserNotFound
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+def _parse_telegram_id(telegram_id) -> Optional[int]:
+    try:
+        return int(telegram_id)
+    except (TypeError, ValueError):
+        return None
+
+
+async def register_user(session: AsyncSession, telegram_id) -> User:
+    return await crud.get_or_create_user(session, str(telegram_id))
+
+
+async def get_profile(session: AsyncSession, telegram_id: str) -> UserProfile:
+    """Credits and trial state from the cached status record"""
+    telegram_id_int = _parse_telegram_id(telegram_id)
+    status = await crud.get_user_status(session, telegram_id_int) if telegram_id_int is not None else None
+    if status is None:
+        raise UserNotFound()
+
+    is_trial_active = status.active_plan == SubscriptionPlanType.TRIAL
+    return UserProfile(
+        telegram_id=str(status.telegram_id),
+        credits=status.credits,
+        is_vip=status.is_vip,
+        is_trial_active=is_trial_active,
+        trial_remaining=max(0, (status.plan_end - date.today()).days) if is_trial_active else 0,
+    )
+
+
 class UserService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def get_or_create_user(self, telegram_id: int) -> User:
-        user = crud.get_user_by_telegram_id(self.db, telegram_id)
+    async def get_or_create_user(self, telegram_id: int) -> User:
+        user = await crud.get_user_by_telegram_id(self.db, telegram_id)
         if not user:
-            user = crud.create_user(self.db, telegram_id)
+            user = await crud.create_user(self.db, telegram_id)
             logger.info(f"Created new user with telegram_id: {telegram_id}")
 
-        crud.update_user_last_active(self.db, user.id)
+        await crud.update_user_last_active(self.db, user.id)
         return user
 
-    def get_user_status(self, telegram_id: int) -> Optional[Dict[str, Any]]:
-        user = crud.get_user_by_telegram_id(self.db, telegram_id)
-        if not user:
+    async def get_status(self, telegram_id: int) -> Optional[UserStatus]:
+        return await crud.get_user_status(self.db, telegram_id)
+
+    async def get_user_status(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        status = await self.get_status(telegram_id)
+        if not status:
             return None
 
-        subscription = crud.get_active_subscription(self.db, user.id)
         return {
-            "telegram_id": user.telegram_id,
-            "is_vip": bool(user.is_vip),
-            "trial_messages_left": int(user.trial_messages_left or 0),
-            "has_active_subscription": subscription is not None,
-            "subscription_end_date": subscription.end_date if subscription else None,
-            "active_plan": subscription.plan if subscription else None
+            "telegram_id": status.telegram_id,
+            "is_vip": status.is_vip,
+            "trial_messages_left": status.credits,
+            "has_active_subscription": status.has_active_subscription,
+            "subscription_end_date": status.plan_end if status.has_active_subscription else None,
+            "active_plan": status.active_plan
         }
 
-    def can_user_send_message(self, telegram_id: int) -> Tuple[bool, str, Optional[int]]:
-        user = crud.get_user_by_telegram_id(self.db, telegram_id)
-        if not user:
+    async def can_user_send_message(self, telegram_id: int) -> Tuple[bool, str, Optional[int]]:
+        status = await self.get_status(telegram_id)
+        if not status:
             return False, "User not found", None
 
-        subscription = crud.get_active_subscription(self.db, user.id)
-
-        if subscription:
-            plan = subscription.plan
-            if plan == SubscriptionPlanType.PREMIUM:
-                return True, "Premium subscription active", None
-            elif plan == SubscriptionPlanType.TRIAL:
-                trial_left = int(user.trial_messages_left or 0)
-                if trial_left > 0:
-                    return True, "Trial active", trial_left
-                else:
-                    return False, "Trial messages exhausted", 0
+        plan = status.active_plan
+        if plan == SubscriptionPlanType.PREMIUM:
+            return True, "Premium subscription active", None
+        elif plan == SubscriptionPlanType.TRIAL:
+            if status.credits > 0:
+                return True, "Trial active", status.credits
+            else:
+                return False, "Trial messages exhausted", 0
         else:
-            trial_left = int(user.trial_messages_left or 0)
-            if trial_left > 0:
-                return True, "Using trial messages", trial_left
+            if status.credits > 0:
+                return True, "Using trial messages", status.credits
             else:
                 return False, "No messages left. Please subscribe.", 0
 
-    def decrement_trial_messages(self, telegram_id: int) -> int:
-        user = crud.get_user_by_telegram_id(self.db, telegram_id)
-        if not user:
+    async def decrement_trial_messages(self, telegram_id: int) -> int:
+        status = await self.get_status(telegram_id)
+        if not status or status.credits <= 0:
             return 0
 
-        trial_left = int(user.trial_messages_left or 0)
-        if trial_left > 0:
-            trial_left -= 1
-            crud.decrement_trial_messages(self.db, user.id)
-        return trial_left
+        user = await crud.decrement_trial_messages(self.db, status.user_id, status.telegram_id)
+        return int(user.trial_messages_left) if user else 0
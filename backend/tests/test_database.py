@@ -0,0 +1,920 @@
+import asyncio
+import json
+import os
+
+import pytest
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from backend.database import crud
+from backend.database.heartbeats import HeartbeatBuffer
+from backend.database.history_writer import HistoryWriter
+from backend.database import rollups
+from backend.database.periodic import PeriodicTask
+from backend.database.partitions import Partition, expired_partitions, missing_months, parse_partition
+from backend.database.sharding import HashRing, ShardRouter
+from backend.database.session import ReadRouter, async_database_url, engine_options
+from backend.database.status_cache import RedisInvalidationBus, UserStatus, UserStatusCache
+from backend.services import credit_campaigns, history_export
+from backend.services.user_service import UserService
+from backend.models.database import ActiveUser, Base, CreditReservation, User
+from backend.models.enums import AIProviderType, CurrencyType
+from backend.utils.cursor import decode_cursor, encode_cursor
+
+
+class FakeSession:
+    """Records executed statements; returns the given rows from scalars().all()"""
+
+    def __init__(self, rows=(), fail=False):
+        self.rows = list(rows)
+        self.fail = fail
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    async def execute(self, statement, params=None):
+        if self.fail:
+            raise ConnectionError("database is down")
+        self.executed.append((statement, params))
+        return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: self.rows), all=lambda: self.rows)
+
+    async def commit(self):
+        self.commits += 1
+
+    async def rollback(self):
+        self.rollbacks += 1
+
+
+def test_heartbeats_collapse_and_flush_in_one_transaction():
+    buffer = HeartbeatBuffer()
+    early, late = datetime(2024, 1, 1, 12, 0), datetime(2024, 1, 1, 12, 5)
+    buffer.touch(1, late)
+    buffer.touch(1, early)
+    buffer.touch(2, early)
+    buffer.touch(2, datetime(2023, 12, 31, 23, 59))
+
+    failing = FakeSession(fail=True)
+    try:
+        asyncio.run(buffer.flush(failing))
+    except ConnectionError:
+        pass
+    assert buffer.stats()["pending"] == 2 and failing.rollbacks == 1
+
+    session = FakeSession()
+    flushed = asyncio.run(buffer.flush(session))
+
+    assert flushed == 2 and session.commits == 1
+    assert len(session.executed) == 3
+    params = session.executed[0][1]
+    assert dict(zip(params["user_ids"], params["touched_at"])) == {1: late, 2: early}
+    # Daily actives get every day touched, not only the newest touch
+    statement, params = session.executed[2]
+    assert statement is rollups.COUNT_ACTIVE_DAYS
+    assert set(zip(params["user_ids"], params["days"])) == {
+        (1, early.date()), (2, early.date()), (2, datetime(2023, 12, 31).date())
+    }
+    assert buffer.stats()["pending"] == 0 and buffer.stats()["touches"] == 4
+
+
+def test_recently_active_users_include_unflushed_touches(monkeypatch):
+    buffer = HeartbeatBuffer()
+    monkeypatch.setattr(crud, "heartbeats", buffer)
+    now = datetime.utcnow()
+    stored = [
+        ActiveUser(user_id=1, updated_at=now - timedelta(minutes=30)),
+        ActiveUser(user_id=2, updated_at=now - timedelta(minutes=10)),
+    ]
+    buffer.touch(1, now)
+    buffer.touch(3, now - timedelta(minutes=1))
+    buffer.touch(4, now - timedelta(hours=30))
+
+    active = asyncio.run(crud.get_recently_active_users(FakeSession(stored), hours=24, limit=3))
+
+    assert [active_user.user_id for active_user in active] == [1, 3, 2]
+    assert active[0].updated_at == now
+    # The loaded row is left untouched, so the session has nothing to write back
+    assert stored[0].updated_at == now - timedelta(minutes=30)
+
+
+def test_history_writer_spools_failed_batches_and_replays_them(tmp_path):
+    spool = tmp_path / "spool.jsonl"
+    writer = HistoryWriter(max_queue=2, batch_size=2, max_delay=0.05, put_timeout=0.01, spool_path=str(spool))
+    written = []
+    database_up = False
+
+    async def copy_rows(rows):
+        if not database_up:
+            raise ConnectionError("database is down")
+        written.extend(rows)
+
+    async def scenario():
+        nonlocal database_up
+        writer._copy_rows = copy_rows
+        await writer.put(1, AIProviderType.CHATGPT, "gpt-5", "q1", "a1")
+        await writer.put(1, AIProviderType.CHATGPT, "gpt-5", "q2", "a2")
+        assert [row[3] for row in writer.pending_turns(1)] == ["q2", "q1"]
+        # Queue is full and nothing drains it: the caller is held back, then the row is spooled
+        await writer.put(2, AIProviderType.CHATGPT, "gpt-5", "q3", "a3")
+        assert writer.stats()["backpressure_waits"] == 1
+
+        writer.start(copy_rows)
+        await asyncio.sleep(0.1)
+        assert writer.pending_turns(1) == [] and writer.stats()["failures"] == 1
+
+        database_up = True
+        await writer.put(1, AIProviderType.CHATGPT, "gpt-5", "q4", "a4")
+        await asyncio.sleep(0.1)
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    assert sorted(row[3] for row in written) == ["q1", "q2", "q3", "q4"]
+    assert written[0][1] == "chatgpt" and written[0][5] == 1
+    assert not spool.exists() and writer.stats()["spooled"] == 0
+
+
+def test_history_writer_keeps_the_batch_it_is_stopped_in(tmp_path):
+    spool = tmp_path / "spool.jsonl"
+    written = []
+    copying = asyncio.Event()
+
+    async def copy_rows(rows):
+        written.extend(rows)
+
+    async def hanging_copy(rows):
+        copying.set()
+        await asyncio.sleep(60)
+
+    async def scenario():
+        # Stopped while still collecting the batch: stop() writes the collected rows
+        writer = HistoryWriter(batch_size=10, max_delay=60, spool_path=str(spool))
+        writer.start(copy_rows)
+        await writer.put(1, AIProviderType.CHATGPT, "gpt-5", "q1", "a1")
+        await writer.put(1, AIProviderType.CHATGPT, "gpt-5", "q2", "a2")
+        await asyncio.sleep(0.05)
+        assert writer.stats()["queue_depth"] == 0
+        await writer.stop()
+        assert [row[3] for row in written] == ["q1", "q2"] and not spool.exists()
+
+        # Stopped in the middle of COPY: the batch is spooled for the next start
+        writer = HistoryWriter(batch_size=1, max_delay=60, spool_path=str(spool))
+        writer.start(hanging_copy)
+        await writer.put(2, AIProviderType.CHATGPT, "gpt-5", "q3", "a3")
+        await copying.wait()
+        await writer.stop()
+        assert writer.pending_turns(2) == []
+
+    asyncio.run(scenario())
+    assert [line.split(", ")[3] for line in spool.read_text(encoding="utf-8").splitlines()] == ['"q3"']
+
+
+def test_pgbouncer_mode_turns_statement_caches_off():
+    config = SimpleNamespace(
+        DB_POOL_SIZE=5, DB_MAX_OVERFLOW=0, DB_POOL_TIMEOUT=1.0, DB_POOL_RECYCLE=60,
+        DB_POOL_PRE_PING=True, DB_STATEMENT_CACHE_SIZE=500, DB_PGBOUNCER=False,
+    )
+    assert engine_options(config)["connect_args"]["statement_cache_size"] == 500
+
+    config.DB_PGBOUNCER = True
+    connect_args = engine_options(config)["connect_args"]
+    assert connect_args["statement_cache_size"] == connect_args["prepared_statement_cache_size"] == 0
+    assert connect_args["prepared_statement_name_func"]() != connect_args["prepared_statement_name_func"]()
+    assert async_database_url("postgresql://u:p@db:5432/bot") == "postgresql+asyncpg://u:p@db:5432/bot"
+
+
+def test_partition_maintenance_fills_gaps_and_expires_whole_months():
+    utc = timezone.utc
+    legacy = parse_partition("message_history_legacy", "FOR VALUES FROM (MINVALUE) TO ('2024-05-01 00:00:00+00')")
+    may = parse_partition(
+        "message_history_p202405",
+        "FOR VALUES FROM ('2024-05-01 00:00:00+00') TO ('2024-06-01 00:00:00+00')"
+    )
+    assert legacy == Partition("message_history_legacy", None, datetime(2024, 5, 1, tzinfo=utc))
+
+    now = datetime(2024, 4, 20, tzinfo=utc)
+    assert missing_months([legacy, may], now, 3) == [datetime(2024, 6, 1, tzinfo=utc), datetime(2024, 7, 1, tzinfo=utc)]
+    # A December partition is followed by January of the next year
+    assert missing_months([], datetime(2024, 12, 31, tzinfo=utc), 1)[-1] == datetime(2025, 1, 1, tzinfo=utc)
+
+    assert expired_partitions([legacy, may], datetime(2024, 5, 1, tzinfo=utc)) == [legacy]
+    assert expired_partitions([legacy, may], datetime(2024, 4, 30, tzinfo=utc)) == []
+
+    # created_at is a plain TIMESTAMP in init.sql and create_all: bounds without an offset are UTC
+    june = parse_partition(
+        "message_history_p202406", "FOR VALUES FROM ('2024-06-01 00:00:00') TO ('2024-07-01 00:00:00')"
+    )
+    assert june == Partition("message_history_p202406", datetime(2024, 6, 1, tzinfo=utc), datetime(2024, 7, 1, tzinfo=utc))
+    assert missing_months([legacy, may, june], now, 3) == [datetime(2024, 7, 1, tzinfo=utc)]
+    assert expired_partitions([june], datetime(2024, 8, 1, tzinfo=utc)) == [june]
+
+
+def test_history_page_is_a_keyset_query_with_sql_previews():
+    created_at = datetime(2024, 5, 17, 9, 30, 15, 123456)
+    cursor = encode_cursor(created_at, 4242)
+    assert decode_cursor(cursor) == (created_at, 4242)
+    assert len("history:" + cursor) <= 64
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+    session = FakeSession()
+    asyncio.run(crud.get_history_page(session, 7, 700, 11, decode_cursor(cursor), preview_chars=100))
+    sql = str(session.executed[0][0].compile(dialect=postgresql.dialect()))
+
+    assert "(message_history.created_at, message_history.id) <" in sql
+    # Plain bounds next to the row comparison let the planner skip partitions
+    assert "message_history.created_at <=" in sql and "message_history.created_at >=" in sql
+    assert "left(message_history.ai_response" in sql and "OFFSET" not in sql
+    # Only the listed columns are read, not whole ORM rows
+    assert len(session.executed[0][0].selected_columns) == 6
+
+
+class ListWriter:
+    """Plain JSON lines instead of zstd, failing on the chunk named by fail_on"""
+    extension = "jsonl"
+    fail_on = None
+
+    def __init__(self, path):
+        if ListWriter.fail_on and path.endswith(ListWriter.fail_on + ".tmp"):
+            raise OSError("disk full")
+        self._file = open(path, "w")
+
+    def write(self, records):
+        self._file.writelines(f"{record['id']}\n" for record in records)
+
+    def close(self):
+        self._file.close()
+
+
+class StreamingSession:
+    """session.stream() over history rows, in fetch batches of yield_per"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+
+    async def stream(self, statement):
+        self.statements.append(statement)
+        size = statement.get_execution_options()["yield_per"]
+
+        async def partitions():
+            for start in range(0, len(self.rows), size):
+                yield self.rows[start:start + size]
+
+        return SimpleNamespace(partitions=partitions)
+
+
+def test_history_export_resumes_after_the_last_finished_chunk(tmp_path, monkeypatch):
+    monkeypatch.setitem(history_export.WRITERS, "jsonl", ListWriter)
+    rows = [
+        SimpleNamespace(
+            id=i, user_id=7, created_at=datetime(2024, 5, 1, 12, i), ai_provider=AIProviderType.DEEPSEEK,
+            ai_model="deepseek-chat", user_message="q", ai_response="a", user_tokens=1, response_tokens=1
+        )
+        for i in range(1, 6)
+    ]
+    filters = history_export.ExportFilter(provider=AIProviderType.DEEPSEEK, user_id=7)
+
+    ListWriter.fail_on = "history-00001.jsonl"
+    with pytest.raises(OSError):
+        asyncio.run(history_export.export_history(StreamingSession(rows), str(tmp_path), filters, chunk_rows=2, batch_size=3))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["checkpoint.json", "history-00000.jsonl"]
+
+    ListWriter.fail_on = None
+    session = StreamingSession(rows[2:])
+    checkpoint = asyncio.run(history_export.export_history(session, str(tmp_path), filters, chunk_rows=2, batch_size=3))
+
+    sql = str(session.statements[0].compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    assert "(message_history.created_at, message_history.id) > ('2024-05-01 12:02:00', 2)" in sql
+    assert checkpoint["rows"] == 5 and checkpoint["parts"] == 3 and checkpoint["done"]
+    exported = [(tmp_path / f"history-0000{i}.jsonl").read_text().split() for i in range(3)]
+    assert exported == [["1", "2"], ["3", "4"], ["5"]]
+
+    with pytest.raises(ValueError):
+        history_export.load_checkpoint(str(tmp_path), history_export.ExportFilter(), "jsonl")
+
+
+def test_history_stream_reads_each_batch_in_a_session_of_its_own():
+    zstandard = pytest.importorskip("zstandard")
+    rows = [
+        SimpleNamespace(
+            id=i, user_id=7, created_at=datetime(2024, 5, 1, 12, i), ai_provider=AIProviderType.DEEPSEEK,
+            ai_model="deepseek-chat", user_message="q", ai_response="a", user_tokens=1, response_tokens=1
+        )
+        for i in range(1, 6)
+    ]
+    statements, open_sessions = [], []
+
+    class PageSession:
+        async def __aenter__(self):
+            open_sessions.append(self)
+            return self
+
+        async def __aexit__(self, *exc):
+            open_sessions.remove(self)
+
+        async def execute(self, statement):
+            statements.append(statement)
+            start = 2 * (len(statements) - 1)
+            return SimpleNamespace(all=lambda: rows[start:start + 2])
+
+    async def download():
+        body = b""
+        async for chunk in history_export.stream_jsonl_zstd(PageSession, history_export.ExportFilter(), batch_size=2):
+            assert not open_sessions
+            body += chunk
+        return body
+
+    body = zstandard.ZstdDecompressor().decompressobj().decompress(asyncio.run(download()))
+    assert [json.loads(line)["id"] for line in body.decode().splitlines()] == [1, 2, 3, 4, 5]
+    assert len(statements) == 3
+    sql = str(statements[2].compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    assert "(message_history.created_at, message_history.id) > ('2024-05-01 12:04:00', 4)" in sql
+    assert "LIMIT 2" in sql
+
+
+class FakeRedis:
+    """publish()/pubsub() of redis.asyncio over in-memory queues"""
+
+    def __init__(self):
+        self.queues = []
+
+    async def publish(self, channel, data):
+        for queue in self.queues:
+            queue.put_nowait({"type": "message", "channel": channel, "data": data})
+
+    def pubsub(self):
+        redis = self
+
+        class PubSub:
+            async def subscribe(self, channel):
+                self.queue = asyncio.Queue()
+                redis.queues.append(self.queue)
+
+            async def listen(self):
+                while True:
+                    yield await self.queue.get()
+
+        return PubSub()
+
+
+def test_user_status_cache_invalidates_across_workers():
+    loads = []
+
+    def loader(credits):
+        async def load():
+            loads.append(credits)
+            return UserStatus(user_id=1, telegram_id=100, credits=credits, is_vip=False)
+        return load
+
+    async def scenario():
+        redis = FakeRedis()
+        worker_a = UserStatusCache(bus=RedisInvalidationBus(redis))
+        worker_b = UserStatusCache(bus=RedisInvalidationBus(redis))
+        await worker_a.bus.start()
+        await worker_b.bus.start()
+        await asyncio.sleep(0)
+
+        assert (await worker_a.get_or_load(100, loader(5))).credits == 5
+        assert (await worker_a.get_or_load(100, loader(0))).credits == 5
+        await worker_b.get_or_load(100, loader(5))
+
+        # A write on worker A drops the record on both workers
+        await worker_a.invalidate(1)
+        await asyncio.sleep(0)
+        assert worker_a.get(100) is None and worker_b.get(100) is None
+        assert (await worker_b.get_or_load(100, loader(4))).credits == 4
+
+        # A load that started before an invalidation of the same user is not kept
+        async def slow_load():
+            await worker_a.invalidate(1)
+            return UserStatus(user_id=1, telegram_id=100, credits=3, is_vip=False)
+        assert (await worker_a.get_or_load(100, slow_load)).credits == 3
+        assert worker_a.get(100) is None
+
+        await worker_a.bus.stop()
+        await worker_b.bus.stop()
+        return worker_a.stats()
+
+    stats = asyncio.run(scenario())
+    assert loads == [5, 5, 4]
+    assert stats["hits"] == 1 and stats["invalidations"] >= 2
+    assert 0 < stats["hit_rate"] < 1
+
+
+def test_invalidation_listener_resubscribes_and_flushes_the_cache():
+    class FlakyRedis(FakeRedis):
+        """The first subscription breaks once `dropped` is set"""
+
+        def __init__(self):
+            super().__init__()
+            self.dropped = asyncio.Event()
+            self.subscriptions = 0
+
+        def pubsub(self):
+            pubsub = super().pubsub()
+            self.subscriptions += 1
+            if self.subscriptions > 1:
+                return pubsub
+            listen = pubsub.listen
+
+            async def flaky_listen():
+                messages = listen()
+                while True:
+                    get = asyncio.ensure_future(messages.__anext__())
+                    drop = asyncio.ensure_future(self.dropped.wait())
+                    done, _ = await asyncio.wait({get, drop}, return_when=asyncio.FIRST_COMPLETED)
+                    if drop in done:
+                        get.cancel()
+                        raise ConnectionError("connection reset")
+                    drop.cancel()
+                    yield get.result()
+
+            pubsub.listen = flaky_listen
+            return pubsub
+
+    def status(credits):
+        async def load():
+            return UserStatus(user_id=1, telegram_id=100, credits=credits, is_vip=False)
+        return load
+
+    async def scenario():
+        redis = FlakyRedis()
+        writer = UserStatusCache(bus=RedisInvalidationBus(redis))
+        reader = UserStatusCache(bus=RedisInvalidationBus(redis, retry_delay=0.01))
+        await reader.bus.start()
+        await asyncio.sleep(0)
+        await writer.bus.start()
+        await asyncio.sleep(0)
+        await reader.get_or_load(100, status(5))
+
+        # The reader's connection breaks and a write happens before it is back
+        redis.dropped.set()
+        await asyncio.sleep(0)
+        await writer.invalidate(1)
+        assert reader.get(100) is not None
+
+        # Resubscribing drops everything, since that invalidation was missed
+        await asyncio.sleep(0.05)
+        assert reader.bus.reconnects == 1
+        assert reader.get(100) is None
+
+        # and invalidations arrive again afterwards
+        await reader.get_or_load(100, status(4))
+        await writer.invalidate(1)
+        await asyncio.sleep(0)
+        assert reader.get(100) is None
+
+        await writer.bus.stop()
+        await reader.bus.stop()
+
+    asyncio.run(scenario())
+
+
+def test_expired_reservations_are_returned_in_one_statement(monkeypatch):
+    cache = UserStatusCache()
+    monkeypatch.setattr(crud, "status_cache", cache)
+    session = FakeSession([5, 6])
+
+    released = asyncio.run(crud.release_expired_reservations(session, limit=100))
+
+    assert released == 2 and session.commits == 1 and cache.invalidations == 2
+    sql = str(session.executed[0][0].compile(dialect=postgresql.dialect()))
+    assert len(session.executed) == 1
+    # Rows held by a concurrent commit/release are skipped, not waited on or returned twice
+    assert "FOR UPDATE SKIP LOCKED" in sql
+    assert sql.startswith("WITH expired AS") and "DELETE FROM credit_reservations" in sql
+    assert "trial_messages_left=(users.trial_messages_left + totals.amount)" in sql
+
+
+# The credit flow is checked against a real database when one is given,
+# e.g. TEST_DATABASE_URL=postgresql://postgres@localhost/helper_bot_test
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def credits_db(monkeypatch):
+    """run(scenario): scenario(sessionmaker) on TEST_DATABASE_URL, whose test users are removed afterwards"""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    monkeypatch.setattr(crud, "heartbeats", HeartbeatBuffer())
+    monkeypatch.setattr(crud, "status_cache", UserStatusCache())
+
+    def run(scenario):
+        async def main():
+            engine = create_async_engine(async_database_url(TEST_DATABASE_URL))
+            try:
+                async with engine.begin() as conn:
+                    await conn.run_sync(Base.metadata.create_all)
+                try:
+                    return await scenario(async_sessionmaker(engine, expire_on_commit=False))
+                finally:
+                    async with engine.begin() as conn:
+                        await conn.execute(delete(User).where(User.telegram_id.between(*TEST_TELEGRAM_IDS)))
+            finally:
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
+
+
+TEST_TELEGRAM_IDS = (990000000000, 990000000099)
+
+
+async def _credits(sessionmaker, user_id):
+    async with sessionmaker() as session:
+        left = await session.scalar(select(User.trial_messages_left).where(User.id == user_id))
+        reservations = await session.scalar(
+            select(func.count()).select_from(CreditReservation).where(CreditReservation.user_id == user_id)
+        )
+    return left, reservations
+
+
+def test_reserved_credit_is_kept_on_commit_and_returned_once_on_release(credits_db):
+    async def scenario(sessionmaker):
+        async with sessionmaker() as session:
+            user = await crud.reserve_message(session, TEST_TELEGRAM_IDS[0], trial_messages_left=3)
+        assert (user.trial_messages_left, await _credits(sessionmaker, user.id)) == (2, (2, 1))
+        async with sessionmaker() as session:
+            assert await crud.commit_reservation(session, user.reservation_id)
+            assert not await crud.commit_reservation(session, user.reservation_id)
+            assert await crud.release_reservation(session, user.reservation_id) is None
+        assert await _credits(sessionmaker, user.id) == (2, 0)
+
+        async with sessionmaker() as session:
+            user = await crud.reserve_message(session, TEST_TELEGRAM_IDS[0], trial_messages_left=3)
+        async with sessionmaker() as session:
+            assert await crud.release_reservation(session, user.reservation_id) == 2
+            assert await crud.release_reservation(session, user.reservation_id) is None
+            assert not await crud.commit_reservation(session, user.reservation_id)
+        assert await _credits(sessionmaker, user.id) == (2, 0)
+
+    credits_db(scenario)
+
+
+def test_commit_racing_the_sweeper_settles_the_credit_exactly_once(credits_db):
+    async def scenario(sessionmaker):
+        for attempt in range(20):
+            async with sessionmaker() as session:
+                # Expired at once, so the sweeper may take it
+                user = await crud.reserve_message(session, TEST_TELEGRAM_IDS[0], trial_messages_left=50, ttl=-1)
+            left_before = user.trial_messages_left + 1
+
+            async def commit():
+                async with sessionmaker() as session:
+                    return await crud.commit_reservation(session, user.reservation_id)
+
+            async def sweep():
+                async with sessionmaker() as session:
+                    return await crud.release_expired_reservations(session)
+
+            committed, swept = await asyncio.gather(commit(), sweep())
+            left, reservations = await _credits(sessionmaker, user.id)
+            assert reservations == 0 and committed != bool(swept), attempt
+            assert left == (left_before - 1 if committed else left_before), attempt
+
+    credits_db(scenario)
+
+
+def test_last_credit_goes_to_one_message_and_vip_is_not_charged(credits_db):
+    async def scenario(sessionmaker):
+        async def reserve(telegram_id, limit=1):
+            async with sessionmaker() as session:
+                return await crud.reserve_message(session, telegram_id, trial_messages_left=limit)
+
+        first = await reserve(TEST_TELEGRAM_IDS[0])
+        assert first.trial_messages_left == 0
+        assert await asyncio.gather(reserve(TEST_TELEGRAM_IDS[0]), reserve(TEST_TELEGRAM_IDS[0])) == [None, None]
+        assert await _credits(sessionmaker, first.id) == (0, 1)
+
+        # Without trial messages a new user gets nothing, rather than -1 credits
+        assert await reserve(TEST_TELEGRAM_IDS[1], limit=0) is None
+        async with sessionmaker() as session:
+            assert await crud.get_user_by_telegram_id(session, TEST_TELEGRAM_IDS[1]) is None
+
+        async with sessionmaker() as session:
+            await session.execute(update(User).where(User.id == first.id).values(is_vip=True))
+            await session.commit()
+        for _ in range(3):
+            vip = await reserve(TEST_TELEGRAM_IDS[0], limit=0)
+            assert vip.is_vip and vip.reservation_id is None and vip.trial_messages_left == 0
+        assert await _credits(sessionmaker, first.id) == (0, 1)
+
+        # VIP ends with access_until, not with the next subscription sweep
+        async with sessionmaker() as session:
+            await session.execute(
+                update(User).where(User.id == first.id).values(access_until=datetime.utcnow().date() - timedelta(days=1))
+            )
+            await session.commit()
+        assert await reserve(TEST_TELEGRAM_IDS[0]) is None
+
+    credits_db(scenario)
+
+
+def test_lapsed_subscriptions_are_expired_in_bulk(monkeypatch):
+    cache = UserStatusCache()
+    monkeypatch.setattr(crud, "status_cache", cache)
+    session = FakeSession([3, 4, 9])
+
+    expired = asyncio.run(crud.expire_subscriptions(session, limit=500))
+
+    assert expired == 3 and session.commits == 1 and cache.invalidations == 3
+    sql = str(session.executed[0][0].compile(dialect=postgresql.dialect()))
+    assert len(session.executed) == 1 and "subscriptions" not in sql
+    assert "users.access_until <" in sql and "FOR UPDATE SKIP LOCKED" in sql
+    # Only VIP that came with PREMIUM is taken away; the sweep is not user activity
+    assert "is_vip=CASE WHEN (users.plan =" in sql and "last_active=users.last_active" in sql
+
+
+def test_periodic_task_keeps_running_after_a_failed_run():
+    class Sweep(PeriodicTask):
+        description = "Test sweep"
+
+        def __init__(self):
+            super().__init__(interval=0.01)
+            self.runs = []
+
+        async def run_once(self):
+            self.runs.append(self._session_factory())
+            if len(self.runs) == 1:
+                raise ConnectionError("database went away")
+
+    async def scenario():
+        sweep = Sweep()
+        sweep.start(lambda: FakeSession())
+        while len(sweep.runs) < 3:
+            await asyncio.sleep(0.01)
+        await sweep.stop()
+        assert sweep._task is None
+        return sweep
+
+    sweep = asyncio.run(scenario())
+    assert sweep.failures == 1 and len(sweep.runs) >= 3
+    # A job without run_once is caught when it is built, not on its first run
+    with pytest.raises(TypeError):
+        PeriodicTask(interval=1)
+
+
+def test_campaign_grants_chunks_once_per_user(monkeypatch):
+    granted_so_far = set()
+    calls = []
+
+    async def get_or_create_campaign(session, campaign_id, amount):
+        return None
+
+    async def grant_campaign_credits(session, campaign_id, amount, keys, by_telegram_id=True):
+        calls.append(list(keys))
+        fresh = [key for key in keys if key not in granted_so_far and key != 404]
+        granted_so_far.update(fresh)
+        return fresh
+
+    monkeypatch.setattr(crud, "get_or_create_campaign", get_or_create_campaign)
+    monkeypatch.setattr(crud, "grant_campaign_credits", grant_campaign_credits)
+    seen = []
+
+    def run(ids):
+        return asyncio.run(credit_campaigns.run_campaign(
+            FakeSession(), "spring", 5, ids, chunk_size=2, progress=lambda r: seen.append(r.targeted)
+        ))
+
+    report = run([1, 2, 2, 3, 404])
+    assert calls == [[1, 2], [3, 404]] and seen == [2, 4]
+    assert (report.targeted, report.granted, report.skipped, report.chunks) == (4, 3, 1, 2)
+
+    # A rerun with an overlapping cohort only credits the new users
+    assert run([3, 4]).granted == 1
+
+    sql = crud.GRANT_BY_TELEGRAM_ID.text
+    assert "unnest(CAST(:keys AS BIGINT[]))" in sql and "users.telegram_id = t.key" in sql
+    assert "ON CONFLICT (campaign_id, user_id) DO NOTHING" in sql
+    with pytest.raises(ValueError):
+        asyncio.run(credit_campaigns.run_campaign(FakeSession(), "spring", 5))
+
+
+class StandInDatabase:
+    """Session factory for one database: answers the lag check and the user id lookup"""
+
+    def __init__(self, name, lag=0.0, users=None):
+        self.name = name
+        self.lag = lag
+        self.users = users or {}
+
+    def __call__(self):
+        database = self
+
+        class Session:
+            name = database.name
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def execute(self, statement, params=None):
+                value = database.users.get(params["telegram_id"]) if params else database.lag
+                return SimpleNamespace(scalar_one=lambda: value, scalar_one_or_none=lambda: value)
+
+        return Session()
+
+
+def test_read_router_keeps_recent_writers_and_lagging_replicas_on_the_primary():
+    primary = StandInDatabase("primary")
+    replica = StandInDatabase("replica", lag=0.5, users={100: 7, 200: 8})
+    router = ReadRouter(window=5.0, max_lag=2.0)
+
+    async def read_from(telegram_id=None):
+        async with router.session(primary, replica, telegram_id) as session:
+            return session.name
+
+    # No successful lag check yet
+    assert asyncio.run(read_from(100)) == "primary"
+    asyncio.run(router.check_lag(replica))
+    assert router.replica_healthy
+    assert asyncio.run(read_from(100)) == "replica" and asyncio.run(read_from()) == "replica"
+
+    # The user's own write, e.g. from a status cache invalidation
+    router.note_write(7)
+    assert asyncio.run(read_from(100)) == "primary" and asyncio.run(read_from(200)) == "replica"
+    router._recent_writes[7] -= 10
+    assert asyncio.run(read_from(100)) == "replica"
+
+    # Not replicated yet
+    assert asyncio.run(read_from(300)) == "primary"
+
+    replica.lag = 3.0
+    asyncio.run(router.check_lag(replica))
+    assert asyncio.run(read_from(200)) == "primary"
+    assert router.stats()["replica_reads"] == 4
+
+
+class ShardStandIn(FakeSession):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def test_shard_ring_moves_only_keys_of_the_new_shard_and_fans_out_admin_reads(monkeypatch):
+    ids = range(1, 20001)
+    ring = HashRing(["a", "b", "c"])
+    grown = HashRing(["a", "b", "c", "d"])
+    assert [ring.shard_for(i) for i in ids] == [HashRing(["c", "b", "a"]).shard_for(i) for i in ids]
+
+    moved = [i for i in ids if ring.shard_for(i) != grown.shard_for(i)]
+    assert {grown.shard_for(i) for i in moved} == {"d"}
+    assert 0.15 < len(moved) / len(ids) < 0.35
+
+    # Admin reads fan out to every shard and merge the results
+    monkeypatch.setattr(crud, "heartbeats", HeartbeatBuffer())
+    now = datetime.utcnow()
+    shards = {
+        "a": ShardStandIn([ActiveUser(user_id=1, updated_at=now - timedelta(minutes=5))]),
+        "b": ShardStandIn([ActiveUser(user_id=65, updated_at=now - timedelta(minutes=1))]),
+    }
+    router = ShardRouter({"a": "postgresql://a/bot", "b": "postgresql://b/bot"})
+    monkeypatch.setattr(router, "sessionmaker_for", lambda shard: lambda: shards[shard])
+
+    async def recent():
+        async with router.sessionmaker()() as session:
+            return await crud.get_recently_active_users(session, hours=1, limit=10)
+
+    assert [active_user.user_id for active_user in asyncio.run(recent())] == [65, 1]
+    assert all(len(shard.executed) == 1 for shard in shards.values())
+
+
+def test_sharded_heartbeats_go_only_to_the_shard_of_each_touch(monkeypatch):
+    # Without prepared sequences both shards can have a user with id 1
+    buffer = HeartbeatBuffer()
+    monkeypatch.setattr(crud, "heartbeats", buffer)
+    now = datetime.utcnow()
+    buffer.touch(1, now - timedelta(minutes=2), "a")
+    buffer.touch(1, now - timedelta(minutes=1), "b")
+    router = ShardRouter({"a": "postgresql://a/bot", "b": "postgresql://b/bot"})
+    shards = {"a": ShardStandIn(), "b": ShardStandIn()}
+    monkeypatch.setattr(router, "sessionmaker_for", lambda shard: lambda: shards[shard])
+
+    recent = asyncio.run(crud.get_recently_active_users(router.sessionmaker()(), hours=1))
+    assert [active_user.updated_at for active_user in recent] == [now - timedelta(minutes=1), now - timedelta(minutes=2)]
+
+    shards.update(a=ShardStandIn(), b=ShardStandIn())
+    assert asyncio.run(buffer.flush(router.sessionmaker()())) == 2
+    for shard, minutes in (("a", 2), ("b", 1)):
+        params = shards[shard].executed[0][1]
+        assert params == {"user_ids": [1], "touched_at": [now - timedelta(minutes=minutes)]}
+        assert shards[shard].commits == 1
+
+
+class UserShard(ShardStandIn):
+    """A shard's session as the user crud functions use it"""
+
+    async def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+        return SimpleNamespace(scalar_one_or_none=lambda: None, all=lambda: [])
+
+    def add(self, instance):
+        self.executed.append((instance, None))
+
+    async def refresh(self, instance):
+        pass
+
+    async def close(self):
+        pass
+
+
+def test_user_id_crud_calls_run_on_the_users_shard(monkeypatch):
+    cache = UserStatusCache()
+    monkeypatch.setattr(crud, "status_cache", cache)
+    monkeypatch.setattr(crud, "heartbeats", HeartbeatBuffer())
+    router = ShardRouter({"a": "postgresql://a/bot", "b": "postgresql://b/bot"})
+    shards = {}
+    monkeypatch.setattr(router, "sessionmaker_for", lambda shard: lambda: shards[shard])
+    # One user on each shard
+    telegram_ids = {router.ring.shard_for(telegram_id): telegram_id for telegram_id in range(100, 120)}
+    assert set(telegram_ids) == {"a", "b"}
+
+    calls = {
+        "update_user": lambda session, telegram_id: crud.update_user(session, 1, telegram_id, is_vip=True),
+        "decrement_trial_messages": lambda session, telegram_id: crud.decrement_trial_messages(session, 1, telegram_id),
+        "get_history_page": lambda session, telegram_id: crud.get_history_page(session, 1, telegram_id, 10),
+        "create_payment": lambda session, telegram_id: crud.create_payment(
+            session, 1, telegram_id, 100.0, CurrencyType.RUB, datetime.utcnow().date(), False
+        ),
+        # The status comes from the cache, so nothing routed the session before
+        "UserService.decrement_trial_messages": lambda session, telegram_id: UserService(
+            session
+        ).decrement_trial_messages(telegram_id),
+    }
+
+    async def run(call, telegram_id):
+        async def load():
+            return UserStatus(user_id=1, telegram_id=telegram_id, credits=3, is_vip=False)
+        await cache.get_or_load(telegram_id, load)
+
+        async with router.sessionmaker()() as session:
+            await call(session, telegram_id)
+            return session.shard
+
+    for name, call in calls.items():
+        for shard, telegram_id in telegram_ids.items():
+            shards.update(a=UserShard(), b=UserShard())
+            assert asyncio.run(run(call, telegram_id)) == shard, name
+            other = "b" if shard == "a" else "a"
+            assert shards[shard].executed and not shards[other].executed, name
+
+
+class WatermarkSession(FakeSession):
+    """Keeps rollup watermarks in memory; a name in `locked` is held by another worker"""
+
+    def __init__(self, locked=()):
+        super().__init__()
+        self.positions = {}
+        self.locked = set(locked)
+
+    async def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+        if statement is rollups.INIT_WATERMARK:
+            self.positions.setdefault(params["name"], params["position"])
+        elif statement is rollups.MOVE_WATERMARK:
+            self.positions[params["name"]] = params["position"]
+        position = None if params and params.get("name") in self.locked else self.positions.get((params or {}).get("name"))
+        return SimpleNamespace(scalar_one_or_none=lambda: position)
+
+
+def test_rollups_fold_only_new_rows_window_by_window(monkeypatch):
+    job = rollups.UsageRollups(step=3600, lag=120, revenue_settle_days=3, backfill_days=1)
+    now = datetime(2024, 8, 10, 12, 30)
+    session = WatermarkSession()
+    session.positions["usage"] = datetime(2024, 8, 10, 9, 0)
+
+    assert asyncio.run(job._fold(session, rollups.ROLLUPS[0], now)) == 4
+    windows = [params for statement, params in session.executed if statement is rollups.FOLD_USAGE]
+    assert [(w["start"].hour, w["end"].hour, w["end"].minute) for w in windows] == [
+        (9, 10, 0), (10, 11, 0), (11, 12, 0), (12, 12, 28),
+    ]
+    assert session.positions["usage"] == datetime(2024, 8, 10, 12, 28) and session.commits == 5
+
+    # Nothing new before now - lag; new databases start backfill_days back
+    assert asyncio.run(job._fold(session, rollups.ROLLUPS[0], now)) == 0
+    fresh = WatermarkSession()
+    assert asyncio.run(job._fold(fresh, rollups.ROLLUPS[0], datetime(2024, 8, 9, 1, 0))) == 25
+    assert fresh.positions["usage"] == datetime(2024, 8, 9, 0, 58)
+
+    # Revenue recounts the unsettled days; a worker holding the watermark is left alone
+    assert asyncio.run(job._fold_revenue(session, now)) == 1
+    assert session.executed[-2][1] == {"start_day": datetime(2024, 8, 7).date()}
+    busy = WatermarkSession(locked={"usage", "revenue"})
+    assert asyncio.run(job._fold(busy, rollups.ROLLUPS[0], now)) == 0
+    assert asyncio.run(job._fold_revenue(busy, now)) == 0
+    assert not any(statement in (rollups.FOLD_USAGE, rollups.FOLD_REVENUE) for statement, _ in busy.executed)
+
+    # Sharded reads add the shards' rows up per key
+    day = datetime(2024, 8, 10).date()
+    merged = rollups._sum_by_key(
+        [[(day, "free", 3)], [(day, "free", 2), (day, "premium", 1)]], keys=2
+    )
+    assert merged == [(day, "free", 5), (day, "premium", 1)]
@@ -0,0 +1,582 @@
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import httpx
+from pydantic import ValidationError
+
+from backend.config import Settings, settings
+from backend.models.enums import AIProviderType, SubscriptionPlanType
+from backend.services import conversation
+from backend.services.adapters import ProviderAdapter
+from backend.services.ai_service import AIReply, AIService
+from backend.services.circuit_breaker import CircuitBreaker, CircuitOpen, CLOSED, OPEN
+from backend.services.mock_llm import MockProfile, create_fake_openai_app
+from backend.services.rate_limiter import ProviderLimiter, ProviderRateLimited, RateLimitExceeded, parse_duration
+from backend.services.subscription_service import has_access
+from backend.services.response_cache import InMemoryCacheStore, RedisCacheStore, ResponseCache
+from backend.utils.tokens import count_tokens
+
+
+FAKE_LATENCY = 0.2
+
+
+def fake_chat_completion(content: str) -> dict:
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-test",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+async def slow_openai_endpoint(request: httpx.Request) -> httpx.Response:
+    body = json.loads(request.content)
+    await asyncio.sleep(FAKE_LATENCY)
+    return httpx.Response(200, json=fake_chat_completion(body["messages"][-1]["content"]))
+
+
+def test_chatgpt_requests_run_concurrently(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(settings, "OPENAI_BASE_URL", "http://fake-openai.local/v1")
+
+    async def run():
+        service = AIService()
+        service._http_clients[AIProviderType.CHATGPT] = httpx.AsyncClient(
+            transport=httpx.MockTransport(slow_openai_endpoint)
+        )
+        started = time.perf_counter()
+        replies = await asyncio.gather(*[
+            service.process_message(f"question {i}", AIProviderType.CHATGPT, "gpt-test")
+            for i in range(5)
+        ])
+        elapsed = time.perf_counter() - started
+        await service.shutdown()
+        return replies, elapsed
+
+    replies, elapsed = asyncio.run(run())
+
+    assert replies == [f"question {i}" for i in range(5)]
+    # Sequential execution would take 5 * FAKE_LATENCY
+    assert elapsed < FAKE_LATENCY * 2.5
+
+
+def sse_chat_stream(request: httpx.Request) -> httpx.Response:
+    body = json.loads(request.content)
+    assert body["stream"] is True
+    events = [
+        {"choices": [{"index": 0, "delta": {"role": "assistant"}}]},
+        {"choices": [{"index": 0, "delta": {"content": "Hel"}}]},
+        {"choices": [{"index": 0, "delta": {"content": "lo"}}]},
+    ]
+    payload = "".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+    return httpx.Response(200, content=payload.encode(), headers={"Content-Type": "text/event-stream"})
+
+
+def test_deepseek_stream_yields_chunks(monkeypatch):
+    monkeypatch.setattr(settings, "DEEPSEEK_API_KEY", "test-key")
+
+    async def run():
+        service = AIService()
+        service._http_clients[AIProviderType.DEEPSEEK] = httpx.AsyncClient(
+            base_url="http://fake-deepseek.local", transport=httpx.MockTransport(sse_chat_stream)
+        )
+        chunks = [chunk async for chunk in service.stream_message("hi", AIProviderType.DEEPSEEK, "deepseek-chat")]
+        await service.shutdown()
+        return chunks
+
+    assert asyncio.run(run()) == ["Hel", "lo"]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """Local stand-in for redis.asyncio.Redis"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+
+
+def test_in_memory_cache_store_evicts_lru_and_expires():
+    clock = FakeClock()
+    store = InMemoryCacheStore(max_size=2, clock=clock)
+
+    async def run():
+        await store.set("a", "1", ttl=10)
+        await store.set("b", "2", ttl=10)
+        assert await store.get("a") == "1"
+        await store.set("c", "3", ttl=10)
+        evicted = await store.get("b")
+        clock.now = 11
+        expired = await store.get("a")
+        return evicted, expired
+
+    assert asyncio.run(run()) == (None, None)
+
+
+def test_response_cache_normalizes_text_and_skips_bypass_models():
+    cache = ResponseCache(RedisCacheStore(FakeRedis()), bypass_models=["sonar"])
+
+    async def run():
+        await cache.set(AIProviderType.CHATGPT, "gpt-test", "sys", "Hello   World", "hi")
+        await cache.set(AIProviderType.PERPLEXITY, "sonar", "sys", "Hello World", "hi")
+        return (
+            await cache.get(AIProviderType.CHATGPT, "gpt-test", "sys", " hello world "),
+            await cache.get(AIProviderType.CHATGPT, "other-model", "sys", "hello world"),
+            await cache.get(AIProviderType.PERPLEXITY, "sonar", "sys", "Hello World"),
+        )
+
+    assert asyncio.run(run()) == ("hi", None, None)
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_generate_serves_repeated_prompt_from_cache(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(settings, "OPENAI_BASE_URL", "http://fake-openai.local/v1")
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(200, json=fake_chat_completion("cached answer"))
+
+    async def run():
+        service = AIService()
+        service._http_clients[AIProviderType.CHATGPT] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        first = await service.generate("What is 2+2?", AIProviderType.CHATGPT, "gpt-test")
+        second = await service.generate("what is 2+2? ", AIProviderType.CHATGPT, "gpt-test")
+        await service.shutdown()
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert (first.cached, second.cached) == (False, True)
+    assert second.text == "cached answer"
+    assert len(calls) == 1
+
+
+def test_identical_concurrent_requests_share_one_upstream_call(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(settings, "OPENAI_BASE_URL", "http://fake-openai.local/v1")
+    monkeypatch.setattr(settings, "AI_CACHE_ENABLED", False)
+
+    async def run():
+        service = AIService()
+        service._http_clients[AIProviderType.CHATGPT] = httpx.AsyncClient(
+            transport=httpx.MockTransport(slow_openai_endpoint)
+        )
+        replies = await asyncio.gather(*[
+            service.generate("same question", AIProviderType.CHATGPT, "gpt-test") for _ in range(4)
+        ])
+        stats = service.stats()
+        await service.shutdown()
+        return replies, stats
+
+    replies, stats = asyncio.run(run())
+
+    assert {reply.text for reply in replies} == {"same question"}
+    assert [reply.shared for reply in replies].count(False) == 1
+    assert stats["upstream_calls"] == {"chatgpt/gpt-test": 1}
+    assert stats["single_flight"]["coalesced"] == 3
+
+
+def test_limiter_follows_rate_limit_headers():
+    clock = FakeClock()
+    limiter = ProviderLimiter("test", max_concurrency=2, requests_per_minute=60,
+                              tokens_per_minute=1000, max_wait=1.0, clock=clock)
+
+    limiter.update_from_headers({
+        "x-ratelimit-limit-requests": "120",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "6m0s",
+    })
+
+    assert parse_duration("1m30.5s") == 90.5
+    assert limiter.requests.capacity == 120
+    assert limiter.retry_delay() == 360
+
+    async def run():
+        async with limiter.acquire(10):
+            pass
+
+    try:
+        asyncio.run(run())
+    except RateLimitExceeded:
+        pass
+    else:
+        raise AssertionError("acquire should not wait past max_wait")
+
+    # A negative retry count would skip the call altogether
+    try:
+        Settings(AI_RATE_LIMIT_RETRIES=-1)
+    except ValidationError:
+        pass
+    else:
+        raise AssertionError("AI_RATE_LIMIT_RETRIES must not be negative")
+
+
+def test_deepseek_waits_out_429_instead_of_failing(monkeypatch):
+    monkeypatch.setattr(settings, "DEEPSEEK_API_KEY", "test-key")
+    responses = [
+        httpx.Response(429, headers={"retry-after": "0.1"}, json={"error": "rate limited"}),
+        httpx.Response(200, json=fake_chat_completion("after retry")),
+    ]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return responses.pop(0)
+
+    async def run():
+        service = AIService()
+        service._http_clients[AIProviderType.DEEPSEEK] = httpx.AsyncClient(
+            base_url="http://fake-deepseek.local", transport=httpx.MockTransport(handler)
+        )
+        reply = await service.process_message("hi", AIProviderType.DEEPSEEK, "deepseek-chat")
+        await service.shutdown()
+        return reply
+
+    assert asyncio.run(run()) == "after retry"
+    assert responses == []
+
+
+def test_circuit_breaker_opens_on_failures_and_recovers_after_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker("test", min_calls=4, failure_rate=0.5, slow_call_seconds=5, open_seconds=30, clock=clock)
+
+    breaker.record_success(0.1)
+    breaker.record_success(6.0)
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_success(0.1)
+
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    clock.now = 31
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.state == CLOSED
+
+
+def test_route_leaves_half_open_probes_to_the_dispatched_call(monkeypatch):
+    monkeypatch.setattr(settings, "AI_FALLBACK_MODELS", {})
+    clock = FakeClock()
+    service = AIService()
+    provider, model = AIProviderType.DEEPSEEK, "deepseek-chat"
+    for name in (provider.value, f"{provider.value}/{model}"):
+        service.breakers[name] = CircuitBreaker(name, open_seconds=30, clock=clock)
+    provider_breaker, model_breaker = service._breakers_for(provider, model)
+
+    # The provider is due a probe, the model is still open: nothing is called
+    for _ in range(5):
+        provider_breaker.record_failure()
+    clock.now = 31
+    for _ in range(5):
+        model_breaker.record_failure()
+    try:
+        service.route(provider, model)
+    except CircuitOpen:
+        pass
+    else:
+        raise AssertionError("route should refuse while the model breaker is open")
+    assert provider_breaker.available()
+
+    # Once both agree, route only looks and the call itself takes the probes
+    clock.now = 62
+    assert service.route(provider, model) == (provider, model)
+    assert provider_breaker.available() and model_breaker.available()
+    service._admit(provider, model)
+    assert not provider_breaker.available() and not model_breaker.available()
+
+
+def test_open_circuit_reroutes_to_fallback_model(monkeypatch):
+    monkeypatch.setattr(settings, "DEEPSEEK_API_KEY", "test-key")
+    monkeypatch.setattr(settings, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(settings, "OPENAI_BASE_URL", "http://fake-openai.local/v1")
+    monkeypatch.setattr(settings, "AI_BREAKER_MIN_CALLS", 2)
+    monkeypatch.setattr(settings, "AI_FALLBACK_MODELS", {"deepseek_default": "chatgpt_gpt5"})
+    deepseek_calls = []
+
+    def deepseek_down(request: httpx.Request) -> httpx.Response:
+        deepseek_calls.append(request)
+        return httpx.Response(503, text="unavailable")
+
+    async def run():
+        service = AIService()
+        service._http_clients[AIProviderType.DEEPSEEK] = httpx.AsyncClient(
+            base_url="http://fake-deepseek.local", transport=httpx.MockTransport(deepseek_down)
+        )
+        service._http_clients[AIProviderType.CHATGPT] = httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, json=fake_chat_completion("from gpt")))
+        )
+        for i in range(2):
+            try:
+                await service.generate(f"question {i}", AIProviderType.DEEPSEEK, "deepseek-chat")
+            except Exception:
+                pass
+        reply = await service.generate("question 3", AIProviderType.DEEPSEEK, "deepseek-chat")
+        await service.shutdown()
+        return reply
+
+    reply = asyncio.run(run())
+
+    assert (reply.provider, reply.model, reply.text) == (AIProviderType.CHATGPT, "gpt-5", "from gpt")
+    assert len(deepseek_calls) == 2
+
+
+def test_slow_instant_call_is_hedged_and_fast_duplicate_wins(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(settings, "OPENAI_BASE_URL", "http://fake-openai.local/v1")
+    monkeypatch.setattr(settings, "AI_HEDGE_MODELS", {"chatgpt_instant": "chatgpt_instant"})
+    monkeypatch.setattr(settings, "AI_HEDGE_MIN_SAMPLES", 3)
+    monkeypatch.setattr(settings, "AI_HEDGE_MAX_RATIO", 1.0)
+    calls = []
+
+    async def first_call_stalls(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        if len(calls) == 1:
+            await asyncio.sleep(5)
+        return httpx.Response(200, json=fake_chat_completion("fast"))
+
+    async def run():
+        service = AIService()
+        service._http_clients[AIProviderType.CHATGPT] = httpx.AsyncClient(
+            transport=httpx.MockTransport(first_call_stalls)
+        )
+        for _ in range(3):
+            service.latency.record("chatgpt/gpt-4o-mini", 0.05)
+        started = time.perf_counter()
+        reply = await service.generate("hi", AIProviderType.CHATGPT, "gpt-4o-mini")
+        elapsed = time.perf_counter() - started
+        stats = service.stats()["hedging"]
+        await service.shutdown()
+        return reply, elapsed, stats
+
+    reply, elapsed, stats = asyncio.run(run())
+
+    assert reply.text == "fast"
+    assert elapsed < 1
+    assert len(calls) == 2
+    assert stats["hedged"] == 1 and stats["backup_wins"] == 1
+
+
+def test_mock_mode_and_model_code_override(monkeypatch):
+    monkeypatch.setattr(settings, "AI_MOCK_MODE", True)
+    monkeypatch.setattr(settings, "AI_MOCK_LATENCY_DISTRIBUTION", "fixed")
+    monkeypatch.setattr(settings, "AI_MOCK_LATENCY_MS", 10.0)
+
+    class EchoAdapter(ProviderAdapter):
+        name = "Echo"
+
+        async def complete(self, message: str, model: str, context=None) -> str:
+            return f"echo {message}"
+
+    async def run():
+        service = AIService()
+        service.adapters.register(AIProviderType.DEEPSEEK, EchoAdapter(), model_code="deepseek_thinking")
+        mocked = await service.generate("hello there", AIProviderType.DEEPSEEK, "deepseek-chat")
+        echoed = await service.generate("hello there", AIProviderType.DEEPSEEK, "deepseek-reasoner")
+        return mocked, echoed, service.stats()["adapters"]
+
+    mocked, echoed, adapters = asyncio.run(run())
+
+    assert mocked.text.startswith("[deepseek-chat] hello there")
+    assert echoed.text == "echo hello there"
+    assert adapters["deepseek"] == "Mock" and adapters["deepseek_thinking"] == "Echo"
+
+
+def test_fake_llm_server_with_http_adapter(monkeypatch):
+    monkeypatch.setattr(settings, "DEEPSEEK_API_KEY", "test-key")
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_RETRIES", 0)
+    profile = MockProfile(latency_ms=0, latency_distribution="fixed", reply_tokens=5, rate_limit_rate=1.0, seed=1)
+    app = create_fake_openai_app(profile)
+
+    async def run():
+        service = AIService()
+        service._http_clients[AIProviderType.DEEPSEEK] = httpx.AsyncClient(
+            base_url="http://fake-llm.local/v1", transport=httpx.ASGITransport(app=app)
+        )
+        try:
+            await service.generate("first", AIProviderType.DEEPSEEK, "deepseek-chat")
+        except ProviderRateLimited:
+            limited = True
+        else:
+            limited = False
+
+        profile.rate_limit_rate = 0.0
+        service.limiters[AIProviderType.DEEPSEEK].blocked_until = 0.0
+        reply = await service.generate("second", AIProviderType.DEEPSEEK, "deepseek-chat")
+        chunks = [chunk async for chunk in service.stream_message("third", AIProviderType.DEEPSEEK, "deepseek-chat")]
+        await service.shutdown()
+        return limited, reply, chunks
+
+    limited, reply, chunks = asyncio.run(run())
+
+    assert limited
+    assert reply.text == "[deepseek-chat] second dolor sit amet "
+    assert len(chunks) == 5 and chunks[0] == "[deepseek-chat] "
+
+
+def test_conversation_context_keeps_newest_turns_within_budget(monkeypatch):
+    monkeypatch.setattr(settings, "AI_CONTEXT_TOKEN_BUDGETS", {"chatgpt_instant": 40})
+    monkeypatch.setattr(settings, "DEEPSEEK_API_KEY", "test-key")
+    # Stored counts are trusted; the legacy row without them is counted from its text
+    rows = [
+        SimpleNamespace(id=3, user_message="newest question", ai_response="newest answer",
+                        user_tokens=10, response_tokens=10),
+        SimpleNamespace(id=2, user_message="older question", ai_response="older answer",
+                        user_tokens=None, response_tokens=None),
+        SimpleNamespace(id=1, user_message="oldest question", ai_response="oldest answer",
+                        user_tokens=10, response_tokens=10),
+    ]
+    fetched = []
+
+    async def fake_recent_turns(session, user_id, limit, after_id=None):
+        fetched.append(limit)
+        return rows
+
+    async def no_summary(session, user_id):
+        return None
+
+    monkeypatch.setattr(conversation.crud, "get_recent_turns", fake_recent_turns)
+    monkeypatch.setattr(conversation.crud, "get_conversation_summary", no_summary)
+    sent = []
+
+    async def deepseek(request: httpx.Request) -> httpx.Response:
+        sent.append(json.loads(request.content)["messages"])
+        return httpx.Response(200, json=fake_chat_completion("ok"))
+
+    async def run():
+        context = await conversation.build_context(None, 1, "chatgpt_instant", "system", "follow-up?")
+        service = AIService()
+        service._http_clients[AIProviderType.DEEPSEEK] = httpx.AsyncClient(
+            base_url="http://fake-deepseek.local", transport=httpx.MockTransport(deepseek)
+        )
+        await service.generate("follow-up?", AIProviderType.DEEPSEEK, "deepseek-chat", context)
+        await service.shutdown()
+        return context
+
+    context = asyncio.run(run())
+
+    assert count_tokens("older question") == 4 and count_tokens("Привет, мир!") == 7
+    assert fetched == [settings.AI_CONTEXT_MAX_TURNS]
+    assert [m["content"] for m in context] == ["older question", "older answer", "newest question", "newest answer"]
+    assert [m["role"] for m in sent[0]] == ["system", "user", "assistant", "user", "assistant", "user"]
+    assert sent[0][-1]["content"] == "follow-up?"
+
+
+def test_turns_out_of_window_are_folded_into_summary(monkeypatch):
+    monkeypatch.setattr(settings, "AI_CONTEXT_TOKEN_BUDGETS", {"chatgpt_instant": 100})
+    monkeypatch.setattr(settings, "AI_SUMMARY_MIN_TURNS", 2)
+    # ids 1..6, each turn 30 tokens; newest first like get_recent_turns
+    history = [
+        SimpleNamespace(id=i, user_message=f"q{i}", ai_response=f"a{i}", user_tokens=15, response_tokens=15)
+        for i in range(6, 0, -1)
+    ]
+    stored = {}
+
+    async def fake_recent_turns(session, user_id, limit, after_id=None):
+        return [row for row in history if after_id is None or row.id > after_id][:limit]
+
+    async def fake_unfolded_turns(session, user_id, limit, after_id=None, before_id=None):
+        return [
+            row for row in reversed(history)
+            if (after_id is None or row.id > after_id) and (before_id is None or row.id < before_id)
+        ][:limit]
+
+    async def fake_get_summary(session, user_id):
+        return SimpleNamespace(**stored) if stored else None
+
+    async def fake_save_summary(session, user_id, summary, summary_tokens, last_message_id):
+        stored.update(summary=summary, summary_tokens=summary_tokens, last_message_id=last_message_id)
+
+    # Sessions update_summary holds open; none may be during the summary call
+    open_sessions = []
+
+    @asynccontextmanager
+    async def no_session():
+        open_sessions.append(None)
+        try:
+            yield None
+        finally:
+            open_sessions.pop()
+
+    class FakeAI:
+        prompts = []
+
+        async def generate(self, message, provider, model, context=None):
+            assert not open_sessions
+            self.prompts.append(message)
+            return AIReply("user likes tea", provider, model)
+
+    monkeypatch.setattr(conversation.crud, "get_recent_turns", fake_recent_turns)
+    monkeypatch.setattr(conversation.crud, "get_unfolded_turns", fake_unfolded_turns)
+    monkeypatch.setattr(conversation.crud, "get_conversation_summary", fake_get_summary)
+    monkeypatch.setattr(conversation.crud, "save_conversation_summary", fake_save_summary)
+    ai = FakeAI()
+
+    async def run():
+        await conversation.update_summary(no_session, 100, 1, "chatgpt_instant", "system", ai)
+        return await conversation.build_context(None, 1, "chatgpt_instant", "system", "next")
+
+    context = asyncio.run(run())
+
+    # 100 - 1 (system) - 1 (next message) leaves room for 3 turns; 1..3 are folded
+    assert stored["last_message_id"] == 3
+    assert "User: q1" in ai.prompts[0] and "User: q3" in ai.prompts[0] and "q4" not in ai.prompts[0]
+    assert context[0] == {"role": "system", "content": conversation.SUMMARY_PREFIX + "user likes tea"}
+    assert [m["content"] for m in context[1:] if m["role"] == "user"] == ["q4", "q5", "q6"]
+
+
+    # A backlog bigger than AI_SUMMARY_MAX_FOLD is folded oldest first, call by call
+    monkeypatch.setattr(settings, "AI_SUMMARY_MAX_FOLD", 5)
+    history[:] = [
+        SimpleNamespace(id=i, user_message=f"q{i}", ai_response=f"a{i}", user_tokens=15, response_tokens=15)
+        for i in range(40, 0, -1)
+    ]
+    stored["last_message_id"] = 3
+    watermarks = []
+    for _ in range(3):
+        asyncio.run(conversation.update_summary(no_session, 100, 1, "chatgpt_instant", "system", ai))
+        watermarks.append(stored["last_message_id"])
+    assert watermarks == [8, 13, 18]
+    assert "User: q4\n" in ai.prompts[1] and "User: q8\n" in ai.prompts[1] and "q9" not in ai.prompts[1]
+
+
+def test_access_is_checked_on_the_user_row_alone():
+    from datetime import date
+
+    today = date(2024, 6, 15)
+
+    def user(**fields):
+        row = dict(is_vip=False, plan=None, access_until=None, trial_messages_left=0)
+        row.update(fields)
+        return SimpleNamespace(**row)
+
+    assert has_access(user(is_vip=True), today)
+    assert has_access(user(trial_messages_left=3), today)
+    assert has_access(user(plan=SubscriptionPlanType.PREMIUM, access_until=today), today)
+    # Lapsed but not yet swept: VIP granted by the subscription no longer counts
+    assert not has_access(user(is_vip=True, plan=SubscriptionPlanType.PREMIUM, access_until=date(2024, 6, 14)), today)
+    assert not has_access(user(plan=SubscriptionPlanType.TRIAL, access_until=today), today)
@@ -0,0 +1,30 @@
+"""
+Opaque keyset pagination cursors.
+
+A cursor names the last row of a page by (created_at, id). created_at is
+kept as integer microseconds since the epoch so the round trip is exact;
+the result is short enough for Telegram callback data (64 bytes).
+"""
+
+import base64
+from datetime import datetime, timedelta, timezone
+from typing import Tuple
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    micros = (created_at - EPOCH) // timedelta(microseconds=1)
+    return base64.urlsafe_b64encode(f"{micros}:{row_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_cursor; ValueError if cursor is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        micros, row_id = raw.split(":")
+        return EPOCH + timedelta(microseconds=int(micros)), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"malformed cursor {cursor!r}") from e
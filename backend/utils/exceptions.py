@@ -8,6 +8,7 @@ NotEnoughCredits 402: User lacks sufficient credits for operation
 UserNotFound  404: Requested user does not exist in the system
 PaymentValidationError 400: Payment data failed validation checks
 AIServiceError  500: AI provider service failed or returned an error
+InvalidCursor 400: Pagination cursor is malformed
 """
 
 from fastapi import HTTPException, status
@@ -26,4 +27,8 @@ class PaymentValidationError(HTTPException):
 
 class AIServiceError(HTTPException):
     def __init__(self, detail: str = "AI service error"):
-        super().__init__(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=detail)
\ No newline at end of file
+        super().__init__(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=detail)
+
+class InvalidCursor(HTTPException):
+    def __init__(self, detail: str = "Invalid cursor"):
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
@@ -0,0 +1,23 @@
+"""
+PURPOSE:
+Fast local estimate of how many tokens a text costs a BPE-based model,
+without loading a tokenizer. Used for prompt budgets and stored with
+message history so counts are computed once per message.
+
+Latin words cost about one token per 4 characters, other scripts
+(Cyrillic, CJK) about one per 2, punctuation one token each.
+"""
+
+import re
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    total = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        chars_per_token = 4 if piece.isascii() else 2
+        total += -(-len(piece) // chars_per_token)
+    return total
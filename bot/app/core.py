@@ -9,6 +9,16 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN не найден в .env")
 
+# Адрес backend API (если не задан — используются мок-ответы)
+BACKEND_API_URL = os.getenv("BACKEND_API_URL")
+
+# Не чаще одной правки сообщения в интервал при потоковом ответе (лимиты Telegram)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Сколько сообщений показывать на одной странице /history
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "5"))
+
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
@@ -1,14 +1,18 @@
+import asyncio
+from typing import AsyncIterator
+
 from aiogram import F
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import Message, CallbackQuery
 
 from .core import (
     bot, dp, user_model, waiting_for_question, ensure_user_meta,
     increment_question_count, can_ask_question, DEFAULT_MODEL_CODE,
-    FREE_QUESTION_LIMIT
+    FREE_QUESTION_LIMIT, STREAM_EDIT_INTERVAL, TELEGRAM_MESSAGE_LIMIT
 )
 from .models import MODELS, PROVIDER_TITLES
-from .keyboards import main_menu_kb, providers_menu_kb, models_menu_kb, settings_menu_kb
-from .utils import mock_model_answer
+from .keyboards import main_menu_kb, providers_menu_kb, models_menu_kb, settings_menu_kb, history_kb
+from .utils import stream_model_answer, fetch_history, BackendError
 
 # КОМАНДЫ
 
@@ -30,7 +34,8 @@ async def cmd_help(message: Message):
         "2. Нажми «🤖 Задать вопрос» — следующий текст будет отправлен в ИИ.\n"
         "3. «💰 Мои кредиты» и «➕ Пополнить баланс» пока работают как заглушки — позже их свяжем с backend.\n"
         "4. В /settings можно посмотреть профиль и VIP-информацию.\n"
-        "5. /status — показывает твой статус (VIP или Обычный) и использованные вопросы.",
+        "5. /status — показывает твой статус (VIP или Обычный) и использованные вопросы.\n"
+        "6. /history — последние вопросы и ответы, кнопками можно листать дальше.",
         parse_mode="Markdown",
     )
 
@@ -76,6 +81,57 @@ async def cmd_status(message: Message):
 
     await message.answer(f"Статус: {status_text}\n{limit_text}", parse_mode="Markdown")
 
+# ИСТОРИЯ
+
+def format_history_page(items: list[dict]) -> str:
+    """Текст страницы /history; обрезанные backend'ом тексты помечаются «…»."""
+    if not items:
+        return "История пуста."
+    blocks = []
+    for item in items:
+        created = item["created_at"][:16].replace("T", " ")
+        ellipsis = "…" if item.get("truncated") else ""
+        blocks.append(
+            f"🕒 {created} — {item['ai_model']}\n"
+            f"❓ {item['user_message']}\n"
+            f"💬 {item['ai_response']}{ellipsis}"
+        )
+    return "\n\n".join(blocks)[:TELEGRAM_MESSAGE_LIMIT]
+
+
+@dp.message(F.text == "/history")
+async def cmd_history(message: Message):
+    """Последние вопросы и ответы; кнопки листают дальше в прошлое."""
+    try:
+        page = await fetch_history(message.from_user.id)
+    except BackendError as exc:
+        await message.answer(f"⚠️ {exc}")
+        return
+    await message.answer(
+        format_history_page(page["items"]),
+        reply_markup=history_kb(page.get("next_cursor"), first_page=True),
+    )
+
+
+@dp.callback_query(F.data.startswith("history:"))
+async def on_history_page(callback: CallbackQuery):
+    """Следующая страница истории в том же сообщении; пустой курсор — снова с начала."""
+    cursor = callback.data.split(":", 1)[1] or None
+    try:
+        page = await fetch_history(callback.from_user.id, cursor)
+    except BackendError as exc:
+        await callback.answer(str(exc), show_alert=True)
+        return
+    try:
+        await callback.message.edit_text(
+            format_history_page(page["items"]),
+            reply_markup=history_kb(page.get("next_cursor"), first_page=cursor is None),
+        )
+    except TelegramBadRequest:
+        # например "message is not modified" — не критично
+        pass
+    await callback.answer()
+
 # КНОПКИ ГЛАВНОГО МЕНЮ И НАСТРОЕК
 
 @dp.callback_query(F.data == "ask_ai")
@@ -230,6 +286,51 @@ async def on_model_selected(callback: CallbackQuery):
     )
     await callback.answer()
 
+# ПОТОКОВЫЙ ОТВЕТ
+
+async def edit_reply(sent: Message, text: str, wait: bool = False) -> float:
+    """
+    Правит сообщение. Возвращает, сколько секунд Telegram просит подождать
+    (0 — правка прошла). С wait=True ждёт и повторяет правку.
+    """
+    while True:
+        try:
+            await sent.edit_text(text)
+            return 0.0
+        except TelegramRetryAfter as exc:
+            if not wait:
+                return float(exc.retry_after)
+            await asyncio.sleep(exc.retry_after)
+        except TelegramBadRequest:
+            # например "message is not modified" — не критично
+            return 0.0
+
+
+async def stream_reply(sent: Message, header: str, chunks: AsyncIterator[str]):
+    """
+    Дописывает ответ в одно сообщение по мере прихода кусков.
+    Правки не чаще STREAM_EDIT_INTERVAL; если текст не влезает
+    в лимит Telegram — продолжает в новом сообщении.
+    """
+    loop = asyncio.get_running_loop()
+    text = ""
+    next_edit = 0.0
+
+    async for chunk in chunks:
+        text += chunk
+
+        while len(header) + len(text) > TELEGRAM_MESSAGE_LIMIT:
+            cut = TELEGRAM_MESSAGE_LIMIT - len(header)
+            await edit_reply(sent, header + text[:cut], wait=True)
+            header, text = "", text[cut:]
+            sent = await sent.answer(text[:TELEGRAM_MESSAGE_LIMIT] or "…")
+
+        if text and loop.time() >= next_edit:
+            delay = await edit_reply(sent, header + text + " ▌")
+            next_edit = loop.time() + max(STREAM_EDIT_INTERVAL, delay)
+
+    await edit_reply(sent, header + (text or "Модель вернула пустой ответ."), wait=True)
+
 # ОБРАБОТКА СООБЩЕНИЙ
 
 @dp.message()
@@ -264,12 +365,13 @@ async def handle_message(message: Message):
         status = "платная 💰" if paid else "бесплатная 🆓"
         full_name = f"{provider} — {name}"
 
-        # временный ответ модели
-        model_reply = await mock_model_answer(code, text)
-
-        await message.answer(
-            f"Текущая модель: {full_name} ({status})\n\n{model_reply}"
-        )
+        # ответ модели приходит по кускам — правим одно сообщение
+        header = f"Текущая модель: {full_name} ({status})\n\n"
+        sent = await message.answer(header + "⏳ Думаю...")
+        try:
+            await stream_reply(sent, header, stream_model_answer(user_id, code, text))
+        except BackendError as exc:
+            await edit_reply(sent, header + f"⚠️ {exc}", wait=True)
     else:
         await message.answer(
             f"Ты написал: {text}\n"
@@ -75,3 +75,13 @@ def settings_menu_kb() -> InlineKeyboardMarkup:
         ],
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def history_kb(next_cursor: str | None, first_page: bool) -> InlineKeyboardMarkup | None:
+    """Кнопки листания /history: дальше в прошлое и назад к последним сообщениям."""
+    row = []
+    if next_cursor:
+        row.append(InlineKeyboardButton(text="⬅️ Раньше", callback_data=f"history:{next_cursor}"))
+    if not first_page:
+        row.append(InlineKeyboardButton(text="🔄 К последним", callback_data="history:"))
+    return InlineKeyboardMarkup(inline_keyboard=[row]) if row else None
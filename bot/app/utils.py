@@ -1,12 +1,17 @@
+import json
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
 from .models import MODELS
-from .core import DEFAULT_MODEL_CODE
+from .core import DEFAULT_MODEL_CODE, BACKEND_API_URL, HISTORY_PAGE_SIZE
 
 # ВРЕМЕННЫЙ "ОТВЕТ МОДЕЛИ" (ЗАГЛУШКА)
 
 async def mock_model_answer(model_code: str, text: str) -> str:
     """
     ВРЕМЕННЫЙ мок-ответ вместо настоящего ИИ.
-    Потом здесь будет запрос на backend /process_message.
+    Используется, пока не задан BACKEND_API_URL.
     """
     info = MODELS.get(model_code, MODELS[DEFAULT_MODEL_CODE])
     provider = info["provider"]
@@ -20,3 +25,92 @@ async def mock_model_answer(model_code: str, text: str) -> str:
         f"Исходный текст: {text}\n"
         f"Фэйковый ответ: {fake}"
     )
+
+# ПОТОКОВЫЙ ОТВЕТ ЧЕРЕЗ BACKEND
+
+class BackendError(Exception):
+    """Backend вернул ошибку — текст можно показать пользователю."""
+
+
+_backend_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_backend_session() -> aiohttp.ClientSession:
+    """Одна HTTP-сессия на весь бот, чтобы переиспользовать соединения с backend."""
+    global _backend_session
+    if _backend_session is None or _backend_session.closed:
+        _backend_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=120)
+        )
+    return _backend_session
+
+
+async def close_backend_session():
+    if _backend_session is not None and not _backend_session.closed:
+        await _backend_session.close()
+
+
+async def stream_model_answer(user_id: int, model_code: str, text: str) -> AsyncIterator[str]:
+    """
+    Отдаёт куски ответа модели по мере генерации (SSE от /process_message/stream).
+    Без BACKEND_API_URL отдаёт мок-ответ одним куском.
+    """
+    if not BACKEND_API_URL:
+        yield await mock_model_answer(model_code, text)
+        return
+
+    url = f"{BACKEND_API_URL.rstrip('/')}/v1/process_message/stream"
+    payload = {"telegram_id": str(user_id), "text": text, "model_code": model_code}
+
+    try:
+        async with get_backend_session().post(url, json=payload) as resp:
+            if resp.status != 200:
+                try:
+                    detail = (await resp.json()).get("detail")
+                except (aiohttp.ContentTypeError, ValueError):
+                    detail = None
+                raise BackendError(detail or f"Ошибка backend: {resp.status}")
+
+            event = None
+            async for raw in resp.content:
+                line = raw.decode("utf-8").rstrip("\r\n")
+                if not line:
+                    event = None
+                elif line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):].strip())
+                    if event == "error":
+                        raise BackendError(data.get("detail", "Ошибка AI сервиса"))
+                    if event == "done":
+                        return
+                    if "delta" in data:
+                        yield data["delta"]
+    except aiohttp.ClientError as exc:
+        raise BackendError("Backend недоступен, попробуйте позже") from exc
+
+
+# ИСТОРИЯ СООБЩЕНИЙ
+
+async def fetch_history(user_id: int, cursor: Optional[str] = None, limit: int = HISTORY_PAGE_SIZE) -> dict:
+    """
+    Страница истории из /history: {"items": [...], "next_cursor": str | None}.
+    next_cursor передаётся обратно, чтобы получить более старые сообщения.
+    """
+    if not BACKEND_API_URL:
+        raise BackendError("История доступна только с подключённым backend")
+
+    url = f"{BACKEND_API_URL.rstrip('/')}/v1/history"
+    params = {"telegram_id": str(user_id), "limit": limit}
+    if cursor:
+        params["cursor"] = cursor
+
+    try:
+        async with get_backend_session().get(url, params=params) as resp:
+            if resp.status == 404:
+                return {"items": [], "next_cursor": None}
+            if resp.status != 200:
+                raise BackendError(f"Ошибка backend: {resp.status}")
+            return await resp.json()
+    except aiohttp.ClientError as exc:
+        raise BackendError("Backend недоступен, попробуйте позже") from exc
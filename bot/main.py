@@ -1,9 +1,13 @@
 import asyncio
 from app import core, handlers
+from app.utils import close_backend_session
 
 async def main():
     print("Бот запускается...")
-    await core.dp.start_polling(core.bot)
+    try:
+        await core.dp.start_polling(core.bot)
+    finally:
+        await close_backend_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,66 @@
+"""
+Export message_history into chunked, zstd-compressed JSONL or Parquet files.
+Rows are streamed from a server-side cursor, so memory use does not grow with
+the table. Re-running with the same --out and filters resumes after the last
+finished chunk (see checkpoint.json in the output directory):
+
+    python scripts/export_history.py --out exports/2024-05 \
+        --since 2024-05-01 --until 2024-06-01 --provider deepseek --format parquet
+
+With DB_SHARDS, export one --telegram-id, or run once per --shard with an
+--out of its own.
+"""
+import argparse
+import asyncio
+import sys
+import os
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.config import settings
+from backend.database import crud
+from backend.database.session import dispose_engine, session_scope
+from backend.database.sharding import shard_router
+from backend.models.enums import AIProviderType
+from backend.services.history_export import WRITERS, ExportFilter, export_history
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="message_history bulk export")
+    parser.add_argument("--out", required=True, help="output directory, also holds the checkpoint")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="jsonl")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="created_at >= since (UTC)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="created_at < until (UTC)")
+    parser.add_argument("--provider", type=AIProviderType, choices=list(AIProviderType))
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--telegram-id")
+    parser.add_argument("--shard", choices=shard_router.shards if shard_router else None, help="export this shard only")
+    parser.add_argument("--chunk-rows", type=int, default=100000, help="rows per output file")
+    parser.add_argument("--batch-size", type=int, default=settings.EXPORT_BATCH_SIZE, help="rows per fetch")
+    args = parser.parse_args()
+    if args.shard and shard_router is None:
+        sys.exit("--shard needs DB_SHARDS")
+    if shard_router is not None and not (args.shard or args.telegram_id):
+        sys.exit("With DB_SHARDS, give --telegram-id or run once per --shard")
+
+    scope = shard_router.sessionmaker_for(args.shard) if args.shard else session_scope
+    async with scope() as session:
+        user_id = args.user_id
+        if args.telegram_id:
+            user = await crud.get_user_by_telegram(session, args.telegram_id)
+            if not user:
+                sys.exit(f"No user with telegram_id {args.telegram_id}")
+            user_id = user.id
+
+        filters = ExportFilter(since=args.since, until=args.until, provider=args.provider, user_id=user_id)
+        checkpoint = await export_history(
+            session, args.out, filters, args.format, args.chunk_rows, args.batch_size
+        )
+    await dispose_engine()
+    if shard_router is not None:
+        await shard_router.dispose()
+    print(f"Exported {checkpoint['rows']} rows into {checkpoint['parts']} files in {args.out}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+"""
+Standalone fake OpenAI-compatible LLM server for load tests.
+
+Point the backend at it with OPENAI_BASE_URL / DEEPSEEK_BASE_URL /
+PERPLEXITY_BASE_URL=http://127.0.0.1:8100/v1 and any non-empty API keys.
+
+    python scripts/fake_llm_server.py --latency-ms 300 --jitter-ms 100 \
+        --distribution lognormal --tokens-per-second 50 --error-rate 0.01
+"""
+import argparse
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+
+from backend.services.mock_llm import LATENCY_DISTRIBUTIONS, MockProfile, create_fake_openai_app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="mean/median time to first token")
+    parser.add_argument("--jitter-ms", type=float, default=50.0, help="spread of the latency distribution")
+    parser.add_argument("--distribution", choices=LATENCY_DISTRIBUTIONS, default="normal")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="0 sends the reply at once")
+    parser.add_argument("--reply-tokens", type=int, default=30)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    profile = MockProfile(
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.jitter_ms,
+        latency_distribution=args.distribution,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    )
+    print(f"Fake LLM listening on http://{args.host}:{args.port}/v1")
+    uvicorn.run(create_fake_openai_app(profile), host=args.host, port=args.port, log_level="warning")
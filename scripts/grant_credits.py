@@ -0,0 +1,83 @@
+"""
+Grant credits to many users at once (a credit campaign). Users come from a
+file of telegram_ids, one per line ("-" reads stdin), or from filters.
+Each user is credited at most once per campaign, so an interrupted run can
+simply be started again:
+
+    python scripts/grant_credits.py --campaign spring-2024 --amount 5 --ids-file cohort.txt
+    python scripts/grant_credits.py --campaign winback-may --amount 3 \
+        --active-since 2024-01-01 --created-before 2024-04-01
+"""
+import argparse
+import asyncio
+import sys
+import os
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.config import settings
+from backend.database.session import dispose_engine, session_scope
+from backend.models.enums import SubscriptionPlanType
+from backend.services.credit_campaigns import CampaignFilter, run_campaign
+
+
+def read_ids(path: str):
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with f:
+        return [int(line) for line in (line.strip() for line in f) if line]
+
+
+def print_progress(report) -> None:
+    print(
+        f"chunk {report.chunks}: {report.targeted} users processed, {report.granted} credited, "
+        f"{report.seconds:.1f}s",
+        flush=True
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="bulk credit grant")
+    parser.add_argument("--campaign", required=True, help="campaign id, users are credited once per campaign")
+    parser.add_argument("--amount", type=int, required=True)
+    parser.add_argument("--ids-file", help="telegram_ids, one per line; - for stdin")
+    parser.add_argument("--active-since", type=datetime.fromisoformat, help="last_active >= (UTC)")
+    parser.add_argument("--created-before", type=datetime.fromisoformat, help="created_at < (UTC)")
+    parser.add_argument("--plan", type=SubscriptionPlanType, choices=list(SubscriptionPlanType))
+    parser.add_argument("--vip", dest="is_vip", action="store_true", default=None)
+    parser.add_argument("--no-vip", dest="is_vip", action="store_false")
+    parser.add_argument("--all-users", action="store_true", help="credit every user")
+    parser.add_argument("--chunk-size", type=int, default=settings.CAMPAIGN_CHUNK_SIZE, help="users per statement")
+    args = parser.parse_args()
+
+    if args.amount <= 0:
+        sys.exit("--amount must be positive")
+    telegram_ids, filters = None, None
+    if args.ids_file:
+        telegram_ids = read_ids(args.ids_file)
+    else:
+        filters = CampaignFilter(
+            active_since=args.active_since,
+            created_before=args.created_before,
+            plan=args.plan,
+            is_vip=args.is_vip,
+        )
+        if filters.is_empty() and not args.all_users:
+            sys.exit("Give --ids-file, a filter or --all-users")
+
+    try:
+        async with session_scope() as session:
+            report = await run_campaign(
+                session, args.campaign, args.amount, telegram_ids, filters, args.chunk_size, print_progress
+            )
+    except ValueError as e:
+        sys.exit(str(e))
+    finally:
+        await dispose_engine()
+    print(
+        f"Campaign {report.campaign_id}: {report.granted} users credited with {report.amount}, "
+        f"{report.skipped} skipped, {report.seconds:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
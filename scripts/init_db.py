@@ -1,11 +1,17 @@
+import asyncio
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from backend.database.session import engine
-from backend.models.database import Base
+from backend.database.session import dispose_engine, init_db
+
+
+async def main():
+    await init_db()
+    await dispose_engine()
+
 
 if __name__ == "__main__":
     print("Initializing database...")
-    Base.metadata.create_all(bind=engine)
-    print("Database initialized successfully!")
\ No newline at end of file
+    asyncio.run(main())
+    print("Database initialized successfully!")
@@ -0,0 +1,101 @@
+"""
+Resharding of user data (see backend/database/sharding.py).
+
+1. Give every shard, including new ones, its own id offset once:
+
+    python scripts/reshard.py prepare --shard shard3 --offset 3
+
+2. Deploy with DB_SHARDS (current layout) and DB_SHARDS_NEXT (target layout).
+   Requests keep working while users move.
+
+3. Move the users whose shard changes; busy users are retried:
+
+    python scripts/reshard.py plan
+    python scripts/reshard.py move
+
+4. Once move reports nothing left, set DB_SHARDS to the target layout and
+   drop DB_SHARDS_NEXT.
+"""
+import argparse
+import asyncio
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.config import settings
+from backend.database.sharding import moving_users, move_user, prepare_sequences, shard_router
+
+
+async def plan(batch_size: int) -> None:
+    for shard in shard_router.shards:
+        counts = {}
+        async for batch in moving_users(shard_router, shard, batch_size):
+            for telegram_id in batch:
+                target = shard_router.placement(telegram_id)[1]
+                counts[target] = counts.get(target, 0) + 1
+        print(f"{shard}: " + (", ".join(f"{n} to {target}" for target, n in sorted(counts.items())) or "nothing to move"))
+
+
+async def move(batch_size: int, retries: int, retry_delay: float) -> int:
+    busy = []
+    moved = 0
+    for shard in shard_router.shards:
+        async for batch in moving_users(shard_router, shard, batch_size):
+            for telegram_id in batch:
+                if await move_user(shard_router, telegram_id):
+                    moved += 1
+                else:
+                    busy.append(telegram_id)
+            print(f"{shard}: {moved} users moved, {len(busy)} busy", flush=True)
+
+    for attempt in range(retries):
+        if not busy:
+            break
+        await asyncio.sleep(retry_delay)
+        still_busy = []
+        for telegram_id in busy:
+            if await move_user(shard_router, telegram_id):
+                moved += 1
+            elif shard_router.placement(telegram_id)[0] != shard_router.placement(telegram_id)[1]:
+                still_busy.append(telegram_id)
+        busy = still_busy
+        print(f"retry {attempt + 1}: {moved} users moved, {len(busy)} busy", flush=True)
+    return len(busy)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="move users between shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    prepare = commands.add_parser("prepare", help="set a shard's id sequences to its offset")
+    prepare.add_argument("--shard", required=True)
+    prepare.add_argument("--offset", type=int, required=True, help=f"0..{settings.DB_SHARD_ID_STRIDE - 1}, unique per shard")
+    for name in ("plan", "move"):
+        command = commands.add_parser(name)
+        command.add_argument("--batch-size", type=int, default=1000, help="users scanned per query")
+    commands.choices["move"].add_argument("--retries", type=int, default=10, help="passes over busy users")
+    commands.choices["move"].add_argument("--retry-delay", type=float, default=5.0)
+    args = parser.parse_args()
+
+    if shard_router is None:
+        sys.exit("DB_SHARDS is not set")
+    try:
+        if args.command == "prepare":
+            if not 0 <= args.offset < settings.DB_SHARD_ID_STRIDE:
+                sys.exit(f"--offset must be below DB_SHARD_ID_STRIDE ({settings.DB_SHARD_ID_STRIDE})")
+            await prepare_sequences(shard_router.engine(args.shard), args.offset, settings.DB_SHARD_ID_STRIDE)
+            print(f"{args.shard}: id sequences step by {settings.DB_SHARD_ID_STRIDE} from offset {args.offset}")
+        elif shard_router.next_ring is None:
+            sys.exit("DB_SHARDS_NEXT is not set")
+        elif args.command == "plan":
+            await plan(args.batch_size)
+        else:
+            left = await move(args.batch_size, args.retries, args.retry_delay)
+            if left:
+                sys.exit(f"{left} users still busy, run move again")
+            print("All users are on their target shards")
+    finally:
+        await shard_router.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())